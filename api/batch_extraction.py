@@ -0,0 +1,131 @@
+import asyncio
+import io
+import json
+import os
+import time
+import zipfile
+
+try:
+    from .extraction_cache import hash_pdf_bytes
+    from .pdf_extractor import extract_fields_from_pdf
+    from .scheduler import BACKGROUND
+except ImportError:
+    from extraction_cache import hash_pdf_bytes
+    from pdf_extractor import extract_fields_from_pdf
+    from scheduler import BACKGROUND
+
+# Reports extracted at the same time. Their category calls all share the process-wide model
+# scheduler, so this only bounds per-report bookkeeping, not model concurrency.
+BATCH_MAX_OPEN_REPORTS = int(os.getenv("BATCH_MAX_OPEN_REPORTS", "32"))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "500"))
+# Total PDF bytes per batch (uploaded files plus the uncompressed PDFs in the archive).
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def read_zip_pdfs(archive_bytes, max_files=BATCH_MAX_FILES, max_bytes=BATCH_MAX_BYTES):
+    """Return [(filename, pdf_bytes, sha256)] for every PDF inside a zip archive.
+
+    Raises ValueError when the archive holds more than `max_files` PDFs or more than
+    `max_bytes` of them uncompressed; both are checked before any PDF is read.
+    """
+    documents = []
+    try:
+        with zipfile.ZipFile(io.BytesIO(archive_bytes)) as archive:
+            entries = []
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not name.lower().endswith(".pdf") or name.startswith("._"):
+                    continue
+                entries.append((name, info))
+            # The limits may be what is left of the batch's budget after its other uploads.
+            if len(entries) > max_files:
+                raise ValueError(f"The archive holds {len(entries)} PDFs; at most {max_files} fit in this batch")
+            total = sum(info.file_size for _, info in entries)
+            if total > max_bytes:
+                raise ValueError(f"The archive's PDFs total {total} bytes; at most {max_bytes} fit in this batch")
+            for name, info in entries:
+                pdf_bytes = archive.read(info)
+                # Hashed here, off the event loop, like direct uploads.
+                documents.append((name, pdf_bytes, hash_pdf_bytes(pdf_bytes)))
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"Invalid zip archive: {e}") from e
+    return documents
+
+
+def resolve_form_types(filenames, form_types, default_form_type):
+    """Map each file to its form type.
+
+    `form_types` may be a JSON object keyed by filename, a JSON list in upload order, or a
+    comma-separated list in upload order; files without an entry use `default_form_type`.
+    """
+    if not form_types:
+        return [default_form_type] * len(filenames)
+    try:
+        parsed = json.loads(form_types)
+    except json.JSONDecodeError:
+        parsed = [value.strip() for value in form_types.split(",")]
+    if isinstance(parsed, dict):
+        return [str(parsed.get(name, default_form_type)) for name in filenames]
+    if isinstance(parsed, list):
+        values = [str(value) for value in parsed]
+        return [values[i] if i < len(values) and values[i] else default_form_type for i in range(len(filenames))]
+    return [str(parsed)] * len(filenames)
+
+
+async def stream_batch_extraction(documents, client=None):
+    """Extract many reports and yield one event per unique report as it completes.
+
+    `documents` is a list of (filename, pdf_bytes, form_type, sha256). Identical files with the same
+    form type are extracted once and reported under every filename. Their model calls are
+    background traffic, so reviewers' interactive requests go ahead of them.
+    """
+    started_at = time.perf_counter()
+    groups = {}
+    for filename, pdf_bytes, form_type, pdf_sha256 in documents:
+        key = (pdf_sha256, form_type)
+        if key not in groups:
+            groups[key] = {"filenames": [], "pdf_bytes": pdf_bytes}
+        groups[key]["filenames"].append(filename)
+
+    open_reports = asyncio.Semaphore(BATCH_MAX_OPEN_REPORTS)
+
+    async def extract_report(key, group):
+        pdf_sha256, form_type = key
+        async with open_reports:
+            report_started = time.perf_counter()
+            try:
+                result = await extract_fields_from_pdf(None, form_type, pdf_bytes=group["pdf_bytes"], pdf_sha256=pdf_sha256,
+                                                      priority=BACKGROUND, client=client)
+                error = None
+            except Exception as e:
+                result, error = {"fields": {}, "raw": ""}, str(e)
+        event = {
+            "event": "report",
+            "filenames": group["filenames"],
+            "document_sha256": pdf_sha256,
+            "form_type": form_type,
+            "elapsed": round(time.perf_counter() - report_started, 3),
+            **result,
+        }
+        if error:
+            event["error"] = error
+        return event
+
+    tasks = [asyncio.ensure_future(extract_report(key, group)) for key, group in groups.items()]
+    failed = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            event = await next_done
+            failed += 1 if "error" in event else 0
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    yield {
+        "event": "summary",
+        "files": len(documents),
+        "unique_reports": len(groups),
+        "failed_reports": failed,
+        "elapsed": round(time.perf_counter() - started_at, 3),
+    }
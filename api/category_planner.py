@@ -0,0 +1,83 @@
+import json
+import os
+
+try:
+    from .response_schema import parse_json_object
+except ImportError:
+    from response_schema import parse_json_object
+
+# Small field groups are packed into combined model calls up to these budgets.
+COALESCE_CATEGORIES = os.getenv("COALESCE_CATEGORIES", "1") == "1"
+COALESCE_MAX_FIELDS = int(os.getenv("COALESCE_MAX_FIELDS", "60"))
+COALESCE_MAX_FIELD_CHARS = int(os.getenv("COALESCE_MAX_FIELD_CHARS", "3500"))
+# Photo/consistency checks reason over the whole report and are kept in their own call.
+COALESCE_EXCLUDED = {"IMAGE_ANALYSIS", "DATA_CONSISTENCY"}
+
+
+def field_chars(fields_list) -> int:
+    return sum(len(field) for field in fields_list)
+
+
+def plan_category_batches(categories, field_categories, max_fields=COALESCE_MAX_FIELDS,
+                          max_field_chars=COALESCE_MAX_FIELD_CHARS, enabled=COALESCE_CATEGORIES, affinity=None):
+    """Group categories into model calls.
+
+    Returns a list of batches (lists of category names) in first-appearance order. Grid
+    categories, excluded categories and anything over budget on its own get a batch of one.
+    When given, `affinity(category_name)` restricts batches to categories with equal values
+    (e.g. so page-routed sections are not packed with ones that need the whole report).
+    """
+    batches = []
+    open_batches = []  # [batch, field_count, char_count, affinity] that can still take categories
+    for category_name in categories:
+        fields_list = field_categories.get(category_name)
+        if not enabled or fields_list is None or category_name in COALESCE_EXCLUDED:
+            batches.append([category_name])
+            continue
+        count, chars = len(fields_list), field_chars(fields_list)
+        group = affinity(category_name) if affinity else None
+        if count > max_fields or chars > max_field_chars:
+            batches.append([category_name])
+            continue
+        for candidate in open_batches:
+            if candidate[3] == group and candidate[1] + count <= max_fields and candidate[2] + chars <= max_field_chars:
+                candidate[0].append(category_name)
+                candidate[1] += count
+                candidate[2] += chars
+                break
+        else:
+            batch = [category_name]
+            batches.append(batch)
+            open_batches.append([batch, count, chars, group])
+    return batches
+
+
+def build_batch_prompt(batch, field_categories, base_instructions):
+    groups = " ".join(f"Fields for {category_name}: {field_categories[category_name]}." for category_name in batch)
+    return (
+        "Extract the following groups of fields from the appraisal report. "
+        "Return your answer strictly as a JSON object with one key per group name and this structure: "
+        "{ 'GROUP NAME': { 'FieldName': 'Value', ... }, ... } using exactly these group names: "
+        f"{', '.join(batch)}. "
+        "If a field is missing, set its value to ''. Do not include any explanation or formatting outside the JSON object. "
+        f"{base_instructions} {groups}"
+    )
+
+
+def split_batch_response(raw_text, batch):
+    """Split a combined response back into per-category JSON text.
+
+    Returns (split, complete). Categories missing from the response (or an unparseable
+    response) are left out so the caller can retry them individually; complete is False
+    when the response was salvaged from truncated JSON.
+    """
+    data, complete = parse_json_object(raw_text)
+    if data is None:
+        return {}, False
+    lookup = {key.strip().upper(): value for key, value in data.items()}
+    split = {}
+    for category_name in batch:
+        value = lookup.get(category_name)
+        if isinstance(value, dict):
+            split[category_name] = json.dumps(value)
+    return split, complete
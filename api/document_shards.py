@@ -0,0 +1,115 @@
+import hashlib
+import math
+import os
+import re
+
+# Reports this large (bytes or pages) are extracted in page-range shards whenever a call would
+# otherwise carry the whole document: inline requests have a size limit, and one call over a
+# long report is much slower than several over its parts.
+SHARDING = os.getenv("SHARDING", "1") == "1"
+SHARD_MIN_BYTES = int(os.getenv("SHARD_MIN_BYTES", str(15 * 1024 * 1024)))
+SHARD_MIN_PAGES = int(os.getenv("SHARD_MIN_PAGES", "60"))
+# Upper bounds for one shard; bytes are estimated assuming pages are of similar size.
+SHARD_MAX_PAGES = int(os.getenv("SHARD_MAX_PAGES", "30"))
+SHARD_MAX_BYTES = int(os.getenv("SHARD_MAX_BYTES", str(12 * 1024 * 1024)))
+SHARD_MAX_COUNT = int(os.getenv("SHARD_MAX_COUNT", "8"))
+# Pages repeated at the start of the next shard, so a section cut at a boundary is whole in one of them.
+SHARD_OVERLAP_PAGES = int(os.getenv("SHARD_OVERLAP_PAGES", "1"))
+# Largest PDF the model accepts inline. Categories that need the whole report (photos, cross-page
+# checks) are never sharded, so they cannot be extracted from a larger inline document.
+INLINE_MAX_BYTES = int(os.getenv("INLINE_MAX_BYTES", str(20 * 1024 * 1024)))
+
+SHARD_VERSION = hashlib.sha256(
+    repr(("2", SHARD_MIN_BYTES, SHARD_MIN_PAGES, SHARD_MAX_PAGES, SHARD_MAX_BYTES, SHARD_MAX_COUNT,
+          SHARD_OVERLAP_PAGES)).encode()
+).hexdigest()[:8]
+
+
+class DocumentTooLarge(ValueError):
+    pass
+
+# Answers that only point elsewhere ("See attached addendum"); the shard holding the text itself wins.
+_REFERENCE_PATTERN = re.compile(r"^(see|refer to|per|as stated in)\b.*\b(addend\w*|attach\w*|comments?|page|report)\b",
+                                re.IGNORECASE)
+_EMPTY, _REFERENCE, _VALUE = 0, 1, 2
+
+
+def plan_shards(page_count: int, document_bytes: int, enabled=SHARDING):
+    """Page ranges [(start, stop)] to extract separately, or None for documents small enough to send whole."""
+    if not enabled or page_count < 2:
+        return None
+    if document_bytes < SHARD_MIN_BYTES and page_count < SHARD_MIN_PAGES:
+        return None
+    count = max(2, math.ceil(page_count / SHARD_MAX_PAGES), math.ceil(document_bytes / SHARD_MAX_BYTES))
+    count = min(count, page_count, SHARD_MAX_COUNT)
+    starts = [round(number * page_count / count) for number in range(count)] + [page_count]
+    return [(starts[number], min(page_count, starts[number + 1] + SHARD_OVERLAP_PAGES)) for number in range(count)]
+
+
+def _rank(value):
+    if value is None:
+        return _EMPTY
+    if isinstance(value, str):
+        text = value.strip()
+        if not text:
+            return _EMPTY
+        return _REFERENCE if len(text) < 120 and _REFERENCE_PATTERN.match(text) else _VALUE
+    if isinstance(value, dict):
+        return max((_rank(item) for item in value.values()), default=_EMPTY)
+    if isinstance(value, list):
+        return _VALUE if any(_rank(item) for item in value) else _EMPTY
+    return _VALUE
+
+
+def _comparable(value):
+    # "$1,500" and "1500 " are the same answer formatted differently.
+    if isinstance(value, str):
+        return re.sub(r"[^0-9a-z.]", "", value.lower())
+    return repr(value)
+
+
+def _is_object(value):
+    # {'choice': ..., 'comment': ...} answers are one value, not fields to merge separately.
+    return isinstance(value, dict) and "choice" not in value
+
+
+def _merge(values, path, conflicts, join_text):
+    if all(_is_object(value) for value in values):
+        keys = dict.fromkeys(key for value in values for key in value)
+        return {
+            key: _merge([value[key] for value in values if key in value], path + (str(key),), conflicts, join_text)
+            for key in keys
+        }
+    if all(isinstance(value, list) for value in values):
+        merged, seen = [], set()
+        for item in (item for value in values for item in value):
+            if _comparable(item) not in seen:
+                seen.add(_comparable(item))
+                merged.append(item)
+        return merged
+    best = max(_rank(value) for value in values)
+    distinct = {}
+    for value in values:
+        if _rank(value) == best:
+            distinct.setdefault(_comparable(value), value)
+    candidates = list(distinct.values())
+    if len(candidates) > 1 and best == _VALUE:
+        if join_text and all(isinstance(value, str) for value in candidates):
+            return "; ".join(value.strip() for value in candidates)
+        conflicts.append("/".join(path))
+    return candidates[0]
+
+
+def merge_shard_answers(answers, join_text=False):
+    """Merge JSON answers from each shard, in page order, into one answer.
+
+    Per field, a real value beats a pointer to another part of the report ("See addendum"),
+    which beats an empty one. When shards give different real values the earliest pages
+    win (the form itself comes before its addenda) and the field is listed as a conflict;
+    with `join_text` (free-form findings, where each shard saw different pages) the
+    distinct answers are joined instead. Lists are concatenated without duplicates.
+
+    Returns (merged answer, conflicting field paths).
+    """
+    conflicts = []
+    return _merge(list(answers), (), conflicts, join_text), conflicts
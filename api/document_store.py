@@ -0,0 +1,106 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Uploaded PDFs are kept in memory up to DOCUMENT_MEMORY_MAX_BYTES; older documents spill to disk.
+DOCUMENT_TTL_SECONDS = float(os.getenv("DOCUMENT_TTL_SECONDS", str(60 * 60)))
+DOCUMENT_MEMORY_MAX_BYTES = int(os.getenv("DOCUMENT_MEMORY_MAX_BYTES", str(256 * 1024 * 1024)))
+DOCUMENT_SPILL_DIR = os.getenv("DOCUMENT_SPILL_DIR") or os.path.join(tempfile.gettempdir(), "appraisutra-documents")
+
+
+class DocumentStore:
+    """Content-addressed store for uploaded PDFs, so a report is sent once and extracted many times."""
+
+    def __init__(self, ttl_seconds=DOCUMENT_TTL_SECONDS, memory_max_bytes=DOCUMENT_MEMORY_MAX_BYTES,
+                 spill_dir=DOCUMENT_SPILL_DIR):
+        self.ttl_seconds = ttl_seconds
+        self.memory_max_bytes = memory_max_bytes
+        self.spill_dir = spill_dir
+        self._memory = OrderedDict()  # document_id -> bytes
+        self._expires = {}  # document_id -> expiry timestamp (memory and disk)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, pdf_bytes, pdf_sha256: str = None) -> str:
+        document_id = pdf_sha256 or hashlib.sha256(pdf_bytes).hexdigest()
+        with self._lock:
+            self._purge_expired()
+            self._expires[document_id] = time.time() + self.ttl_seconds
+            if document_id in self._memory:
+                self._memory.move_to_end(document_id)
+                return document_id
+            if os.path.exists(self._spill_path(document_id)):
+                return document_id
+            self._memory[document_id] = pdf_bytes
+            self._memory_bytes += len(pdf_bytes)
+            self._spill_over_budget()
+        return document_id
+
+    def get(self, document_id: str):
+        with self._lock:
+            self._purge_expired()
+            if document_id not in self._expires:
+                return None
+            # Every use extends the document's lifetime.
+            self._expires[document_id] = time.time() + self.ttl_seconds
+            if document_id in self._memory:
+                self._memory.move_to_end(document_id)
+                return self._memory[document_id]
+        try:
+            with open(self._spill_path(document_id), "rb") as f:
+                return f.read()
+        except OSError:
+            with self._lock:
+                self._expires.pop(document_id, None)
+            return None
+
+    def delete(self, document_id: str) -> bool:
+        with self._lock:
+            known = self._expires.pop(document_id, None) is not None
+            self._drop(document_id)
+        return known
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "documents": len(self._expires),
+                "in_memory": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+            }
+
+    def _spill_path(self, document_id):
+        return os.path.join(self.spill_dir, f"{document_id}.pdf")
+
+    def _spill_over_budget(self):
+        while self._memory_bytes > self.memory_max_bytes and len(self._memory) > 1:
+            document_id, pdf_bytes = self._memory.popitem(last=False)
+            self._memory_bytes -= len(pdf_bytes)
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                with open(self._spill_path(document_id), "wb") as f:
+                    f.write(pdf_bytes)
+            except OSError as e:
+                print(f"Could not spill document {document_id} to disk: {e}")
+                self._expires.pop(document_id, None)
+
+    def _purge_expired(self):
+        now = time.time()
+        for document_id in [doc_id for doc_id, expires in self._expires.items() if expires < now]:
+            del self._expires[document_id]
+            self._drop(document_id)
+
+    def _drop(self, document_id):
+        pdf_bytes = self._memory.pop(document_id, None)
+        if pdf_bytes is not None:
+            self._memory_bytes -= len(pdf_bytes)
+            return
+        try:
+            os.remove(self._spill_path(document_id))
+        except OSError:
+            pass
+
+
+document_store = DocumentStore()
@@ -0,0 +1,217 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# In-memory tier limits. The disk tier is only enabled when EXTRACTION_CACHE_DIR is set.
+CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "512"))
+CACHE_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_TTL_SECONDS = float(os.getenv("EXTRACTION_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR")
+CACHE_DISK_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def hash_pdf_bytes(pdf_bytes) -> str:
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+@functools.lru_cache(maxsize=1024)
+def prompt_version(prompt_text: str) -> str:
+    # Any change to a field list or prompt wording produces a new version, so stale
+    # results are never served after the prompts are edited.
+    return hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:16]
+
+
+def make_cache_key(pdf_sha256: str, form_type: str, category: str, version: str) -> str:
+    raw_key = "\x1f".join([pdf_sha256, str(form_type), str(category), version])
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    """Two-tier (memory LRU + optional disk) cache of raw model responses per category."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl_seconds=CACHE_TTL_SECONDS,
+                 directory=CACHE_DIR, disk_max_bytes=CACHE_DISK_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (created_at, value)
+        self._bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return value
+                self._remove(key)
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._store(key, entry[0], entry[1])
+            return entry[1]
+
+    def set(self, key: str, value: str):
+        created_at = time.time()
+        with self._lock:
+            self._store(key, created_at, value)
+        self._write_disk(key, created_at, value)
+
+    async def get_async(self, key: str):
+        # The disk tier does blocking file I/O; keep it off the event loop.
+        if self.directory:
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def set_async(self, key: str, value: str):
+        if self.directory:
+            return await asyncio.to_thread(self.set, key, value)
+        return self.set(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "disk_enabled": bool(self.directory),
+            }
+
+    def _store(self, key, created_at, value):
+        if key in self._entries:
+            self._remove(key)
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (created_at, value)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value.encode("utf-8"))
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read_disk(self, key, now):
+        if not self.directory:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if now - payload.get("created_at", 0) > self.ttl_seconds:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return payload.get("created_at", now), payload.get("value", "")
+
+    def _write_disk(self, key, created_at, value):
+        if not self.directory:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": created_at, "value": value}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Extraction cache could not write to disk: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += os.path.getsize(path)
+            over_limit = self._disk_bytes > self.disk_max_bytes
+        if over_limit:
+            self._prune_disk()
+
+    def _disk_files(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".json"):
+                    yield os.path.join(root, name)
+
+    def _scan_disk_bytes(self):
+        total = 0
+        for path in self._disk_files():
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    def _prune_disk(self):
+        # Drop expired files first, then the least recently written ones, until the
+        # disk tier is back under 90% of its budget.
+        now = time.time()
+        files = []
+        for path in self._disk_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.disk_max_bytes * 0.9
+        for mtime, size, path in files:
+            if total <= target and now - mtime <= self.ttl_seconds:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        with self._lock:
+            self._disk_bytes = total
+
+
+extraction_cache = ExtractionCache()
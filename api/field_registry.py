@@ -0,0 +1,60 @@
+import json
+import os
+
+# Ask the model to key its answer by short field IDs instead of echoing long field names.
+COMPACT_FIELD_IDS = os.getenv("COMPACT_FIELD_IDS", "1") == "1"
+# These lists are instructions whose answers use their own keys, not field names.
+FREE_FORM_CATEGORIES = {"IMAGE_ANALYSIS", "DATA_CONSISTENCY"}
+
+FIELD_ID_INSTRUCTIONS = (
+    "Fields are given as a JSON object mapping a field ID to the field name. "
+    "Use the field ID (for example 'F1') as the key in your answer instead of the field name. "
+)
+
+
+class FieldRegistry:
+    """Short, deterministic field IDs per category (F1, F2, ... in field-list order).
+
+    Prompts carry the ID -> name legend once; responses keyed by ID are expanded back to
+    the full field names, so callers see the same keys as before.
+    """
+
+    def __init__(self, field_categories, excluded=FREE_FORM_CATEGORIES, enabled=COMPACT_FIELD_IDS):
+        self.enabled = enabled
+        self._labels = {}  # category -> {field_id: field name}
+        self._lookup = {}  # category -> {FIELD_ID: field name}
+        for category_name, fields in field_categories.items():
+            if category_name in excluded:
+                continue
+            labels = {}
+            for field in dict.fromkeys(fields):  # some lists repeat a field; it keeps one ID
+                labels[f"F{len(labels) + 1}"] = field
+            self._labels[category_name] = labels
+            self._lookup[category_name] = {field_id.upper(): field for field_id, field in labels.items()}
+
+    def is_compact(self, category_name) -> bool:
+        return self.enabled and category_name in self._labels
+
+    @property
+    def instructions(self) -> str:
+        return FIELD_ID_INSTRUCTIONS if self.enabled else ""
+
+    def prompt_fields(self, category_name, fields):
+        """`fields` as they appear in the prompt: the ID legend, or the plain list."""
+        if not self.is_compact(category_name):
+            return fields
+        return json.dumps(dict(self.response_keys(category_name, fields)))
+
+    def expand(self, category_name, data):
+        if not self.is_compact(category_name) or not isinstance(data, dict):
+            return data
+        lookup = self._lookup[category_name]
+        # Keys that are not IDs (e.g. the model echoed a full name) are kept as they are.
+        return {lookup.get(str(key).strip().upper(), key): value for key, value in data.items()}
+
+    def response_keys(self, category_name, fields):
+        """[(key the model answers with, field name)] for a category."""
+        if not self.is_compact(category_name):
+            return [(field, field) for field in dict.fromkeys(fields)]
+        wanted = set(fields)
+        return [(field_id, field) for field_id, field in self._labels[category_name].items() if field in wanted]
@@ -0,0 +1,304 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    from .pdf_extractor import ExtractionRun, build_category_prompt, build_extraction_result, categories_for
+except ImportError:
+    from pdf_extractor import ExtractionRun, build_category_prompt, build_extraction_result, categories_for
+
+JOB_DB_PATH = os.getenv("JOB_DB_PATH") or os.path.join(tempfile.gettempdir(), "appraisutra-jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+# Extraction attempts per category (each a full retried model call) before a job finishes without it,
+# and the wait before a job with failed categories is picked up again.
+JOB_CATEGORY_ATTEMPTS = int(os.getenv("JOB_CATEGORY_ATTEMPTS", "3"))
+JOB_RETRY_DELAY_SECONDS = float(os.getenv("JOB_RETRY_DELAY_SECONDS", "30"))
+# Finished jobs (and their results) are deleted after this long; their PDFs as soon as they finish.
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 60 * 60)))
+JOB_PURGE_INTERVAL_SECONDS = float(os.getenv("JOB_PURGE_INTERVAL_SECONDS", "600"))
+# A running job is leased to one worker and renewed while it runs; a job whose lease ran out
+# (its process died) is picked up again by any worker sharing the database.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    form_type TEXT NOT NULL,
+    category TEXT,
+    status TEXT NOT NULL,
+    pdf BLOB NOT NULL,
+    pdf_sha256 TEXT NOT NULL,
+    previous_sha256 TEXT,
+    total_categories INTEGER NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    retry_at REAL,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at);
+CREATE TABLE IF NOT EXISTS job_categories (
+    job_id TEXT NOT NULL,
+    category TEXT NOT NULL,
+    status TEXT NOT NULL,
+    raw TEXT,
+    details TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, category)
+);
+"""
+
+
+class JobQueue:
+    """SQLite-backed queue of full-report extractions.
+
+    Per-category results are written as soon as each category finishes, so a restarted
+    process resumes a job with only the categories that were still outstanding. A job whose
+    categories failed goes back to the queue until each has had JOB_CATEGORY_ATTEMPTS tries.
+    Several processes can share the database: jobs are claimed atomically under a lease.
+    """
+
+    def __init__(self, path=JOB_DB_PATH, workers=JOB_WORKERS):
+        self.path = path
+        self.workers = workers
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._tasks = []
+        self._purged_at = 0.0
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "previous_sha256" not in columns:  # databases created before revisions were linked
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN previous_sha256 TEXT")
+            if "retry_at" not in columns:  # databases created before failed categories were retried
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN retry_at REAL")
+            if "owner" not in columns:  # databases created before jobs were leased
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+            category_columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(job_categories)")}
+            if "attempts" not in category_columns:
+                self._conn.execute("ALTER TABLE job_categories ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1")
+        return self._conn
+
+    def _execute(self, sql, params=(), fetch=None):
+        with self._lock:
+            db = self._connect()
+            with db:
+                cursor = db.execute(sql, params)
+                if fetch == "one":
+                    return cursor.fetchone()
+                if fetch == "all":
+                    return cursor.fetchall()
+                return cursor.rowcount
+
+    async def _db(self, sql, params=(), fetch=None):
+        return await asyncio.to_thread(self._execute, sql, params, fetch)
+
+    async def submit(self, pdf_bytes, pdf_sha256: str, form_type: str, category: str = None,
+                     previous_sha256: str = None) -> str:
+        job_id = uuid.uuid4().hex
+        total = sum(1 for name in categories_for(form_type, category) if build_category_prompt(name) is not None)
+        await self._db(
+            "INSERT INTO jobs (id, form_type, category, status, pdf, pdf_sha256, previous_sha256, total_categories, created_at) "
+            "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, form_type, category, bytes(pdf_bytes), pdf_sha256, previous_sha256, total, time.time()),
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str):
+        job = await self._db(
+            "SELECT id, form_type, category, status, pdf_sha256, total_categories, error, created_at, started_at, finished_at "
+            "FROM jobs WHERE id = ?", (job_id,), fetch="one",
+        )
+        if job is None:
+            return None
+        rows = await self._db(
+            "SELECT category, status, raw, details, attempts FROM job_categories WHERE job_id = ?", (job_id,), fetch="all"
+        )
+        raw_by_category = {row["category"]: row["raw"] for row in rows if row["raw"] is not None}
+        status = {row["category"]: json.loads(row["details"]) for row in rows}
+        partial = build_extraction_result(categories_for(job["form_type"], job["category"]), raw_by_category, status)
+        # Categories that will be tried again are still pending, not failed.
+        failed = sum(1 for row in rows if row["raw"] is None and row["attempts"] >= JOB_CATEGORY_ATTEMPTS)
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "form_type": job["form_type"],
+            "category": job["category"],
+            "document_sha256": job["pdf_sha256"],
+            "progress": {
+                "completed": sum(1 for row in rows if row["raw"] is not None),
+                "failed": failed,
+                "total": job["total_categories"],
+            },
+            "fields": partial["fields"],
+            "raw": partial["raw"],
+            "category_status": partial["status"],
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+        }
+
+    async def purge(self):
+        """Delete jobs that finished more than JOB_RETENTION_SECONDS ago."""
+        self._purged_at = time.monotonic()
+
+        def purge():
+            cutoff = time.time() - JOB_RETENTION_SECONDS
+            with self._lock:
+                db = self._connect()
+                with db:
+                    db.execute(
+                        "DELETE FROM job_categories WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)", (cutoff,)
+                    )
+                    return db.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,)).rowcount
+
+        deleted = await asyncio.to_thread(purge)
+        if deleted:
+            print(f"Purged {deleted} finished job(s)")
+
+    async def start(self):
+        if self._tasks:
+            return
+        # Jobs left running by a process that stopped are reclaimed once their lease expires.
+        await self.purge()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._worker(number)) for number in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Hand this process's unfinished jobs back without waiting for their leases to expire.
+        await self._db(
+            "UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL WHERE status = 'running' AND owner = ?",
+            (self.owner,),
+        )
+
+    async def _claim_next(self):
+        claimable = (
+            "(status = 'queued' AND (retry_at IS NULL OR retry_at <= :now)) "
+            "OR (status = 'running' AND (lease_until IS NULL OR lease_until < :now))"
+        )
+
+        def claim():
+            with self._lock:
+                db = self._connect()
+                with db:
+                    now = time.time()
+                    for row in db.execute(f"SELECT id FROM jobs WHERE {claimable} ORDER BY created_at LIMIT 8",
+                                          {"now": now}).fetchall():
+                        # Conditional on the job still being claimable, so only one process wins it.
+                        claimed = db.execute(
+                            f"UPDATE jobs SET status = 'running', owner = :owner, lease_until = :lease, "
+                            f"started_at = COALESCE(started_at, :now) WHERE id = :id AND ({claimable})",
+                            {"owner": self.owner, "lease": now + JOB_LEASE_SECONDS, "now": now, "id": row["id"]},
+                        ).rowcount
+                        if claimed:
+                            return db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+                    return None
+
+        return await asyncio.to_thread(claim)
+
+    async def _renew_lease(self, job_id):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            await self._db(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time() + JOB_LEASE_SECONDS, job_id, self.owner),
+            )
+
+    async def _worker(self, number):
+        while True:
+            job = await self._claim_next()
+            if job is None:
+                if time.monotonic() - self._purged_at > JOB_PURGE_INTERVAL_SECONDS:
+                    await self.purge()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            lease = asyncio.ensure_future(self._renew_lease(job["id"]))
+            try:
+                await self._run_job(job)
+            except asyncio.CancelledError:
+                # Leave the job as 'running'; stop() or the lease expiring hands it to another worker.
+                raise
+            except Exception as e:
+                print(f"Job {job['id']} failed: {e}")
+                await self._db(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, owner = NULL, lease_until = NULL, "
+                    "pdf = X'' WHERE id = ? AND owner = ?",
+                    (str(e), time.time(), job["id"], self.owner),
+                )
+            finally:
+                lease.cancel()
+
+    async def _run_job(self, job):
+        rows = await self._db(
+            "SELECT category FROM job_categories WHERE job_id = ? AND (raw IS NOT NULL OR attempts >= ?)",
+            (job["id"], JOB_CATEGORY_ATTEMPTS), fetch="all"
+        )
+        done = {row["category"] for row in rows}
+        remaining = [name for name in categories_for(job["form_type"], job["category"]) if name not in done]
+        run = await ExtractionRun.open(None, job["form_type"], pdf_bytes=job["pdf"], pdf_sha256=job["pdf_sha256"],
+                                       previous_sha256=job["previous_sha256"])
+        async for category_name, raw_text in run.iter_categories(remaining):
+            details = run.status.get(category_name, {"status": "ok" if raw_text is not None else "error"})
+            await self._db(
+                "INSERT INTO job_categories (job_id, category, status, raw, details, attempts, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (job_id, category) DO UPDATE SET status = excluded.status, raw = excluded.raw, "
+                "details = excluded.details, attempts = job_categories.attempts + 1, updated_at = excluded.updated_at",
+                (job["id"], category_name, details["status"], raw_text, json.dumps(details), time.time()),
+            )
+        retryable = await self._db(
+            "SELECT COUNT(*) AS n FROM job_categories WHERE job_id = ? AND raw IS NULL AND attempts < ?",
+            (job["id"], JOB_CATEGORY_ATTEMPTS), fetch="one"
+        )
+        if retryable["n"]:
+            # Give quota or outages time to clear; other jobs run in the meantime.
+            await self._db(
+                "UPDATE jobs SET status = 'queued', retry_at = ?, owner = NULL, lease_until = NULL "
+                "WHERE id = ? AND owner = ?",
+                (time.time() + JOB_RETRY_DELAY_SECONDS, job["id"], self.owner),
+            )
+            return
+        succeeded = await self._db(
+            "SELECT COUNT(*) AS n FROM job_categories WHERE job_id = ? AND raw IS NOT NULL", (job["id"],), fetch="one"
+        )
+        status = "completed" if succeeded["n"] or not job["total_categories"] else "failed"
+        error = None if status == "completed" else "No category could be extracted"
+        # The PDF is only needed while the job runs; results stay until the job is purged.
+        await self._db(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ?, retry_at = NULL, owner = NULL, lease_until = NULL, "
+            "pdf = X'' WHERE id = ? AND owner = ?",
+            (status, error, time.time(), job["id"], self.owner),
+        )
+
+
+job_queue = JobQueue()
@@ -0,0 +1,240 @@
+import io
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+
+# Fill fields printed verbatim on the form from the PDF itself before asking the model.
+LOCAL_EXTRACTION = os.getenv("LOCAL_EXTRACTION", "1") == "1"
+# Part of the cache key, so results are re-extracted when the rules below change.
+LOCAL_EXTRACTION_VERSION = "2"
+LOCAL_EXTRACTION_CACHE_SIZE = int(os.getenv("LOCAL_EXTRACTION_CACHE_SIZE", "32"))
+# Fields outside the grids that are read locally: short values printed verbatim. Narrative
+# and judgement fields are always left to the model, however their labels look.
+LOCAL_FIELDS = frozenset({
+    "Property Address", "City", "State", "Zip Code", "County", "Assessor's Parcel #", "Tax Year", "Census Tract",
+    "FEMA Map #", "FEMA Map Date",
+})
+# Longer grid "fields" are questions or instructions that need the model's judgement.
+LOCAL_MAX_LABEL_CHARS = 60
+LOCAL_MAX_VALUE_CHARS = 200
+# Text fragments whose baselines are this close (in points) are on the same line.
+LINE_TOLERANCE = 2.0
+
+# Checkbox marks are not values on their own.
+_MARKS = {"x", "[x]", "[ ]", "☐", "☒", "☑", "✓", "✔"}
+
+
+def normalize(text):
+    return re.sub(r"\s+", " ", str(text)).strip().rstrip(":").strip().lower()
+
+
+def is_local_candidate(field_name):
+    """Grid rows with short labels only; questions and 'did did not' narratives are left to the model."""
+    return len(field_name) <= LOCAL_MAX_LABEL_CHARS and "?" not in field_name and "did did not" not in field_name.lower()
+
+
+class TextCell:
+    def __init__(self, x, y, text):
+        self.x = x
+        self.y = y
+        self.text = text
+        self.key = normalize(text)
+
+
+def page_lines(page):
+    """The page's text fragments grouped into lines (top to bottom), each sorted left to right."""
+    cells = []
+
+    def visit(text, cm, tm, font_dict, font_size):
+        text = text.strip()
+        if not text:
+            return
+        x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+        y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+        cells.append(TextCell(x, y, text))
+
+    page.extract_text(visitor_text=visit)
+    lines = []
+    for cell in sorted(cells, key=lambda cell: (-cell.y, cell.x)):
+        if lines and abs(lines[-1][0].y - cell.y) <= LINE_TOLERANCE:
+            lines[-1].append(cell)
+        else:
+            lines.append([cell])
+    return [sorted(line, key=lambda cell: cell.x) for line in lines]
+
+
+def _form_values(reader):
+    values = {}
+    try:
+        fields = reader.get_fields() or {}
+    except Exception as e:
+        print(f"Could not read PDF form fields: {e}")
+        return values
+    for name, field in fields.items():
+        value = field.get("/V")
+        if value is None:
+            continue
+        value = str(value).lstrip("/")
+        if not value.strip() or value == "Off":
+            continue
+        for label in (name, field.get("/TU")):
+            if label:
+                values.setdefault(normalize(label), value.strip())
+    return values
+
+
+class LocalExtraction:
+    """Field values read straight from a report's AcroForm and positioned text.
+
+    A value is only returned when it is unambiguous: form fields win; otherwise every
+    occurrence of the printed label must be followed by the same value on its line.
+    """
+
+    def __init__(self, form_values, page_lines, known_labels):
+        self.form_values = form_values
+        self.page_lines = page_lines  # [[[TextCell, ...], ...] per page]
+        self.known_labels = known_labels
+
+    def _is_value(self, cell):
+        return (
+            cell.key not in self.known_labels
+            and cell.key not in _MARKS
+            and len(cell.text) <= LOCAL_MAX_VALUE_CHARS
+        )
+
+    def _pages(self, pages):
+        numbers = range(len(self.page_lines)) if pages is None else pages
+        return [(number, self.page_lines[number]) for number in numbers if number < len(self.page_lines)]
+
+    def _value_run(self, line, start):
+        # A value split into several fragments runs up to the next label, mark or the end of the line.
+        parts = []
+        for cell in line[start:]:
+            if not self._is_value(cell):
+                break
+            parts.append(cell.text)
+        return " ".join(parts)
+
+    def _text_value(self, label, pages):
+        found = set()
+        for _, lines in self._pages(pages):
+            for line in lines:
+                for index, cell in enumerate(line):
+                    if cell.key == label:
+                        value = self._value_run(line, index + 1)
+                        if not value:
+                            return None
+                        found.add(value)
+                    elif cell.key.startswith(label + ":"):
+                        inline = cell.text.split(":", 1)[1].strip()
+                        found.add(" ".join(part for part in (inline, self._value_run(line, index + 1)) if part))
+        if len(found) != 1:
+            return None
+        value = found.pop()
+        if len(value) > LOCAL_MAX_VALUE_CHARS:
+            return None
+        return value or None
+
+    def resolve(self, fields, pages=None):
+        """{field: value} for the LOCAL_FIELDS that can be read confidently."""
+        resolved = {}
+        for field in fields:
+            if field not in LOCAL_FIELDS:
+                continue
+            label = normalize(field)
+            value = self.form_values.get(label)
+            if value is None:
+                value = self._text_value(label, pages)
+            if value:
+                resolved[field] = value
+        return resolved
+
+    def resolve_grid(self, column_label, fields, pages=None):
+        """Read the sales / rent grid: returns ({column: {field: value}}, fully resolved fields).
+
+        Columns are located by their 'Subject' / '<column_label> # N' headers. A comparable
+        cell with an '<field> Adjustment' companion is only read when the column holds exactly
+        a description and an adjustment; anything else is left to the model.
+        """
+        field_names = {normalize(field): field for field in fields if is_local_candidate(field)}
+        column_pattern = re.compile(rf"^{re.escape(normalize(column_label))}\s*#\s*(\d+)$")
+        grid = defaultdict(dict)
+        unresolved = set()
+        columns_seen = set()
+        for _, lines in self._pages(pages):
+            headers = []
+            for line in lines:
+                for cell in line:
+                    match = column_pattern.match(cell.key)
+                    if match:
+                        headers.append((cell.x, f"{column_label} #{match.group(1)}"))
+                    elif cell.key == "subject":
+                        headers.append((cell.x, "Subject"))
+            if not any(name != "Subject" for _, name in headers):
+                continue
+            headers = sorted(dict((name, x) for x, name in headers).items(), key=lambda item: item[1])
+            columns_seen.update(name for name, _ in headers)
+            for line in lines:
+                field = field_names.get(line[0].key)
+                if field is None or line[0].x >= headers[0][1]:
+                    continue
+                cells_by_column = defaultdict(list)
+                for cell in line[1:]:
+                    column = None
+                    for name, x in headers:
+                        if cell.x >= x - LINE_TOLERANCE:
+                            column = name
+                    if column is not None:
+                        cells_by_column[column].append(cell)
+                adjustment = f"{field} Adjustment"
+                for name, _ in headers:
+                    cells = cells_by_column.get(name, [])
+                    if not cells or not all(self._is_value(cell) for cell in cells):
+                        unresolved.add(field)
+                        continue
+                    if name == "Subject" or adjustment not in fields:
+                        if len(cells) == 1:
+                            grid[name][field] = cells[0].text
+                        else:
+                            unresolved.add(field)
+                    elif len(cells) == 2:
+                        grid[name][field] = cells[0].text
+                        grid[name][adjustment] = cells[1].text
+                    else:
+                        unresolved.update([field, adjustment])
+        resolved_fields = [
+            field for field in fields
+            if field not in unresolved and columns_seen and all(
+                field in grid[name] or (name == "Subject" and field.endswith(" Adjustment"))
+                for name in columns_seen
+            )
+        ]
+        return dict(grid), resolved_fields
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def extract_local_fields(pdf_bytes, pdf_sha256: str, known_labels):
+    """Return a LocalExtraction for the document, or None when it cannot be read."""
+    if not LOCAL_EXTRACTION:
+        return None
+    with _cache_lock:
+        if pdf_sha256 in _cache:
+            return _cache[pdf_sha256]
+    try:
+        import pypdf  # imported on first use to keep it out of cold starts
+
+        reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+        extraction = LocalExtraction(_form_values(reader), [page_lines(page) for page in reader.pages], known_labels)
+    except Exception as e:
+        print(f"Local pre-extraction unavailable, using the model for every field: {e}")
+        extraction = None
+    with _cache_lock:
+        _cache[pdf_sha256] = extraction
+        _cache.move_to_end(pdf_sha256)
+        while len(_cache) > LOCAL_EXTRACTION_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return extraction
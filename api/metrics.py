@@ -0,0 +1,256 @@
+import threading
+
+try:
+    from .extraction_cache import extraction_cache
+    from .prefetch import prefetcher
+    from .scheduler import model_scheduler
+    from .single_flight import extraction_flights
+    from .startup import startup_report
+except ImportError:
+    from extraction_cache import extraction_cache
+    from prefetch import prefetcher
+    from scheduler import model_scheduler
+    from single_flight import extraction_flights
+    from startup import startup_report
+
+# Model calls take seconds to minutes, so the buckets are wider than the client defaults.
+DURATION_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 90, 120, 180)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def mirror(self, total, **labels):
+        """Report a running total kept by another component (read by a collector)."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = max(total, self._values.get(key, 0))
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][index] += 1
+                    break
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry["counts"]):
+                    cumulative += count
+                    labels = _format_labels(self.label_names, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(entry['sum'])}")
+                lines.append(f"{self.name}_count{labels} {entry['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Minimal Prometheus text-format registry, so /metrics needs no client library."""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collect):
+        # `collect` is called on every scrape to refresh gauges that mirror other components' stats.
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        for collect in self._collectors:
+            collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+MODEL_CALL_SECONDS = registry.histogram(
+    "appraisutra_model_call_seconds", "Duration of one model call attempt.", ("form_type", "category", "outcome"))
+MODEL_CALLS_IN_FLIGHT = registry.gauge("appraisutra_model_calls_in_flight", "Model calls currently running.")
+MODEL_CALLS_QUEUED = registry.gauge("appraisutra_model_calls_queued", "Model calls waiting for a scheduler slot.")
+MODEL_CONCURRENCY_WINDOW = registry.gauge(
+    "appraisutra_model_concurrency_window", "Model calls allowed to run at once (adaptive AIMD window).")
+MODEL_CONCURRENCY_DECREASES = registry.counter(
+    "appraisutra_model_concurrency_decreases_total", "Times the concurrency window shrank, by reason.", ("reason",))
+MODEL_QUEUE_DEPTH = registry.gauge(
+    "appraisutra_model_queue_depth", "Model calls waiting for a scheduler slot, by priority class.", ("priority",))
+MODEL_QUEUE_WAIT_SECONDS = registry.counter(
+    "appraisutra_model_queue_wait_seconds_total", "Time model calls spent waiting for a slot, by priority class.",
+    ("priority",))
+MODEL_QUEUE_MAX_WAIT_SECONDS = registry.gauge(
+    "appraisutra_model_queue_max_wait_seconds", "Longest wait for a slot since start, by priority class.", ("priority",))
+MODEL_CALLS_SCHEDULED = registry.counter(
+    "appraisutra_model_calls_scheduled_total", "Model calls that got a slot and finished, by priority class.", ("priority",))
+MODEL_REQUEST_BYTES = registry.counter(
+    "appraisutra_model_request_bytes_total", "Bytes sent to the model.", ("form_type", "category"))
+MODEL_RESPONSE_BYTES = registry.counter(
+    "appraisutra_model_response_bytes_total", "Bytes of model response text.", ("form_type", "category"))
+MODEL_TOKENS = registry.counter(
+    "appraisutra_model_tokens_total", "Tokens reported in response usage metadata.", ("form_type", "category", "kind"))
+MODEL_RETRIES = registry.counter(
+    "appraisutra_model_retries_total", "Model call attempts beyond the first.", ("form_type", "category"))
+MODEL_HEDGES = registry.counter(
+    "appraisutra_model_hedges_total", "Duplicate requests sent because the first was slow to answer.", ("form_type", "category"))
+MODEL_CALL_FAILURES = registry.counter(
+    "appraisutra_model_call_failures_total", "Model calls that failed after every retry.", ("form_type", "category"))
+BLOCKED_RESPONSES = registry.counter(
+    "appraisutra_blocked_responses_total", "Responses blocked by the model's safety filters.", ("form_type", "category"))
+JSON_DECODE_FAILURES = registry.counter(
+    "appraisutra_json_decode_failures_total", "Responses that were not a JSON object.", ("form_type", "category"))
+JSON_REPAIRED = registry.counter(
+    "appraisutra_json_repaired_total", "Truncated JSON responses salvaged by the tolerant parser.", ("form_type", "category"))
+LOCAL_FIELDS = registry.counter(
+    "appraisutra_local_fields_total", "Fields read from the PDF itself instead of the model.", ("form_type", "category"))
+SHARD_CALLS = registry.counter(
+    "appraisutra_shard_calls_total", "Page-range calls made for documents too large to send whole.", ("form_type", "category"))
+SHARD_CONFLICTS = registry.counter(
+    "appraisutra_shard_conflicts_total", "Fields where page-range answers disagreed.", ("form_type", "category"))
+CACHE_LOOKUPS = registry.counter("appraisutra_extraction_cache_lookups_total", "Extraction cache lookups since start.", ("result",))
+CACHE_HIT_RATIO = registry.gauge("appraisutra_extraction_cache_hit_ratio", "Extraction cache hits / lookups.")
+CACHE_BYTES = registry.gauge("appraisutra_extraction_cache_bytes", "Bytes held in the in-memory extraction cache.")
+SINGLE_FLIGHT_CALLS = registry.counter(
+    "appraisutra_single_flight_calls_total", "Planned extraction calls started, joined by a duplicate request, or abandoned.",
+    ("result",))
+SINGLE_FLIGHT_IN_FLIGHT = registry.gauge("appraisutra_single_flight_in_flight", "Distinct extraction calls in flight.")
+PREFETCH_DOCUMENTS = registry.counter(
+    "appraisutra_prefetch_documents_total", "Documents whose remaining sections were scheduled, skipped at capacity, or completed.",
+    ("result",))
+PREFETCH_IN_FLIGHT = registry.gauge("appraisutra_prefetch_in_flight", "Background prefetch calls running.")
+STARTUP_SECONDS = registry.gauge(
+    "appraisutra_startup_phase_seconds", "Time spent in each module import and warm-up phase at startup.", ("phase",))
+
+
+def _collect_runtime():
+    cache = extraction_cache.stats()
+    CACHE_LOOKUPS.mirror(cache["hits"], result="hit")
+    CACHE_LOOKUPS.mirror(cache["misses"], result="miss")
+    CACHE_HIT_RATIO.set(cache["hit_rate"])
+    CACHE_BYTES.set(cache["bytes"])
+    scheduler = model_scheduler.stats()
+    MODEL_CALLS_IN_FLIGHT.set(scheduler["in_flight"])
+    MODEL_CALLS_QUEUED.set(scheduler["queued"])
+    MODEL_CONCURRENCY_WINDOW.set(scheduler["window"])
+    for reason, count in scheduler["window_decreases"].items():
+        MODEL_CONCURRENCY_DECREASES.mirror(count, reason=reason)
+    for priority, entry in scheduler["classes"].items():
+        MODEL_QUEUE_DEPTH.set(entry["queued"], priority=priority)
+        MODEL_QUEUE_WAIT_SECONDS.mirror(entry["wait_seconds"], priority=priority)
+        MODEL_QUEUE_MAX_WAIT_SECONDS.set(entry["max_wait_seconds"], priority=priority)
+        MODEL_CALLS_SCHEDULED.mirror(entry["completed"], priority=priority)
+    flights = extraction_flights.stats()
+    SINGLE_FLIGHT_IN_FLIGHT.set(flights["in_flight"])
+    for result in ("started", "joined", "abandoned"):
+        SINGLE_FLIGHT_CALLS.mirror(flights[result], result=result)
+    prefetch = prefetcher.stats()
+    PREFETCH_IN_FLIGHT.set(prefetch["in_flight"])
+    for result in ("scheduled", "skipped", "completed"):
+        PREFETCH_DOCUMENTS.mirror(prefetch[result], result=result)
+    for phase, seconds in list(startup_report.phases.items()):
+        STARTUP_SECONDS.set(seconds, phase=phase)
+
+
+registry.add_collector(_collect_runtime)
+
+
+def record_usage(response, form_type, category):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, attribute in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        count = getattr(usage, attribute, None)
+        if count:
+            MODEL_TOKENS.inc(count, form_type=form_type, category=category, kind=kind)
+
+
+def render_metrics() -> str:
+    return registry.render()
@@ -0,0 +1,456 @@
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.5-flash")
+# "inline" sends the PDF bytes with every prompt; "file" uploads it once per document and
+# references the uploaded file from every category prompt.
+DOCUMENT_CONTEXT_MODE = os.getenv("DOCUMENT_CONTEXT_MODE", "inline")
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini")
+# The File API keeps uploads for 48 hours; re-upload a little before that.
+UPLOADED_FILE_TTL_SECONDS = float(os.getenv("UPLOADED_FILE_TTL_SECONDS", str(47 * 60 * 60)))
+# Uploaded documents remembered (and kept in the File API) at once; older ones are deleted.
+UPLOADED_FILES_MAX = int(os.getenv("UPLOADED_FILES_MAX", "64"))
+# MODEL_BACKEND=simulated settings; see SimulatedBackend and parse_latency.
+SIMULATED_LATENCY = os.getenv("SIMULATED_LATENCY", "lognormal:1.5:0.4")
+SIMULATED_ERROR_RATE = float(os.getenv("SIMULATED_ERROR_RATE", "0"))
+SIMULATED_QUOTA_PER_MINUTE = int(os.getenv("SIMULATED_QUOTA_PER_MINUTE", "0"))
+SIMULATED_RESPONSES = os.getenv("SIMULATED_RESPONSES")  # JSON file: {"CATEGORY": {...fields...}}
+SIMULATED_SEED = os.getenv("SIMULATED_SEED")
+
+
+_genai_module = None
+_genai_lock = threading.Lock()
+
+
+def _genai():
+    """Import and configure google.generativeai on first use.
+
+    The SDK pulls in gRPC and protobuf and is the slowest import in the app, so requests
+    that never call the model (e.g. /health) never pay for it.
+    """
+    global _genai_module
+    if _genai_module is None:
+        with _genai_lock:
+            if _genai_module is None:
+                import google.generativeai as genai
+
+                # Securely configure the API key from an environment variable
+                genai.configure(api_key=GEMINI_API_KEY)
+                _genai_module = genai
+    return _genai_module
+
+
+def inline_pdf_part(pdf_bytes):
+    return {"mime_type": "application/pdf", "data": pdf_bytes}
+
+
+def request_bytes(contents) -> int:
+    """Approximate payload size of a generate call, for comparing context modes."""
+    total = 0
+    for part in contents:
+        if isinstance(part, str):
+            total += len(part.encode("utf-8"))
+        elif isinstance(part, dict) and "data" in part:
+            total += len(part["data"])
+        else:
+            # Uploaded file references only carry their URI.
+            total += len(str(getattr(part, "uri", "")) or "file-reference")
+    return total
+
+
+class UploadExpired(Exception):
+    """The uploaded copy of a document is gone (expired or deleted); upload it again."""
+
+
+class GeminiBackend:
+    name = "gemini"
+
+    def __init__(self, model_name=MODEL_NAME, context_mode=DOCUMENT_CONTEXT_MODE):
+        self.model_name = model_name
+        self.context_mode = context_mode
+        self._model = None
+        self._uploads = OrderedDict()  # pdf_sha256 -> (upload task, expires_at), least recently used first
+        self._rejected_schemas = set()  # fingerprints of response schemas the API refused
+
+    def model(self):
+        if self._model is None:
+            self._model = _genai().GenerativeModel(model_name=self.model_name)
+        return self._model
+
+    def warm_up(self):
+        # Creates the process-wide client ahead of the first request.
+        self.model()
+
+    async def document_part(self, pdf_bytes, pdf_sha256: str):
+        if self.context_mode != "file":
+            return inline_pdf_part(pdf_bytes)
+        upload = self._uploads.get(pdf_sha256)
+        if upload is not None and upload[1] < time.time():
+            self._forget_upload(pdf_sha256)
+            upload = None
+        if upload is None:
+            task = asyncio.ensure_future(asyncio.to_thread(self._upload, pdf_bytes, pdf_sha256))
+            upload = (task, time.time() + UPLOADED_FILE_TTL_SECONDS)
+            self._uploads[pdf_sha256] = upload
+            while len(self._uploads) > UPLOADED_FILES_MAX:
+                self._forget_upload(next(iter(self._uploads)))
+        self._uploads.move_to_end(pdf_sha256)
+        try:
+            return await asyncio.shield(upload[0])
+        except Exception as e:
+            # Fall back to inline bytes whenever the upload is unavailable.
+            print(f"Document upload failed, sending the PDF inline instead: {e}")
+            self._uploads.pop(pdf_sha256, None)
+            return inline_pdf_part(pdf_bytes)
+
+    def _forget_upload(self, pdf_sha256):
+        upload = self._uploads.pop(pdf_sha256, None)
+        if upload is None:
+            return
+        # Delete the remote copy too (once an upload in progress finishes); leftovers only count
+        # against the File API storage quota.
+        upload[0].add_done_callback(self._delete_uploaded)
+
+    def _delete_uploaded(self, task):
+        if not task.cancelled() and task.exception() is None:
+            asyncio.get_running_loop().run_in_executor(None, self._delete, task.result().name)
+
+    def _delete(self, name):
+        try:
+            _genai().delete_file(name)
+        except Exception as e:
+            print(f"Could not delete uploaded file {name}: {e}")
+
+    def _forget_file(self, name):
+        for pdf_sha256, (task, _) in list(self._uploads.items()):
+            if task.done() and not task.cancelled() and task.exception() is None and task.result().name == name:
+                self._forget_upload(pdf_sha256)
+
+    def _upload(self, pdf_bytes, pdf_sha256):
+        uploaded = _genai().upload_file(io.BytesIO(pdf_bytes), mime_type="application/pdf", display_name=pdf_sha256[:16])
+        deadline = time.time() + 60
+        while uploaded.state.name == "PROCESSING" and time.time() < deadline:
+            time.sleep(1)
+            uploaded = _genai().get_file(uploaded.name)
+        if uploaded.state.name != "ACTIVE":
+            raise RuntimeError(f"Uploaded file {uploaded.name} is {uploaded.state.name}")
+        return uploaded
+
+    async def generate(self, contents, generation_config=None):
+        schema = (generation_config or {}).get("response_schema")
+        fingerprint = _schema_fingerprint(schema) if schema is not None else None
+        if fingerprint in self._rejected_schemas:
+            generation_config = {k: v for k, v in generation_config.items() if k != "response_schema"}
+        try:
+            return await self.model().generate_content_async(contents=contents, generation_config=generation_config)
+        except Exception as e:
+            stale = next((part.name for part in contents if _is_uploaded_file(part)), None)
+            if stale is not None and _is_missing_file_error(e):
+                self._forget_file(stale)
+                raise UploadExpired(f"uploaded file {stale} is no longer available: {e}") from e
+            if fingerprint is None or fingerprint in self._rejected_schemas or not _is_schema_error(e):
+                raise
+            # Keep JSON mode but stop sending this schema; other requests keep theirs.
+            print(f"Response schema rejected, continuing without it: {e}")
+            self._rejected_schemas.add(fingerprint)
+            return await self.generate(contents, generation_config)
+
+
+class LocalFileReference:
+    def __init__(self, pdf_sha256, size):
+        self.uri = f"local://documents/{pdf_sha256}"
+        self.size = size
+
+
+class LocalUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class LocalResponse:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+_CATEGORY_PATTERN = re.compile(r"Fields for ([A-Z0-9_]+):")
+
+
+def prompt_categories(prompt):
+    categories = _CATEGORY_PATTERN.findall(prompt)
+    if categories:
+        return categories
+    if "COMPARABLE RENT SCHEDULE" in prompt:
+        return ["RENT_SCHEDULE_GRID"]
+    if "SALES COMPARISON APPROACH" in prompt:
+        return ["SALES_GRID"]
+    return []
+
+
+def sample_value(schema, key="", optional_columns=3):
+    """A plausible answer matching a response schema: every required key (plus the first
+    few optional ones, e.g. comparable columns) with a non-empty value."""
+    if schema.get("type") == "OBJECT":
+        properties = schema.get("properties", {})
+        required = set(schema.get("required", properties))
+        optional = [name for name in properties if name not in required][:optional_columns]
+        return {name: sample_value(value, name) for name, value in properties.items() if name in required or name in optional}
+    if schema.get("enum"):
+        return schema["enum"][0]
+    return f"Sample {key}".strip()
+
+
+def sample_response(contents, generation_config=None):
+    """Keyed JSON for the fields a request asks for, so offline runs parse and split like real answers."""
+    schema = (generation_config or {}).get("response_schema")
+    if schema is not None:
+        return json.dumps(sample_value(schema))
+    prompt = next((part for part in contents if isinstance(part, str)), "")
+    categories = prompt_categories(prompt)
+    if len(categories) > 1:
+        return json.dumps({category: {} for category in categories})
+    return "{}"
+
+
+class LocalBackend:
+    """Offline stand-in for GeminiBackend.
+
+    Latency is modelled as a fixed cost plus transfer time for the request payload, so the
+    bytes and time saved by the "file" context mode can be measured without model quota.
+    Answers are sample values for the requested fields unless `response_text` is given.
+    """
+
+    name = "local"
+
+    def __init__(self, context_mode=DOCUMENT_CONTEXT_MODE, base_latency=0.05, bytes_per_second=20 * 1024 * 1024,
+                 response_text=None):
+        self.context_mode = context_mode
+        self.base_latency = base_latency
+        self.bytes_per_second = bytes_per_second
+        self.response_text = response_text
+        self._uploads = {}
+        self.reset_stats()
+
+    def warm_up(self):
+        pass
+
+    def reset_stats(self):
+        self.calls = 0
+        self.request_bytes = 0
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.simulated_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "context_mode": self.context_mode,
+            "calls": self.calls,
+            "request_bytes": self.request_bytes,
+            "uploads": self.uploads,
+            "upload_bytes": self.upload_bytes,
+            "simulated_seconds": round(self.simulated_seconds, 4),
+        }
+
+    async def _transfer(self, size):
+        delay = self.base_latency + size / self.bytes_per_second
+        self.simulated_seconds += delay
+        await asyncio.sleep(delay)
+
+    async def document_part(self, pdf_bytes, pdf_sha256: str):
+        if self.context_mode != "file":
+            return inline_pdf_part(pdf_bytes)
+        if pdf_sha256 not in self._uploads:
+            self._uploads[pdf_sha256] = LocalFileReference(pdf_sha256, len(pdf_bytes))
+            self.uploads += 1
+            self.upload_bytes += len(pdf_bytes)
+            await self._transfer(len(pdf_bytes))
+        return self._uploads[pdf_sha256]
+
+    async def generate(self, contents, generation_config=None):
+        size = request_bytes(contents)
+        self.calls += 1
+        self.request_bytes += size
+        await self._transfer(size)
+        if self.response_text is not None:
+            return LocalResponse(self.response_text)
+        return LocalResponse(sample_response(contents, generation_config))
+
+
+def parse_latency(spec: str):
+    """Turn a latency spec into a function of a random.Random returning seconds.
+
+    Specs: "fixed:S", "uniform:LOW:HIGH", "normal:MEAN:STDDEV", "lognormal:MEDIAN:SIGMA",
+    "exponential:MEAN". Values are clamped at zero.
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(":") if value]
+    try:
+        if kind == "fixed":
+            (seconds,) = values
+            return lambda rng: seconds
+        if kind == "uniform":
+            low, high = values
+            return lambda rng: rng.uniform(low, high)
+        if kind == "normal":
+            mean, stddev = values
+            return lambda rng: max(0.0, rng.gauss(mean, stddev))
+        if kind == "lognormal":
+            median, sigma = values
+            return lambda rng: rng.lognormvariate(math.log(median), sigma)
+        if kind == "exponential":
+            (mean,) = values
+            return lambda rng: rng.expovariate(1 / mean)
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid latency spec {spec!r}")
+
+
+def _is_invalid_argument(exc):
+    try:
+        from google.api_core import exceptions as google_exceptions
+    except ImportError:
+        return False
+    return isinstance(exc, google_exceptions.InvalidArgument)
+
+
+def _is_schema_error(exc):
+    # Oversized payloads, unreadable PDFs and stale file references are InvalidArgument too.
+    return _is_invalid_argument(exc) and re.search(r"schema|enum|properties", str(exc), re.IGNORECASE) is not None
+
+
+def _is_uploaded_file(part):
+    return str(getattr(part, "name", "")).startswith("files/")
+
+
+def _is_missing_file_error(exc):
+    try:
+        from google.api_core import exceptions as google_exceptions
+    except ImportError:
+        return False
+    if isinstance(exc, (google_exceptions.NotFound, google_exceptions.PermissionDenied)):
+        return True
+    return isinstance(exc, (google_exceptions.InvalidArgument, google_exceptions.FailedPrecondition)) and re.search(
+        r"\bfiles?\b", str(exc), re.IGNORECASE) is not None
+
+
+def _schema_fingerprint(schema):
+    return json.dumps(schema, sort_keys=True)
+
+
+def _quota_error(message):
+    try:
+        from google.api_core import exceptions as google_exceptions
+    except ImportError:
+        return RuntimeError(f"429 {message}")
+    return google_exceptions.ResourceExhausted(message)
+
+
+class SimulatedBackend(LocalBackend):
+    """LocalBackend with realistic model behaviour for load tests.
+
+    Each call sleeps for a sample from `latency` plus transfer time, may fail with a 429
+    (randomly at `error_rate`, or once more than `quota_per_minute` calls were made in the
+    last minute) and answers with canned JSON for the categories named in the prompt.
+    """
+
+    name = "simulated"
+
+    def __init__(self, latency=SIMULATED_LATENCY, error_rate=SIMULATED_ERROR_RATE,
+                 quota_per_minute=SIMULATED_QUOTA_PER_MINUTE, responses=None, seed=SIMULATED_SEED,
+                 context_mode=DOCUMENT_CONTEXT_MODE, bytes_per_second=20 * 1024 * 1024):
+        super().__init__(context_mode=context_mode, base_latency=0.0, bytes_per_second=bytes_per_second)
+        self.latency_spec = latency
+        self.sample_latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self.error_rate = error_rate
+        self.quota_per_minute = quota_per_minute
+        self.responses = responses or {}
+        self.rng = random.Random(seed)
+        self._recent_calls = deque()
+
+    @classmethod
+    def from_env(cls):
+        responses = None
+        if SIMULATED_RESPONSES:
+            with open(SIMULATED_RESPONSES, "r", encoding="utf-8") as f:
+                responses = json.load(f)
+        return cls(responses=responses)
+
+    def reset_stats(self):
+        super().reset_stats()
+        self.quota_errors = 0
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats.update({"latency": self.latency_spec, "quota_errors": self.quota_errors})
+        return stats
+
+    def canned_response(self, contents, generation_config=None):
+        prompt = next((part for part in contents if isinstance(part, str)), "")
+        categories = prompt_categories(prompt)
+        if not any(category in self.responses for category in categories):
+            return sample_response(contents, generation_config)
+        if len(categories) == 1:
+            return json.dumps(self.responses.get(categories[0], {}))
+        return json.dumps({category: self.responses.get(category, {}) for category in categories})
+
+    def _over_quota(self):
+        if not self.quota_per_minute:
+            return False
+        now = time.monotonic()
+        while self._recent_calls and now - self._recent_calls[0] > 60:
+            self._recent_calls.popleft()
+        if len(self._recent_calls) >= self.quota_per_minute:
+            return True
+        self._recent_calls.append(now)
+        return False
+
+    async def generate(self, contents, generation_config=None):
+        size = request_bytes(contents)
+        self.calls += 1
+        self.request_bytes += size
+        if self._over_quota() or (self.error_rate and self.rng.random() < self.error_rate):
+            self.quota_errors += 1
+            # Rejections come back quickly, without the model's processing time.
+            await asyncio.sleep(min(0.05, self.sample_latency(self.rng)))
+            error = _quota_error("Simulated quota exceeded")
+            if self._recent_calls and len(self._recent_calls) >= self.quota_per_minute:
+                # Like the real service, say when the quota window has room again.
+                error.retry_after = max(0.0, 60 - (time.monotonic() - self._recent_calls[0]))
+            raise error
+        delay = self.sample_latency(self.rng) + size / self.bytes_per_second
+        self.simulated_seconds += delay
+        await asyncio.sleep(delay)
+        text = self.canned_response(contents, generation_config)
+        # Rough token counts (about four bytes per token) so usage metrics have data offline.
+        return LocalResponse(text, LocalUsage(size // 4, len(text) // 4))
+
+
+_backend = None
+
+
+def get_model_backend():
+    global _backend
+    if _backend is None:
+        if MODEL_BACKEND == "local":
+            _backend = LocalBackend()
+        elif MODEL_BACKEND == "simulated":
+            _backend = SimulatedBackend.from_env()
+        else:
+            _backend = GeminiBackend()
+    return _backend
+
+
+def set_model_backend(backend):
+    global _backend
+    _backend = backend
@@ -0,0 +1,209 @@
+import hashlib
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+
+
+PAGE_ROUTING = os.getenv("PAGE_ROUTING", "1") == "1"
+# Sending more than this share of the document gains little; use the full PDF instead.
+PAGE_ROUTING_MAX_SHARE = float(os.getenv("PAGE_ROUTING_MAX_SHARE", "0.5"))
+PAGE_INDEX_CACHE_SIZE = int(os.getenv("PAGE_INDEX_CACHE_SIZE", "32"))
+# Page subsets are whole PDFs (shards of large reports are several MB each), so they are also bounded by size.
+PAGE_SUBSET_CACHE_BYTES = int(os.getenv("PAGE_SUBSET_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Section headings / labels printed on the standard forms, matched case-insensitively
+# against each page's text layer.
+CATEGORY_PAGE_MARKERS = {
+    "SUBJECT": ["the purpose of this summary appraisal report", "owner of public record", "assessor's parcel #"],
+    "CONTRACT": ["contract price", "date of contract"],
+    "NEIGHBORHOOD": ["neighborhood characteristics", "neighborhood boundaries"],
+    "SITE": ["specific zoning classification", "fema special flood hazard area"],
+    "IMPROVEMENTS": ["finished area above grade contains", "foundation walls"],
+    "SALES_GRID": ["sales comparison approach", "comparable sale #"],
+    "SALES_TRANSFER": ["sale or transfer history", "prior sale/transfer"],
+    "RECONCILIATION": ["indicated value by: sales comparison approach", "this appraisal is made"],
+    "COST_APPROACH": ["cost approach to value", "opinion of site value"],
+    "INCOME_APPROACH": ["income approach to value", "gross rent multiplier"],
+    "PUD_INFO": ["project information for puds"],
+    "MARKET_CONDITIONS": ["market conditions addendum"],
+    "CONDO": ["condo/co-op projects", "subject project data"],
+    "CERTIFICATION": ["appraiser's certification", "supervisory appraiser"],
+    "ADDENDUM": ["supplemental addendum", "additional comments", "uad definitions"],
+    "UNIFORM_REPORT": ["scope of work", "definition of market value", "statement of assumptions and limiting conditions"],
+    "APPRAISAL_ID": ["appraisal and report identification"],
+    "RENT_SCHEDULE_GRID": ["comparable rent schedule", "comparable rental #"],
+    "RENT_SCHEDULE_RECONCILIATION": ["final reconciliation of market rent", "estimate the monthly market rent"],
+    "PROJECT_SITE": ["project site", "topography"],
+    "PROJECT_INFO": ["project information", "data source(s) for project information"],
+    "PROJECT_ANALYSIS": ["project analysis", "condominium project budget"],
+    "UNIT_DESCRIPTIONS": ["unit descriptions", "unit charge"],
+    "PRIOR_SALE_HISTORY": ["sale or transfer history", "prior sale/transfer"],
+}
+
+# Page offsets from the first page of the form, used when a category's headings cannot be
+# found in the text layer (e.g. a label printed as an image).
+FORM_TITLE_MARKERS = {
+    "1004": "uniform residential appraisal report",
+    "1007": "uniform residential appraisal report",
+    "1073": "individual condominium unit appraisal report",
+}
+FORM_LAYOUTS = {
+    "1004": {
+        "SUBJECT": [0], "CONTRACT": [0], "NEIGHBORHOOD": [0], "SITE": [0], "IMPROVEMENTS": [0],
+        "SALES_GRID": [1], "SALES_TRANSFER": [1], "RECONCILIATION": [1],
+        "COST_APPROACH": [2], "INCOME_APPROACH": [2], "PUD_INFO": [2],
+        "UNIFORM_REPORT": [3, 4], "CERTIFICATION": [4, 5],
+    },
+    "1073": {
+        "SUBJECT": [0], "CONTRACT": [0], "NEIGHBORHOOD": [0], "PROJECT_SITE": [0], "PROJECT_INFO": [0, 1],
+        "PROJECT_ANALYSIS": [1], "UNIT_DESCRIPTIONS": [1],
+        "PRIOR_SALE_HISTORY": [2], "SALES_GRID": [2], "SALES_TRANSFER": [2],
+        "RECONCILIATION": [3], "COST_APPROACH": [3], "INCOME_APPROACH": [3],
+        "UNIFORM_REPORT": [4, 5], "CERTIFICATION": [5],
+    },
+}
+FORM_LAYOUTS["1007"] = FORM_LAYOUTS["1004"]
+
+# Categories that look across photos, maps and sketches always get the whole report.
+FULL_DOCUMENT_CATEGORIES = {"IMAGE_ANALYSIS", "DATA_CONSISTENCY"}
+
+ROUTING_VERSION = hashlib.sha256(
+    repr((sorted(CATEGORY_PAGE_MARKERS.items()), sorted(FORM_LAYOUTS.items()), PAGE_ROUTING_MAX_SHARE)).encode("utf-8")
+).hexdigest()[:8]
+
+
+class PageIndex:
+    """Text-layer index of a PDF, mapping categories to the pages that contain them."""
+
+    def __init__(self, page_texts, page_hashes=None):
+        self.page_texts = page_texts
+        self.page_count = len(page_texts)
+        # Content hash per page, used to tell which pages a revised report changed.
+        self.page_hashes = page_hashes
+
+    @property
+    def has_text(self):
+        return any(text.strip() for text in self.page_texts)
+
+    def find(self, markers):
+        return [number for number, text in enumerate(self.page_texts) if any(marker in text for marker in markers)]
+
+    def pages_for(self, category_name, form_type):
+        """Page numbers (0-based) to send for a category, or None for the full document."""
+        if category_name in FULL_DOCUMENT_CATEGORIES or not self.has_text:
+            return None
+        pages = set(self.find(CATEGORY_PAGE_MARKERS.get(category_name, [])))
+        if not pages:
+            layout = FORM_LAYOUTS.get(form_type, {}).get(category_name)
+            title_pages = self.find([FORM_TITLE_MARKERS[form_type]]) if form_type in FORM_TITLE_MARKERS else []
+            if layout and title_pages:
+                pages = {title_pages[0] + offset for offset in layout if title_pages[0] + offset < self.page_count}
+        if not pages or len(pages) > self.page_count * PAGE_ROUTING_MAX_SHARE:
+            return None
+        return sorted(pages)
+
+    def source_fingerprint(self, category_name, form_type):
+        """Hash of the pages a category is extracted from, or None without page hashes.
+
+        Two versions of a report with equal fingerprints for a category give the same
+        answer for it, even if the pages moved.
+        """
+        if not self.page_hashes:
+            return None
+        pages = self.pages_for(category_name, form_type)
+        selected = self.page_hashes if pages is None else [self.page_hashes[number] for number in pages]
+        return hashlib.sha256("".join(selected).encode("utf-8")).hexdigest()
+
+
+def page_content_hash(page, text):
+    """Hash of a page's drawing commands, images and text layer."""
+    hasher = hashlib.sha256(text.encode("utf-8"))
+    try:
+        contents = page.get_contents()
+        if contents is not None:
+            hasher.update(contents.get_data())
+        resources = page.get("/Resources")
+        xobjects = resources.get_object().get("/XObject") if resources is not None else None
+        if xobjects is not None:
+            for name, xobject in sorted(xobjects.get_object().items()):
+                hasher.update(name.encode("utf-8"))
+                hasher.update(getattr(xobject.get_object(), "_data", b"") or b"")
+    except Exception as e:
+        # Malformed streams still leave the text layer in the hash.
+        print(f"Could not hash page content, using its text only: {e}")
+    return hasher.hexdigest()
+
+
+_index_cache = OrderedDict()
+_subset_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _remember(cache, key, value, max_bytes=None):
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > PAGE_INDEX_CACHE_SIZE:
+            cache.popitem(last=False)
+        if max_bytes is not None:
+            total = sum(len(item or b"") for item in cache.values())
+            while cache and total > max_bytes:
+                _, evicted = cache.popitem(last=False)
+                total -= len(evicted or b"")
+
+
+def _pypdf():
+    # Imported on first use to keep it out of cold starts.
+    try:
+        import pypdf
+    except ImportError:  # routing is skipped without pypdf
+        return None
+    return pypdf
+
+
+def build_page_index(pdf_bytes, pdf_sha256: str):
+    """Return a PageIndex for the document, or None when routing is unavailable."""
+    pypdf = _pypdf() if PAGE_ROUTING else None
+    if pypdf is None:
+        return None
+    with _cache_lock:
+        if pdf_sha256 in _index_cache:
+            return _index_cache[pdf_sha256]
+    try:
+        reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+        page_texts = []
+        page_hashes = []
+        for page in reader.pages:
+            text = re.sub(r"\s+", " ", page.extract_text() or "").lower()
+            page_texts.append(text)
+            page_hashes.append(page_content_hash(page, text))
+        index = PageIndex(page_texts, page_hashes)
+    except Exception as e:
+        print(f"Could not index PDF pages, sending full documents: {e}")
+        index = None
+    _remember(_index_cache, pdf_sha256, index)
+    return index
+
+
+def extract_pages(pdf_bytes, pdf_sha256: str, pages):
+    """Return a new PDF containing only `pages`, or None if it cannot be built."""
+    key = (pdf_sha256, tuple(pages))
+    with _cache_lock:
+        if key in _subset_cache:
+            return _subset_cache[key]
+    try:
+        pypdf = _pypdf()
+        reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+        writer = pypdf.PdfWriter()
+        for number in pages:
+            writer.add_page(reader.pages[number])
+        output = io.BytesIO()
+        writer.write(output)
+        subset = output.getvalue()
+    except Exception as e:
+        print(f"Could not extract pages {pages}, sending the full document: {e}")
+        subset = None
+    _remember(_subset_cache, key, subset, max_bytes=PAGE_SUBSET_CACHE_BYTES)
+    return subset
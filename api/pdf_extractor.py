@@ -1,11 +1,70 @@
-import google.generativeai as genai
-import tempfile
+import asyncio
+import contextvars
+import functools
 import json
-import os
+import re
+import time
 
-# Securely configure the API key from an environment variable
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
+try:
+    from .category_planner import build_batch_prompt, plan_category_batches, split_batch_response
+    from .document_shards import INLINE_MAX_BYTES, SHARD_VERSION, DocumentTooLarge, merge_shard_answers, plan_shards
+    from .field_registry import FREE_FORM_CATEGORIES, FieldRegistry
+    from .extraction_cache import extraction_cache, hash_pdf_bytes, make_cache_key, prompt_version
+    from .local_extractor import LOCAL_EXTRACTION, LOCAL_EXTRACTION_VERSION, extract_local_fields, normalize
+    from .metrics import (
+        BLOCKED_RESPONSES,
+        JSON_DECODE_FAILURES,
+        JSON_REPAIRED,
+        LOCAL_FIELDS,
+        MODEL_CALL_FAILURES,
+        MODEL_CALL_SECONDS,
+        MODEL_HEDGES,
+        MODEL_REQUEST_BYTES,
+        MODEL_RESPONSE_BYTES,
+        MODEL_RETRIES,
+        SHARD_CALLS,
+        SHARD_CONFLICTS,
+        record_usage,
+    )
+    from .model_backend import UploadExpired, get_model_backend, inline_pdf_part, request_bytes
+    from .photo_hashing import PHOTO_HASH_VERSION, PHOTO_HASHING, analyze_photos
+    from .prefetch import prefetcher
+    from .page_router import FULL_DOCUMENT_CATEGORIES, ROUTING_VERSION, build_page_index, extract_pages
+    from .response_schema import batch_schema, category_schema, generation_config, grid_schema, parse_json_object
+    from .resilience import ModelCallFailed, call_with_retries, hedged, is_quota_error, with_deadline
+    from .scheduler import BACKGROUND, INTERACTIVE, PRIORITIES, STANDARD, model_scheduler
+    from .single_flight import extraction_flights
+    from .startup import startup_report
+except ImportError:
+    from category_planner import build_batch_prompt, plan_category_batches, split_batch_response
+    from document_shards import INLINE_MAX_BYTES, SHARD_VERSION, DocumentTooLarge, merge_shard_answers, plan_shards
+    from field_registry import FREE_FORM_CATEGORIES, FieldRegistry
+    from extraction_cache import extraction_cache, hash_pdf_bytes, make_cache_key, prompt_version
+    from local_extractor import LOCAL_EXTRACTION, LOCAL_EXTRACTION_VERSION, extract_local_fields, normalize
+    from metrics import (
+        BLOCKED_RESPONSES,
+        JSON_DECODE_FAILURES,
+        JSON_REPAIRED,
+        LOCAL_FIELDS,
+        MODEL_CALL_FAILURES,
+        MODEL_CALL_SECONDS,
+        MODEL_HEDGES,
+        MODEL_REQUEST_BYTES,
+        MODEL_RESPONSE_BYTES,
+        MODEL_RETRIES,
+        SHARD_CALLS,
+        SHARD_CONFLICTS,
+        record_usage,
+    )
+    from model_backend import UploadExpired, get_model_backend, inline_pdf_part, request_bytes
+    from photo_hashing import PHOTO_HASH_VERSION, PHOTO_HASHING, analyze_photos
+    from prefetch import prefetcher
+    from page_router import FULL_DOCUMENT_CATEGORIES, ROUTING_VERSION, build_page_index, extract_pages
+    from response_schema import batch_schema, category_schema, generation_config, grid_schema, parse_json_object
+    from resilience import ModelCallFailed, call_with_retries, hedged, is_quota_error, with_deadline
+    from scheduler import BACKGROUND, INTERACTIVE, PRIORITIES, STANDARD, model_scheduler
+    from single_flight import extraction_flights
+    from startup import startup_report
 
 #{{1004}}
 
@@ -481,161 +540,902 @@ DEFAULT_CATEGORIES = [
 ]
 
 
-async def extract_fields_from_pdf(pdf_path, form_type: str, category: str = None, custom_prompt: str = None):
-    from google.api_core import exceptions as google_exceptions
-    combined_result = {}
-    raw_responses = []
+FIELD_CATEGORIES = {
+    "SUBJECT": SUBJECT_FIELDS, "CONTRACT": CONTRACT_FIELDS, "NEIGHBORHOOD": NEIGHBORHOOD_FIELDS,
+    "SITE": SITE_FIELDS, "IMPROVEMENTS": IMPROVEMENTS_FIELDS, "RECONCILIATION": RECONCILIATION_FIELDS,
+    "COST_APPROACH": COST_APPROACH_FIELDS, "INCOME_APPROACH": INCOME_APPROACH_FIELDS,
+    "RENT_SCHEDULE_RECONCILIATION": RENT_SCHEDULE_RECONCILIATION_FIELDS, "PUD_INFO": PUD_INFO_FIELDS,
+    "CERTIFICATION": CERTIFICATION_FIELDS, "ADDENDUM": ADDENDUM_FIELDS, "SALES_TRANSFER": SALES_TRANSFER_FIELDS,
+    "UNIFORM_REPORT": UNIFORM_REPORT_FIELDS, "APPRAISAL_ID": APPRAISAL_ID_FIELDS, "MARKET_CONDITIONS": MARKET_CONDITIONS_FIELDS,
+    "CONDO": CONDO_FIELDS, "IMAGE_ANALYSIS": IMAGE_FIELDS,
+    "PRIOR_SALE_HISTORY": PRIOR_SALE_HISTORY_FIELDS, "PROJECT_SITE": Project_SITE_FIELDS, "PROJECT_INFO": Project_Info_FIELDS,
+    "PROJECT_ANALYSIS": Project_Analysis_FIELDS, "UNIT_DESCRIPTIONS": UNIT_DESCRIPTIONS_FIELDS,
+    "DATA_CONSISTENCY": DATA_CONSISTENCY_FIELDS
+}
+
+GRID_CATEGORIES = ["SALES_GRID", "RENT_SCHEDULE_GRID"]
+
+field_registry = FieldRegistry(FIELD_CATEGORIES)
+# Field lists as they appear in prompts (the compact ID legend where enabled).
+PROMPT_FIELD_LISTS = {
+    category_name: field_registry.prompt_fields(category_name, fields)
+    for category_name, fields in FIELD_CATEGORIES.items()
+}
+# Structured-output schemas; free-form categories only ask for a JSON object.
+RESPONSE_SCHEMAS = {
+    category_name: category_schema(field_registry.response_keys(category_name, fields))
+    for category_name, fields in FIELD_CATEGORIES.items()
+    if category_name not in FREE_FORM_CATEGORIES
+}
+
+COMPLEX_FIELD_INSTRUCTIONS = (
+    "For fields containing 'did did not', the value should be a JSON object like {'choice': 'did' or 'did not', 'comment': 'extracted text'}. "
+    "For Yes/No questions, if the answer is 'Yes' and there is associated text, the value should be a JSON object like {'choice': 'Yes', 'comment': 'extracted text'}. "
+    "If the answer is just 'Yes' or 'No' without other text, the value should be the string 'Yes' or 'No'. "
+    "If a checkbox is marked, treat it as 'Yes'. "
+    "If the report does not answer the question, the choice should be ''."
+)
+
+BASE_PROMPT = (
+    "Extract the following fields from the appraisal report. "
+    "Return your answer strictly as a JSON object with this structure: { 'FieldName': 'Value', ... } "
+    "If a field is missing, set its value to ''. Do not include any explanation or formatting outside the JSON object. "
+)
+
+SALES_GRID_INSTRUCTIONS = (
+    "Extract the following fields for the Subject and each Comparable Sale from the SALES COMPARISON APPROACH section of the appraisal report. "
+    "Return your answer strictly as a JSON object with this structure: { 'Subject': {SalesGridFIELDS2}, 'COMPARABLE SALE #1': {SalesGridFIELDS2}, ... } "
+    "If a field is missing, set its value to ''. Do not include any explanation or formatting outside the JSON object. "
+)
+SALES_GRID_PROMPT = f"{SALES_GRID_INSTRUCTIONS}Fields: {SalesGridFIELDS2}. "
+
+RENT_SCHEDULE_INSTRUCTIONS = (
+    "Extract the following fields for the Subject and each Comparable Rent from the COMPARABLE RENT SCHEDULE section of the appraisal report. "
+    "Return your answer strictly as a JSON object with this structure: { 'Subject': {RentSchedulesFIELDS2}, 'COMPARABLE RENT #1': {RentSchedulesFIELDS2}, ... } "
+    "If a field is missing, set its value to ''. Do not include any explanation or formatting outside the JSON object. "
+)
+RENT_SCHEDULE_PROMPT = f"{RENT_SCHEDULE_INSTRUCTIONS}Fields: {RentSchedulesFIELDS2}. "
+
+# category -> (column label, row fields, instructions) for the comparable grids.
+GRID_LAYOUTS = {
+    "SALES_GRID": ("COMPARABLE SALE", SalesGridFIELDS2, SALES_GRID_INSTRUCTIONS),
+    "RENT_SCHEDULE_GRID": ("COMPARABLE RENT", RentSchedulesFIELDS2, RENT_SCHEDULE_INSTRUCTIONS),
+}
+
+
+# Every printed label, so local extraction never mistakes a neighbouring label for a value.
+KNOWN_LABELS = frozenset(
+    normalize(field)
+    for fields in list(FIELD_CATEGORIES.values()) + [layout[1] for layout in GRID_LAYOUTS.values()]
+    for field in fields
+)
+RESPONSE_SCHEMAS.update({
+    category_name: grid_schema(column_label, fields) for category_name, (column_label, fields, _) in GRID_LAYOUTS.items()
+})
+
+
+def response_generation_config(categories):
+    """JSON output config for a call; custom prompts (unknown categories) get none."""
+    if any(name not in FIELD_CATEGORIES and name not in GRID_CATEGORIES for name in categories):
+        return None
+    if len(categories) == 1:
+        return generation_config(RESPONSE_SCHEMAS.get(categories[0]))
+    if all(name in RESPONSE_SCHEMAS for name in categories):
+        return generation_config(batch_schema({name: RESPONSE_SCHEMAS[name] for name in categories}))
+    return generation_config()
+
+
+def build_custom_prompt(custom_prompt: str):
+    return (
+        f"Extract information from the appraisal report based on the following request: '{custom_prompt}'. "
+        "Return your answer strictly as a JSON object. "
+        "If the information is not found, return an empty JSON object or indicate that in the JSON values. "
+        "Do not include any explanation or formatting outside the JSON object."
+    )
 
+
+def build_fields_prompt(category_name: str, fields):
+    """Prompt asking for `fields` of a category (all of them, or those left after local extraction)."""
+    if category_name in GRID_LAYOUTS:
+        return f"{GRID_LAYOUTS[category_name][2]}Fields: {fields}. "
+    if field_registry.is_compact(category_name):
+        return (
+            f"{BASE_PROMPT}{field_registry.instructions}{COMPLEX_FIELD_INSTRUCTIONS} "
+            f"Fields for {category_name}: {field_registry.prompt_fields(category_name, fields)}."
+        )
+    return f"{BASE_PROMPT}{COMPLEX_FIELD_INSTRUCTIONS} Fields for {category_name}: {fields}."
+
+
+def response_schema_for(category_name: str, fields):
+    if category_name in GRID_LAYOUTS:
+        return grid_schema(GRID_LAYOUTS[category_name][0], fields)
+    if category_name in FREE_FORM_CATEGORIES:
+        return None
+    return category_schema(field_registry.response_keys(category_name, fields))
+
+
+@functools.lru_cache(maxsize=None)
+def build_category_prompt(category_name: str):
+    if category_name == "SALES_GRID":
+        return SALES_GRID_PROMPT
+    if category_name == "RENT_SCHEDULE_GRID":
+        return RENT_SCHEDULE_PROMPT
+    fields_list = FIELD_CATEGORIES.get(category_name)
+    if fields_list is None:
+        return None
+    return build_fields_prompt(category_name, fields_list)
+
+
+@functools.lru_cache(maxsize=None)
+def prompt_templates(form_type: str):
+    """Build (once per process) the prompt, prompt version and response config of every
+    category of a form type, so requests only look them up."""
+    templates = {}
+    for category_name in categories_for(form_type):
+        prompt = build_category_prompt(category_name)
+        if prompt is not None:
+            templates[category_name] = (prompt, prompt_version(prompt), response_generation_config([category_name]))
+    return templates
+
+
+def warm_up():
+    """Create the model client and prompt templates ahead of the first extraction."""
+    with startup_report.measure("warm_up.model_client"):
+        get_model_backend().warm_up()
+    with startup_report.measure("warm_up.prompt_templates"):
+        for form_type in FORM_TYPE_CATEGORIES:
+            prompt_templates(form_type)
+
+
+def response_text(category_name, response):
     try:
+        return response.text, True
+    except ValueError:
+        # Handle cases where the response is blocked (e.g., for safety reasons)
+        reason = "Unknown"
+        if response.prompt_feedback.block_reason:
+            reason = response.prompt_feedback.block_reason.name
+        print(f"Response for '{category_name}' was blocked. Reason: {reason}")
+        return f'{{"error": "Response blocked", "reason": "{reason}"}}', False
+
+
+def normalize_response(category_name, raw_text):
+    """Returns (json_text, status): the answer as full-field-name JSON, and ok / repaired /
+    invalid_json. Invalid answers are returned unchanged."""
+    data, complete = parse_json_object(raw_text)
+    if data is None:
+        return raw_text, "invalid_json"
+    return json.dumps(field_registry.expand(category_name, data)), "ok" if complete else "repaired"
+
+
+def section_raw(category_name, raw_text):
+    if category_name == "SALES_GRID":
+        section_header = "SALES GRID"
+    elif category_name == "RENT_SCHEDULE_GRID":
+        section_header = "RENT SCHEDULE GRID"
+    else: 
+        section_header = category_name
+    return f"--- {section_header} SECTION ---\n{raw_text}"
+
+
+def parse_category_response(category_name, raw_text):
+    try:
+        data, _ = parse_json_object(raw_text)
+        if data is None:
+            print(f"Could not parse JSON for {category_name}. Raw text was: {raw_text}")
+            return None
+         
+        for key, value in data.items():
+            if isinstance(value, bool):
+                data[key] = "Yes" if value else "No"
+
+         
+        for field, value in data.items():
+            if isinstance(value, dict) and set(value) <= {'choice', 'comment'} and not any(
+                    str(item or '').strip() for item in value.values()):
+                # An unanswered question is a missing field.
+                data[field] = ''
+            elif isinstance(value, dict) and 'choice' in value and 'did did not' in field.lower():
+                 
+                data[field] = f"I {value.get('choice', '')} . {value.get('comment', '')}".strip()
+            elif isinstance(value, dict) and set(value) <= {'choice', 'comment'} and not str(value.get('comment') or '').strip():
+                # A Yes/No answer without associated text is the plain string.
+                data[field] = value.get('choice', '')
+        return data
+    except Exception as e:
+        print(f"An unexpected error occurred during data processing for {category_name}: {e}")
+    return None
+
+
+def merge_category_data(combined_result, category_name, data):
+    data = dict(data)
+    if category_name in GRID_CATEGORIES:
+         
+        if "Subject" in data:
+            if "Subject" not in combined_result:
+                combined_result["Subject"] = {}
+            combined_result["Subject"].update(data["Subject"])
+            del data["Subject"]  
+        combined_result.update(data)
+    else:
+        combined_result.update(data)
+
+    # For non-grid categories, store the processed data (with transformations applied) under its category name.
+    if category_name not in GRID_CATEGORIES:
+         combined_result.setdefault(category_name, {}).update(data)
+
+
+def categories_for(form_type: str, category: str = None):
+    if category:
+        return [category.upper()]
+    return FORM_TYPE_CATEGORIES.get(form_type, DEFAULT_CATEGORIES)
+
+
+def read_pdf_file(pdf_path):
+    with open(pdf_path, "rb") as f:
+        return f.read()
+
+
+# Duplicate-photo questions answered from perceptual hashes of the report's photos, found by caption.
+ROOM_PHOTO_CHECKS = {
+    "check for the duplicate photo of the Bedrooms?": r"\bbed(room)?s?\b",
+    "check for the duplicate photo of the Bathrooms?": r"\bbath(room)?s?\b",
+}
+# Room photos of comparables and listings ("Comparable 1 Bedroom") are not the subject's rooms.
+NON_SUBJECT_CAPTION = r"\bcomp(arable)?s?\b|\blisting\b"
+COMPARABLE_PHOTO_CAPTION = r"\bcomp(arable)?(\s+(sale|rent(al)?|listing))?\s*#?\s*(\d+)\b"
+SUBJECT_VIEW_CAPTION = r"\b(front|rear|street)\b"
+COMPARABLE_DUPLICATE_CHECK = next(field for field in IMAGE_FIELDS if "duplicate of another comparable photo" in field)
+
+
+def duplicate_labels(groups):
+    return "; ".join(", ".join(photo.label() for photo in group) for group in groups)
+
+
+def describe_duplicates(groups):
+    return f"Yes - {duplicate_labels(groups)}" if groups else "No"
+
+
+def comparable_number(photo):
+    match = re.search(COMPARABLE_PHOTO_CAPTION, photo.caption, re.IGNORECASE)
+    return int(match.group(5))
+
+
+def photo_check_values(category_name, analysis):
+    """Returns (values, fields answered) for the photo checks of DATA_CONSISTENCY / IMAGE_ANALYSIS.
+
+    A check is only answered when photos with matching captions were found; otherwise it
+    stays in the prompt for the model.
+    """
+    values, answered = {}, []
+    if category_name == "DATA_CONSISTENCY":
+        for field, caption in ROOM_PHOTO_CHECKS.items():
+            photos = analysis.matching(caption, exclude=NON_SUBJECT_CAPTION)
+            if photos:
+                values[field] = describe_duplicates(analysis.duplicates_among(photos))
+                answered.append(field)
+    elif category_name == "IMAGE_ANALYSIS":
+        comparables = analysis.matching(COMPARABLE_PHOTO_CAPTION)
+        if comparables:
+            numbers = sorted({comparable_number(analysis.photos[index]) for index in comparables})
+            duplicated = set()
+            for group in analysis.duplicates_among(comparables):
+                group_numbers = {comparable_number(photo) for photo in group}
+                # The same comparable shown twice is not a duplicate of another comparable.
+                if len(group_numbers) > 1:
+                    duplicated.update(group_numbers)
+            for number in numbers:
+                values[f"duplicate photo? {number}"] = "Yes" if number in duplicated else "No"
+            answered.append(COMPARABLE_DUPLICATE_CHECK)
+        views = analysis.matching(SUBJECT_VIEW_CAPTION)
+        if len(views) > 1:
+            groups = analysis.duplicates_among(views)
+            values["Front, rear and street photos distinct?"] = f"No - {duplicate_labels(groups)}" if groups else "Yes"
+        all_groups = [[analysis.photos[index] for index in group] for group in analysis.groups]
+        values["Duplicate photo groups"] = duplicate_labels(all_groups) or "None"
+    return values, answered
+
+
+def merge_local_values(category_name, json_text, local_values):
+    """Overlay values read from the PDF onto the model's (normalized) answer."""
+    data = json.loads(json_text)
+    if category_name in GRID_LAYOUTS:
+        for column, values in local_values.items():
+            if not isinstance(data.get(column), dict):
+                data[column] = {}
+            data[column].update(values)
+    else:
+        data.update(local_values)
+    return json.dumps(data)
+
+
+def count_local_values(category_name, local_values):
+    if category_name in GRID_LAYOUTS:
+        return sum(len(values) for values in local_values.values())
+    return len(local_values)
+
+
+class SharedCallGroup:
+    """The model calls made for one shared extraction. When a more urgent request joins it
+    (e.g. a reviewer opens a section that is being prefetched), its calls are promoted."""
+
+    def __init__(self, priority):
+        self.priority = priority
+
+    def promote(self, priority):
+        if PRIORITIES.index(priority) < PRIORITIES.index(self.priority):
+            self.priority = priority
+            model_scheduler.promote(self, priority)
+
+
+# The SharedCallGroup of the extraction the current task is working on.
+_call_group = contextvars.ContextVar("call_group", default=None)
+
+
+class ExtractionRun:
+    """State shared by every model call made for one document and form type."""
+
+    def __init__(self, pdf_bytes, form_type: str, backend, document_part, pdf_sha256: str = None,
+                 previous_sha256: str = None, priority: str = STANDARD, client: str = None):
+        self.pdf_bytes = pdf_bytes
+        self.pdf_sha256 = pdf_sha256 or hash_pdf_bytes(pdf_bytes)
+        # Earlier version of the same report; categories whose pages are unchanged reuse its results.
+        self.previous_sha256 = previous_sha256 if previous_sha256 != self.pdf_sha256 else None
+        self.form_type = form_type
+        self.backend = backend
+        self.document_part = document_part
+        # Scheduler traffic class and the client the calls are made for.
+        self.priority = priority
+        self.client = client
+        self.page_index = None
+        # Page ranges extracted separately when the document is too large to send whole.
+        self.shards = None
+        self._local_extraction = None
+        self._photo_analysis = None
+        # category -> {"status": ok|cached|reused|local|repaired|partial|blocked|invalid_json|error, "attempts": n, ...}
+        self.status = {}
+        # category -> {"shards": n, "failed_shards": n, "conflicts": [...]} for sharded calls
+        self.shard_details = {}
+
+    @classmethod
+    async def open(cls, pdf_path, form_type: str, pdf_bytes: bytes = None, pdf_sha256: str = None,
+                   previous_sha256: str = None, priority: str = STANDARD, client: str = None):
         # Read the PDF file bytes directly to avoid the File API's `ragStoreName` requirement.
-        with open(pdf_path, "rb") as f:
-            pdf_bytes = f.read()
+        # Uploads are normally passed in as bytes (with their hash) instead of a path.
+        if pdf_bytes is None:
+            pdf_bytes = await asyncio.to_thread(read_pdf_file, pdf_path)
+        backend = get_model_backend()
+        run = cls(pdf_bytes, form_type, backend, None, pdf_sha256=pdf_sha256, previous_sha256=previous_sha256,
+                  priority=priority, client=client)
+        # The document part is either the inline PDF or, in "file" context mode, a reference
+        # to a copy uploaded once and shared by every category prompt.
+        run.document_part = await backend.document_part(pdf_bytes, run.pdf_sha256)
+        run.page_index = await asyncio.to_thread(build_page_index, pdf_bytes, run.pdf_sha256)
+        if run.page_index is not None and isinstance(run.document_part, dict) and "data" in run.document_part:
+            # Only inline documents are split; an uploaded file is referenced, not resent, per call.
+            run.shards = plan_shards(run.page_index.page_count, len(pdf_bytes))
+        return run
 
-        # Create the file part to be included in the prompt.
-        sample_file_part = {"mime_type": "application/pdf", "data": pdf_bytes}
+    def with_priority(self, priority):
+        """A run over the same document whose model calls are scheduled at `priority`."""
+        run = ExtractionRun(self.pdf_bytes, self.form_type, self.backend, self.document_part,
+                            pdf_sha256=self.pdf_sha256, previous_sha256=self.previous_sha256,
+                            priority=priority, client=self.client)
+        run.page_index = self.page_index
+        run.shards = self.shards
+        return run
 
-        model = genai.GenerativeModel(model_name="gemini-2.5-flash")
+    def cache_key(self, cache_category, prompt, pdf_sha256=None, suffix=""):
+        version = prompt_version(prompt)
+        if self.page_index is not None:
+            version = f"{version}:{ROUTING_VERSION}"
+        if LOCAL_EXTRACTION:
+            version = f"{version}:local{LOCAL_EXTRACTION_VERSION}"
+        if PHOTO_HASHING and cache_category in FREE_FORM_CATEGORIES:
+            version = f"{version}:photos{PHOTO_HASH_VERSION}"
+        if self.shards:
+            version = f"{version}:shards{SHARD_VERSION}"
+        return make_cache_key(pdf_sha256 or self.pdf_sha256, self.form_type, cache_category, version + suffix)
 
-        if custom_prompt:
-            # Handle custom prompt directly
-            final_prompt = (
-                f"Extract information from the appraisal report based on the following request: '{custom_prompt}'. "
-                "Return your answer strictly as a JSON object. "
-                "If the information is not found, return an empty JSON object or indicate that in the JSON values. "
-                "Do not include any explanation or formatting outside the JSON object."
-            )
-            response = await model.generate_content_async(contents=[sample_file_part, final_prompt])
-            raw_text = response.text
-            json_str = raw_text.strip().lstrip('```json').rstrip('```').strip()
-            data = json.loads(json_str) if json_str else {}
-            return {'fields': data, 'raw': f"--- CUSTOM PROMPT SECTION ---\n{raw_text}"}
-
-
-        async def process_category(category_name, fields_list):
-            complex_field_instructions = (
-                "For fields containing 'did did not', the value should be a JSON object like {'choice': 'did' or 'did not', 'comment': 'extracted text'}. "
-                "For Yes/No questions, if the answer is 'Yes' and there is associated text, the value should be a JSON object like {'choice': 'Yes', 'comment': 'extracted text'}. "
-                "If the answer is just 'Yes' or 'No' without other text, the value should be the string 'Yes' or 'No'. "
-                "If a checkbox is marked, treat it as 'Yes'."
-            )
-            
-            base_prompt = (
-                "Extract the following fields from the appraisal report. "
-                "Return your answer strictly as a JSON object with this structure: { 'FieldName': 'Value', ... } "
-                "If a field is missing, set its value to ''. Do not include any explanation or formatting outside the JSON object. "
-            )
+    def source_fingerprint(self, category_name):
+        if self.page_index is None:
+            return None
+        return self.page_index.source_fingerprint(category_name, self.form_type)
 
-            final_prompt = f"{base_prompt}{complex_field_instructions} Fields for {category_name}: {fields_list}."
+    async def cached_result(self, category_name, prompt):
+        """Cached text for this document or, for a revision, the previous version's text
+        when the category's source pages did not change. None when it must be extracted."""
+        cached_text = await extraction_cache.get_async(self.cache_key(category_name, prompt))
+        if cached_text is not None:
+            self.record_status([category_name], "cached", attempts=0)
+            return cached_text
+        fingerprint = self.source_fingerprint(category_name)
+        if not self.previous_sha256 or fingerprint is None:
+            return None
+        previous_fingerprint = await extraction_cache.get_async(
+            self.cache_key(category_name, prompt, self.previous_sha256, suffix=":source"))
+        if previous_fingerprint != fingerprint:
+            return None
+        previous_text = await extraction_cache.get_async(self.cache_key(category_name, prompt, self.previous_sha256))
+        if previous_text is None:
+            return None
+        await self.store_result(category_name, prompt, previous_text)
+        self.record_status([category_name], "reused", attempts=0, previous_document=self.previous_sha256)
+        return previous_text
 
-            response = await model.generate_content_async(contents=[sample_file_part, final_prompt])
-            return category_name, response
+    async def store_result(self, category_name, prompt, raw_text):
+        # The source fingerprint is stored next to the result so a later revision can tell
+        # whether the result still applies.
+        await extraction_cache.set_async(self.cache_key(category_name, prompt), raw_text)
+        fingerprint = self.source_fingerprint(category_name)
+        if fingerprint is not None:
+            await extraction_cache.set_async(self.cache_key(category_name, prompt, suffix=":source"), fingerprint)
 
-        async def process_sales_grid():
-            sales_grid_prompt = (
-                "Extract the following fields for the Subject and each Comparable Sale from the SALES COMPARISON APPROACH section of the appraisal report. "
-                "Return your answer strictly as a JSON object with this structure: { 'Subject': {SalesGridFIELDS2}, 'COMPARABLE SALE #1': {SalesGridFIELDS2}, ... } "
-                "If a field is missing, set its value to ''. Do not include any explanation or formatting outside the JSON object. "f"Fields: {SalesGridFIELDS2}. "
-            )
-            response = await model.generate_content_async(contents=[sample_file_part, sales_grid_prompt])
-            return "SALES_GRID", response
-
-        async def process_rent_schedule_grid():
-            rent_schedule_prompt = (
-                "Extract the following fields for the Subject and each Comparable Rent from the COMPARABLE RENT SCHEDULE section of the appraisal report. "
-                "Return your answer strictly as a JSON object with this structure: { 'Subject': {RentSchedulesFIELDS2}, 'COMPARABLE RENT #1': {RentSchedulesFIELDS2}, ... } "
-                "If a field is missing, set its value to ''. Do not include any explanation or formatting outside the JSON object. "f"Fields: {RentSchedulesFIELDS2}. "
-            )
-            response = await model.generate_content_async(contents=[sample_file_part, rent_schedule_prompt])
-            return "RENT_SCHEDULE_GRID", response
-
-        field_categories = {
-            "SUBJECT": SUBJECT_FIELDS, "CONTRACT": CONTRACT_FIELDS, "NEIGHBORHOOD": NEIGHBORHOOD_FIELDS,
-            "SITE": SITE_FIELDS, "IMPROVEMENTS": IMPROVEMENTS_FIELDS, "RECONCILIATION": RECONCILIATION_FIELDS,
-            "COST_APPROACH": COST_APPROACH_FIELDS, "INCOME_APPROACH": INCOME_APPROACH_FIELDS,
-            "RENT_SCHEDULE_RECONCILIATION": RENT_SCHEDULE_RECONCILIATION_FIELDS, "PUD_INFO": PUD_INFO_FIELDS,
-            "CERTIFICATION": CERTIFICATION_FIELDS, "ADDENDUM": ADDENDUM_FIELDS, "SALES_TRANSFER": SALES_TRANSFER_FIELDS,
-            "UNIFORM_REPORT": UNIFORM_REPORT_FIELDS, "APPRAISAL_ID": APPRAISAL_ID_FIELDS, "MARKET_CONDITIONS": MARKET_CONDITIONS_FIELDS,
-            "CONDO": CONDO_FIELDS, "IMAGE_ANALYSIS": IMAGE_FIELDS,
-            "PRIOR_SALE_HISTORY": PRIOR_SALE_HISTORY_FIELDS, "PROJECT_SITE": Project_SITE_FIELDS, "PROJECT_INFO": Project_Info_FIELDS,
-            "PROJECT_ANALYSIS": Project_Analysis_FIELDS, "UNIT_DESCRIPTIONS": UNIT_DESCRIPTIONS_FIELDS,
-            "DATA_CONSISTENCY": DATA_CONSISTENCY_FIELDS
-        }
+    async def document_part_for(self, categories):
+        # Send only the pages the categories need; fall back to the whole report whenever
+        # any of them cannot be located.
+        if self.page_index is None:
+            return self.document_part
+        pages = set()
+        for category_name in categories:
+            category_pages = self.page_index.pages_for(category_name, self.form_type)
+            if category_pages is None:
+                return self.document_part
+            pages.update(category_pages)
+        subset = await asyncio.to_thread(extract_pages, self.pdf_bytes, self.pdf_sha256, sorted(pages))
+        return inline_pdf_part(subset) if subset is not None else self.document_part
 
-        if category:
-            categories_to_process = [category.upper()]
+    def routing_affinity(self, category_name):
+        if self.page_index is None:
+            return None
+        return self.page_index.pages_for(category_name, self.form_type) is not None
+
+    def record_status(self, categories, status, **details):
+        for category_name in categories:
+            self.status[category_name] = {"status": status, **details}
+            if category_name in self.shard_details and status not in ("cached", "reused", "local"):
+                self.status[category_name].update(self.shard_details[category_name])
+
+    def shard_status(self, category_name, status):
+        # Answers missing some page ranges are returned but not cached, so they are retried next time.
+        if status == "ok" and self.shard_details.get(category_name, {}).get("failed_shards"):
+            return "partial"
+        return status
+
+    async def call_model(self, label, prompt, categories, schemas=None):
+        """Returns (raw_text, ok, attempts); raises ModelCallFailed once retries are exhausted.
+
+        `schemas` ({category: response schema}) replaces the default schemas when only some
+        of a category's fields are requested.
+        """
+        document_part = await self.document_part_for(categories)
+        if document_part is self.document_part and self.shards:
+            if not any(category_name in FULL_DOCUMENT_CATEGORIES for category_name in categories):
+                return await self.call_shards(label, prompt, categories, schemas)
+            # Photo and consistency checks compare pages across the whole report, so they are sent whole.
+            if len(self.pdf_bytes) > INLINE_MAX_BYTES:
+                raise DocumentTooLarge(
+                    f"{label} needs the whole report, which is {len(self.pdf_bytes) / 1024 / 1024:.1f} MB; "
+                    f"inline requests are limited to {INLINE_MAX_BYTES / 1024 / 1024:.0f} MB (set DOCUMENT_CONTEXT_MODE=file)"
+                )
+        return await self.call_model_on(document_part, label, prompt, categories, schemas)
+
+    async def shard_part(self, start, stop):
+        subset = await asyncio.to_thread(extract_pages, self.pdf_bytes, self.pdf_sha256, list(range(start, stop)))
+        return inline_pdf_part(subset) if subset is not None else None
+
+    async def call_shards(self, label, prompt, categories, schemas=None):
+        """call_model for a document split into page ranges: one call per range, in parallel,
+        with the answers merged (see merge_shard_answers). Latency follows the slowest range."""
+        parts = await asyncio.gather(*(self.shard_part(start, stop) for start, stop in self.shards))
+        if any(part is None for part in parts):
+            return await self.call_model_on(self.document_part, label, prompt, categories, schemas)
+        SHARD_CALLS.inc(len(parts), form_type=self.form_type, category=label)
+        outcomes = await asyncio.gather(
+            *(self.call_model_on(part, label, prompt, categories, schemas) for part in parts), return_exceptions=True)
+        answers, failures, attempts = [], [], 1
+        for outcome in outcomes:
+            if isinstance(outcome, asyncio.CancelledError):
+                raise outcome
+            if isinstance(outcome, Exception):
+                failures.append(outcome)
+                continue
+            raw_text, ok, outcome_attempts = outcome
+            attempts = max(attempts, outcome_attempts)
+            data = parse_json_object(raw_text)[0] if ok else None
+            if data is None:
+                failures.append(raw_text)
+            else:
+                answers.append(data)
+        if not answers:
+            if any(isinstance(failure, Exception) for failure in failures):
+                raise next(failure for failure in failures if isinstance(failure, Exception))
+            return outcomes[0][0], outcomes[0][1], attempts
+        # Free-form findings from different pages are all kept; structured fields take one value.
+        join_text = all(name in FREE_FORM_CATEGORIES or name not in RESPONSE_SCHEMAS for name in categories)
+        merged, conflicts = merge_shard_answers(answers, join_text=join_text)
+        if conflicts:
+            SHARD_CONFLICTS.inc(len(conflicts), form_type=self.form_type, category=label)
+        for category_name in categories:
+            prefix = f"{category_name}/" if len(categories) > 1 else ""
+            self.shard_details[category_name] = {
+                "shards": len(parts),
+                "failed_shards": len(failures),
+                "conflicts": [path[len(prefix):] for path in conflicts if path.startswith(prefix)],
+            }
+        return json.dumps(merged), True, attempts
+
+    async def call_model_on(self, document_part, label, prompt, categories, schemas=None):
+        contents = [document_part, prompt]
+        if schemas is None:
+            config = response_generation_config(categories)
+        elif len(categories) == 1:
+            config = generation_config(schemas[categories[0]])
+        elif any(schema is None for schema in schemas.values()):
+            config = generation_config()
         else:
-            categories_to_process = FORM_TYPE_CATEGORIES.get(form_type, DEFAULT_CATEGORIES)
-
-        import asyncio
-        tasks = []
-        for category_name in categories_to_process:
-            if category_name == "SALES_GRID":
-                tasks.append(process_sales_grid())
-            elif category_name == "RENT_SCHEDULE_GRID":
-                tasks.append(process_rent_schedule_grid())
-            elif category_name in field_categories:
-                tasks.append(process_category(category_name, field_categories[category_name]))
+            config = generation_config(batch_schema(schemas))
+        labels = {"form_type": self.form_type, "category": label}
+
+        async def timed_generate():
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                response = await with_deadline(self.backend.generate(contents, generation_config=config))
+                outcome = "ok"
+                return response
+            finally:
+                MODEL_CALL_SECONDS.observe(time.perf_counter() - started, outcome=outcome, **labels)
+
+        async def scheduled():
+            # The deadline and the hedge timer start once the scheduler grants a slot, so
+            # queueing never counts against either. A duplicate needs a slot and a rate-limit
+            # token of its own and is skipped when none is free.
+            return await hedged(timed_generate, on_hedge=lambda: MODEL_HEDGES.inc(**labels),
+                                acquire=model_scheduler.try_acquire)
 
+        async def attempt():
+            MODEL_REQUEST_BYTES.inc(request_bytes(contents), **labels)
+            group = _call_group.get()
+            priority = group.priority if group is not None else self.priority
+            try:
+                return await model_scheduler.run(scheduled, priority=priority, client=self.client, group=group)
+            except UploadExpired:
+                if contents[0] is not self.document_part:
+                    raise
+                # The File API dropped the document; upload it again and resend.
+                self.document_part = await self.backend.document_part(self.pdf_bytes, self.pdf_sha256)
+                contents[0] = self.document_part
+                return await model_scheduler.run(scheduled, priority=priority, client=self.client, group=group)
+
+        try:
+            response, attempts = await call_with_retries(attempt, label)
+        except ModelCallFailed as e:
+            MODEL_RETRIES.inc(e.attempts - 1, **labels)
+            MODEL_CALL_FAILURES.inc(**labels)
+            raise
+        MODEL_RETRIES.inc(attempts - 1, **labels)
+        record_usage(response, **labels)
+        raw_text, ok = response_text(label, response)
+        MODEL_RESPONSE_BYTES.inc(len(raw_text.encode("utf-8")), **labels)
+        if not ok:
+            BLOCKED_RESPONSES.inc(**labels)
+        else:
+            data, complete = parse_json_object(raw_text)
+            if data is None:
+                JSON_DECODE_FAILURES.inc(**labels)
+            elif not complete:
+                JSON_REPAIRED.inc(**labels)
+        return raw_text, ok, attempts
+
+    async def local_extraction(self):
+        # Read once per run, off the event loop, and only when a category needs it.
+        if self._local_extraction is None:
+            self._local_extraction = asyncio.ensure_future(
+                asyncio.to_thread(extract_local_fields, self.pdf_bytes, self.pdf_sha256, KNOWN_LABELS))
+        return await asyncio.shield(self._local_extraction)
+
+    async def photo_analysis(self):
+        if self._photo_analysis is None:
+            self._photo_analysis = asyncio.ensure_future(
+                asyncio.to_thread(analyze_photos, self.pdf_bytes, self.pdf_sha256))
+        return await asyncio.shield(self._photo_analysis)
+
+    async def resolve_photo_checks(self, category_name):
+        analysis = await self.photo_analysis()
+        if analysis is None:
+            return {}, None
+        values, answered = photo_check_values(category_name, analysis)
+        if not answered:
+            return values, None
+        return values, [field for field in dict.fromkeys(FIELD_CATEGORIES[category_name]) if field not in answered]
+
+    async def resolve_locally(self, category_name):
+        """Returns (values read from the PDF, fields the model must still extract).
+
+        The remaining fields are None when nothing was removed from the category, and an
+        empty list when the whole category was read locally.
+        """
+        if category_name in FREE_FORM_CATEGORIES:
+            return await self.resolve_photo_checks(category_name)
+        is_grid = category_name in GRID_LAYOUTS
+        if not is_grid and category_name not in FIELD_CATEGORIES:
+            return {}, None
+        local = await self.local_extraction()
+        if local is None:
+            return {}, None
+        pages = self.page_index.pages_for(category_name, self.form_type) if self.page_index is not None else None
+        if is_grid:
+            column_label, fields, _ = GRID_LAYOUTS[category_name]
+            values, resolved = local.resolve_grid(column_label, fields, pages)
+        else:
+            fields = FIELD_CATEGORIES[category_name]
+            values = local.resolve(fields, pages)
+            resolved = list(values)
+        if not resolved:
+            return values, None
+        resolved = set(resolved)
+        return values, [field for field in dict.fromkeys(fields) if field not in resolved]
+
+    async def store_local_result(self, category_name, local_values):
+        raw_text = json.dumps(local_values)
+        await self.store_result(category_name, build_category_prompt(category_name), raw_text)
+        count = count_local_values(category_name, local_values)
+        LOCAL_FIELDS.inc(count, form_type=self.form_type, category=category_name)
+        self.record_status([category_name], "local", attempts=0, local_fields=count)
+        return raw_text
+
+    async def generate(self, cache_category, prompt):
+        # Serve repeat extractions of the same document from the cache; only
+        # well-formed JSON responses are stored so failures are retried next time.
+        cached_text = await self.cached_result(cache_category, prompt)
+        if cached_text is not None:
+            return cached_text
+        local_values, remaining = await self.resolve_locally(cache_category)
+        if remaining == []:
+            return await self.store_local_result(cache_category, local_values)
+        model_prompt, schemas = prompt, None
+        if remaining is not None:
+            model_prompt = build_fields_prompt(cache_category, remaining)
+            schemas = {cache_category: response_schema_for(cache_category, remaining)}
+        raw_text, ok, attempts = await self.call_model(cache_category, model_prompt, [cache_category], schemas)
+        status = "blocked"
+        if ok:
+            raw_text, status = normalize_response(cache_category, raw_text)
+            status = self.shard_status(cache_category, status)
+        details = {"attempts": attempts}
+        if local_values and status != "invalid_json" and ok:
+            raw_text = merge_local_values(cache_category, raw_text, local_values)
+            details["local_fields"] = count_local_values(cache_category, local_values)
+            LOCAL_FIELDS.inc(details["local_fields"], form_type=self.form_type, category=cache_category)
+        if status == "ok":
+            await self.store_result(cache_category, prompt, raw_text)
+        self.record_status([cache_category], status, **details)
+        return raw_text
+
+    async def run_category(self, category_name):
+        raw_text = await self.generate(category_name, build_category_prompt(category_name))
+        return [(category_name, raw_text)]
+
+    async def run_batch(self, batch):
+        """Extract several small categories with one model call and split the answer per category."""
         results = []
-        chunk_size = 5
-        for i in range(0, len(tasks), chunk_size):
-            chunk = tasks[i:i + chunk_size]
-            chunk_results = await asyncio.gather(*chunk)
-            results.extend(chunk_results)
+        pending = []
+        local = {}  # category -> (local values, remaining fields)
+        for category_name in batch:
+            cached_text = await self.cached_result(category_name, build_category_prompt(category_name))
+            if cached_text is not None:
+                results.append((category_name, cached_text))
+                continue
+            local_values, remaining = await self.resolve_locally(category_name)
+            if remaining == []:
+                results.append((category_name, await self.store_local_result(category_name, local_values)))
+                continue
+            local[category_name] = (local_values, remaining)
+            pending.append(category_name)
+        if len(pending) == 1:
+            return results + await self.run_safely([pending[0]])
+        if pending:
+            label = "+".join(pending)
+            field_lists = {
+                name: PROMPT_FIELD_LISTS[name] if local[name][1] is None else field_registry.prompt_fields(name, local[name][1])
+                for name in pending
+            }
+            schemas = {
+                name: RESPONSE_SCHEMAS.get(name) if local[name][1] is None else response_schema_for(name, local[name][1])
+                for name in pending
+            }
+            prompt = build_batch_prompt(pending, field_lists, field_registry.instructions + COMPLEX_FIELD_INSTRUCTIONS)
+            raw_text, ok, attempts = await self.call_model(label, prompt, pending, schemas)
+            split, complete = split_batch_response(raw_text, pending) if ok else ({}, False)
+            for category_name, category_text in split.items():
+                category_text, status = normalize_response(category_name, category_text)
+                status = self.shard_status(category_name, status)
+                details = {"attempts": attempts, "batch": label}
+                local_values = local[category_name][0]
+                if local_values and status != "invalid_json":
+                    category_text = merge_local_values(category_name, category_text, local_values)
+                    details["local_fields"] = count_local_values(category_name, local_values)
+                    LOCAL_FIELDS.inc(details["local_fields"], form_type=self.form_type, category=category_name)
+                if not complete and status == "ok":
+                    status = "repaired"
+                if status == "ok":
+                    # Stored under the single-category key, so later per-section requests hit it too.
+                    await self.store_result(category_name, build_category_prompt(category_name), category_text)
+                self.record_status([category_name], status, **details)
+                results.append((category_name, category_text))
+            missing = [category_name for category_name in pending if category_name not in split]
+            if missing:
+                print(f"Combined call for {label} did not return {missing}; extracting them individually.")
+                for category_results in await asyncio.gather(*(self.run_safely([name]) for name in missing)):
+                    results.extend(category_results)
+        return results
+
+    async def run_safely(self, batch):
+        """Run one planned call; a failure is recorded per category instead of aborting the extraction.
+
+        Failed categories are returned with raw_text None.
+        """
+        try:
+            if len(batch) == 1:
+                return await self.run_category(batch[0])
+            return await self.run_batch(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Extraction failed for {', '.join(batch)}: {e}")
+            self.record_status(
+                batch, "error", attempts=getattr(e, "attempts", 1), error=str(e), quota_exceeded=is_quota_error(e)
+            )
+            return [(category_name, None) for category_name in batch]
+
+    def flight_key(self, batch):
+        # Everything that determines the result of a planned call.
+        return (self.pdf_sha256, self.previous_sha256, self.form_type, tuple(batch))
+
+    async def run_shared(self, batch):
+        """run_safely(batch), shared with an identical or larger extraction already in flight."""
+        key = self.flight_key(batch)
+        if extraction_flights.owner(key) is None:
+            # A section can also be answered by a larger batch in flight, e.g. one being prefetched.
+            document = key[:-1]
+            key = extraction_flights.find(
+                lambda running: running[:-1] == document and set(batch) <= set(running[-1])
+            ) or key
+        running = extraction_flights.owner(key)
+        if running is not None:
+            running.promote(self.priority)
+        group = SharedCallGroup(self.priority)
+
+        async def run():
+            # Runs in the flight's own task, so the calls it makes (and their shards) carry the group.
+            _call_group.set(group)
+            results = await self.run_safely(batch)
+            return results, {name: self.status[name] for name in batch if name in self.status}
+
+        (results, status), joined = await extraction_flights.run(key, run, owner=group)
+        if joined:
+            results = [(category_name, raw_text) for category_name, raw_text in results if category_name in batch]
+            for category_name, entry in status.items():
+                if category_name in batch:
+                    self.status[category_name] = {**entry, "shared": True}
+        return results
+
+    def prefetch_remaining(self, requested):
+        """Extract the form type's other sections in the background, once per document.
+
+        The UI asks for sections one at a time; prefetched results land in the extraction
+        cache. Sections are batched the way a full extraction would batch them, and a
+        request for a section while its prefetch is running joins (and promotes) that call.
+        """
+        remaining = [
+            category_name for category_name in categories_for(self.form_type)
+            if category_name not in requested and build_category_prompt(category_name) is not None
+        ]
+        if not remaining:
+            return
 
-        for category_name, response in results:
+        background = self.with_priority(BACKGROUND)
+        pending = iter(plan_category_batches(remaining, FIELD_CATEGORIES, affinity=self.routing_affinity))
+
+        async def worker():
+            # Workers share one iterator, so sections are fetched in the order the UI shows them.
+            for batch in pending:
+                async with prefetcher.slot():
+                    await background.run_shared(batch)
+
+        async def prefetch():
+            await asyncio.gather(*(worker() for _ in range(prefetcher.max_in_flight)))
+
+        prefetcher.schedule((self.pdf_sha256, self.previous_sha256, self.form_type), prefetch)
+
+    def quota_exhausted(self):
+        """True when nothing succeeded and the failures were quota errors."""
+        statuses = list(self.status.values())
+        return bool(statuses) and all(entry["status"] == "error" for entry in statuses) and any(
+            entry.get("quota_exceeded") for entry in statuses
+        )
+
+    async def iter_categories(self, categories):
+        """Yield (category_name, raw_text) for each category in completion order.
+
+        raw_text is None for categories whose model call failed; see `self.status`.
+        """
+        # All calls are submitted at once; the process-wide scheduler decides how many
+        # model calls actually run concurrently.
+        known = [category_name for category_name in categories if build_category_prompt(category_name) is not None]
+        tasks = [
+            asyncio.ensure_future(self.run_shared(batch))
+            for batch in plan_category_batches(known, FIELD_CATEGORIES, affinity=self.routing_affinity)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                for result in await next_done:
+                    yield result
+        finally:
+            # Stop outstanding model calls if the consumer goes away (e.g. a client disconnect).
+            for task in tasks:
+                task.cancel()
+
+
+def build_extraction_result(categories, raw_by_category, status=None):
+    # Merge in category-list order so overlapping keys resolve the same way regardless of
+    # which call finished first.
+    combined_result = {}
+    raw_responses = []
+    for category_name in categories:
+        if category_name not in raw_by_category:
+            continue
+        raw_text = raw_by_category[category_name]
+        raw_responses.append(section_raw(category_name, raw_text))
+        data = parse_category_response(category_name, raw_text)
+        if data is not None:
+            merge_category_data(combined_result, category_name, data)
+    result = {'fields': combined_result, 'raw': "\n\n".join(raw_responses)}
+    if "SALES_GRID" in raw_by_category:
+        try:
+            result['sales_comparison'] = get_sales_comparison_data(combined_result)
+        except Exception as e:
+            print(f"Sales comparison analytics failed: {e}")
+    if status is not None:
+        result['status'] = {name: status[name] for name in categories if name in status}
+    return result
+
+
+def request_priority(category: str = None, custom_prompt: str = None):
+    # A single section or a custom question has a reviewer waiting on it; a full report does not.
+    return INTERACTIVE if category or custom_prompt else STANDARD
+
+
+async def extract_fields_from_pdf(pdf_path, form_type: str, category: str = None, custom_prompt: str = None, pdf_bytes: bytes = None, pdf_sha256: str = None, previous_sha256: str = None, priority: str = None, client: str = None):
+    from google.api_core import exceptions as google_exceptions
+    categories_to_process = categories_for(form_type, category)
+    raw_by_category = {}
+    status = {}
+
+    try:
+        run = await ExtractionRun.open(pdf_path, form_type, pdf_bytes=pdf_bytes, pdf_sha256=pdf_sha256, previous_sha256=previous_sha256,
+                                       priority=priority or request_priority(category, custom_prompt), client=client)
+        status = run.status
+
+        if custom_prompt:
+            # Handle custom prompt directly
             try:
-                raw_text = response.text
-            except ValueError:
-                # Handle cases where the response is blocked (e.g., for safety reasons)
-                reason = "Unknown"
-                if response.prompt_feedback.block_reason:
-                    reason = response.prompt_feedback.block_reason.name
-                print(f"Response for '{category_name}' was blocked. Reason: {reason}")
-                raw_text = f'{{"error": "Response blocked", "reason": "{reason}"}}'
-
-            if category_name == "SALES_GRID":
-                section_header = "SALES GRID"
-            elif category_name == "RENT_SCHEDULE_GRID":
-                section_header = "RENT SCHEDULE GRID"
-            else: 
-                section_header = category_name
-            raw_responses.append(f"--- {section_header} SECTION ---\n{raw_text}")
-
-            json_str = raw_text.strip().lstrip('```json').rstrip('```').strip()
-            if json_str:
-                try:
-                    data = json.loads(json_str)
-                     
-                    for key, value in data.items():
-                        if isinstance(value, bool):
-                            data[key] = "Yes" if value else "No"
-
-                     
-                    for field, value in data.items():
-                        if isinstance(value, dict) and 'choice' in value and 'did did not' in field.lower():
-                             
-                            data[field] = f"I {value.get('choice', '')} . {value.get('comment', '')}".strip()
-
-                    if category_name in ["SALES_GRID", "RENT_SCHEDULE_GRID"]:
-                         
-                        if "Subject" in data:
-                            if "Subject" not in combined_result:
-                                combined_result["Subject"] = {}
-                            combined_result["Subject"].update(data["Subject"])
-                            del data["Subject"]  
-                        combined_result.update(data)
-                    else:
-                        combined_result.update(data)
-
-                    # For non-grid categories, store the processed data (with transformations applied) under its category name.
-                    if category_name not in ["SALES_GRID", "RENT_SCHEDULE_GRID"]:
-                         combined_result.setdefault(category_name, {}).update(data)
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON for {category_name}: {e}")
-                    print(f"Raw text was: {raw_text}")
-                except Exception as e:
-                    print(f"An unexpected error occurred during data processing for {category_name}: {e}")
+                raw_text = await run.generate("CUSTOM_PROMPT", build_custom_prompt(custom_prompt))
+            except ModelCallFailed as e:
+                raise e.cause
+            data, _ = parse_json_object(raw_text)
+            return {'fields': data or {}, 'raw': f"--- CUSTOM PROMPT SECTION ---\n{raw_text}"}
+
+        if category:
+            run.prefetch_remaining(categories_to_process)
+
+        async for category_name, raw_text in run.iter_categories(categories_to_process):
+            if raw_text is not None:
+                raw_by_category[category_name] = raw_text
+
+        if run.quota_exhausted():
+            raise google_exceptions.ResourceExhausted("every category call was rejected for quota")
 
     except google_exceptions.ResourceExhausted as e:
         print(f"Gemini API Quota Exceeded: {e}")
@@ -645,15 +1445,83 @@ async def extract_fields_from_pdf(pdf_path, form_type: str, category: str = None
     except Exception as e:
         print(f"Error parsing JSON from Gemini: {e}")
          
-        return {'fields': combined_result, 'raw': "\n\n".join(raw_responses)}
+        return build_extraction_result(categories_to_process, raw_by_category, status)
 
-    return {'fields': combined_result, 'raw': "\n\n".join(raw_responses)}
+    result = build_extraction_result(categories_to_process, raw_by_category, run.status)
+    # Clients pass this back as previous_document_id when they upload a revision.
+    result['document_sha256'] = run.pdf_sha256
+    return result
+
+
+async def stream_extraction_events(pdf_path, form_type: str, category: str = None, pdf_bytes: bytes = None, pdf_sha256: str = None, previous_sha256: str = None, priority: str = None, client: str = None):
+    """Yield one event per category as soon as it completes, then a summary event.
+
+    The summary carries the same merged {'fields', 'raw'} result that extract_fields_from_pdf returns.
+    """
+    from google.api_core import exceptions as google_exceptions
+    categories_to_process = categories_for(form_type, category)
+    raw_by_category = {}
+    status = {}
+    started_at = time.perf_counter()
+    error = None
+    document_sha256 = pdf_sha256
+
+    try:
+        run = await ExtractionRun.open(pdf_path, form_type, pdf_bytes=pdf_bytes, pdf_sha256=pdf_sha256, previous_sha256=previous_sha256,
+                                       priority=priority or request_priority(category), client=client)
+        status = run.status
+        document_sha256 = run.pdf_sha256
+        async for category_name, raw_text in run.iter_categories(categories_to_process):
+            if raw_text is None:
+                yield {
+                    "event": "category_error",
+                    "category": category_name,
+                    "status": run.status.get(category_name, {}),
+                    "elapsed": round(time.perf_counter() - started_at, 3),
+                }
+                continue
+            raw_by_category[category_name] = raw_text
+            yield {
+                "event": "category",
+                "category": category_name,
+                "fields": parse_category_response(category_name, raw_text) or {},
+                "raw": section_raw(category_name, raw_text),
+                "elapsed": round(time.perf_counter() - started_at, 3),
+            }
+    except google_exceptions.ResourceExhausted as e:
+        print(f"Gemini API Quota Exceeded: {e}")
+        error = f"API quota exceeded. Please check your plan and billing details. Original error: {e}"
+    except Exception as e:
+        print(f"Error during streaming extraction: {e}")
+        error = str(e)
+
+    summary = build_extraction_result(categories_to_process, raw_by_category, status)
+    summary.update({
+        "event": "summary",
+        "completed": [name for name in categories_to_process if name in raw_by_category],
+        "document_sha256": document_sha256,
+        "elapsed": round(time.perf_counter() - started_at, 3),
+    })
+    if error:
+        summary["error"] = error
+    yield summary
 
  
 def get_sales_comparison_data(extracted_data):
-     
-    return {
-        "table_data": {},
-        "research_data": {},
-        "additional_data": {}
-    }
+    """Adjustment totals, adjusted prices, consistency checks and outlier flags for the
+    sales grid in an extraction's fields (see sales_analytics)."""
+    # NumPy is only imported once analytics are requested, keeping it out of cold starts.
+    try:
+        from .sales_analytics import analyze_sales_grid
+    except ImportError:
+        from sales_analytics import analyze_sales_grid
+    return analyze_sales_grid(extracted_data)
+
+
+def get_portfolio_sales_analytics(reports):
+    """Sales comparison analytics for many reports' fields at once, with portfolio aggregates."""
+    try:
+        from .sales_analytics import analyze_portfolio
+    except ImportError:
+        from sales_analytics import analyze_portfolio
+    return analyze_portfolio(reports)
@@ -0,0 +1,329 @@
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    from .local_extractor import page_lines
+except ImportError:
+    from local_extractor import page_lines
+
+# Answer duplicate-photo checks from perceptual hashes of the embedded images instead of the model.
+PHOTO_HASHING = os.getenv("PHOTO_HASHING", "1") == "1"
+# Part of the cache key, so results are re-extracted when hashing or matching changes.
+PHOTO_HASH_VERSION = "2"
+# Two photos whose 64-bit hashes differ in at most this many bits are the same picture.
+PHOTO_HASH_DISTANCE = int(os.getenv("PHOTO_HASH_DISTANCE", "8"))
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "32"))
+# Logos, icons and check marks are smaller than this (pixels on the shorter side).
+PHOTO_MIN_SIDE = 48
+# Or drawn smaller than this (points on the shorter side).
+PHOTO_MIN_DRAWN = 36
+# Images this flat (grey-level standard deviation) are blank placeholders, not photos.
+PHOTO_MIN_CONTRAST = 2.0
+# Captions are looked for this far (points) below, then above, the drawn image.
+CAPTION_DISTANCE = 36
+
+HASH_SIZE = 8
+HASH_SOURCE_SIZE = 32
+MAX_FORM_DEPTH = 4
+
+_COMPONENTS = {"/DeviceGray": 1, "/CalGray": 1, "/DeviceRGB": 3, "/CalRGB": 3, "/DeviceCMYK": 4}
+
+
+class Photo:
+    def __init__(self, page, name, bbox, caption=""):
+        self.page = page  # 1-based, as printed
+        self.name = name
+        self.bbox = bbox  # (x0, y0, x1, y1) in points
+        self.caption = caption
+
+    def label(self):
+        return f"page {self.page}" + (f" ({self.caption})" if self.caption else "")
+
+    def as_dict(self):
+        return {"page": self.page, "caption": self.caption}
+
+
+class PhotoAnalysis:
+    """The report's photos and the groups of photos that are the same picture."""
+
+    def __init__(self, photos, groups, skipped=0):
+        self.photos = photos
+        self.groups = groups  # [[index into photos, ...]], each with two or more photos
+        self.skipped = skipped  # images that could not be decoded
+
+    def matching(self, pattern, exclude=None):
+        """Indexes of photos whose caption matches `pattern` and not `exclude` (case-insensitive)."""
+        regex = re.compile(pattern, re.IGNORECASE)
+        excluded = re.compile(exclude, re.IGNORECASE) if exclude else None
+        return [
+            index for index, photo in enumerate(self.photos)
+            if regex.search(photo.caption) and not (excluded and excluded.search(photo.caption))
+        ]
+
+    def duplicates_among(self, indexes):
+        """Duplicate groups restricted to `indexes`; only groups still holding two photos are kept."""
+        wanted = set(indexes)
+        groups = []
+        for group in self.groups:
+            members = [index for index in group if index in wanted]
+            if len(members) > 1:
+                groups.append([self.photos[index] for index in members])
+        return groups
+
+    def summary(self):
+        return [[self.photos[index].as_dict() for index in group] for group in self.groups]
+
+
+def _multiply(m, n):
+    """PDF matrix product: m applied first, then n."""
+    return (
+        m[0] * n[0] + m[1] * n[2],
+        m[0] * n[1] + m[1] * n[3],
+        m[2] * n[0] + m[3] * n[2],
+        m[2] * n[1] + m[3] * n[3],
+        m[4] * n[0] + m[5] * n[2] + n[4],
+        m[4] * n[1] + m[5] * n[3] + n[5],
+    )
+
+
+def _bbox(ctm):
+    # Images are drawn into the unit square, mapped to the page by the current matrix.
+    corners = [(0, 0), (1, 0), (0, 1), (1, 1)]
+    xs = [x * ctm[0] + y * ctm[2] + ctm[4] for x, y in corners]
+    ys = [x * ctm[1] + y * ctm[3] + ctm[5] for x, y in corners]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _placed_images(reader, content, resources, ctm, depth=0):
+    """Yield (xobject, name, bbox) for every image drawn by a content stream, following form XObjects."""
+    from pypdf.generic import ContentStream
+
+    xobjects = resources.get("/XObject") if resources else None
+    xobjects = xobjects.get_object() if xobjects is not None else {}
+    stack = []
+    for operands, operator in ContentStream(content, reader).operations:
+        if operator == b"q":
+            stack.append(ctm)
+        elif operator == b"Q":
+            ctm = stack.pop() if stack else ctm
+        elif operator == b"cm":
+            ctm = _multiply([float(value) for value in operands], ctm)
+        elif operator == b"Do" and operands and operands[0] in xobjects:
+            xobject = xobjects[operands[0]].get_object()
+            subtype = xobject.get("/Subtype")
+            if subtype == "/Image":
+                yield xobject, str(operands[0]), _bbox(ctm)
+            elif subtype == "/Form" and depth < MAX_FORM_DEPTH:
+                matrix = [float(value) for value in xobject.get("/Matrix", [1, 0, 0, 1, 0, 0])]
+                form_resources = xobject.get("/Resources")
+                yield from _placed_images(
+                    reader, xobject, form_resources.get_object() if form_resources is not None else resources,
+                    _multiply(matrix, ctm), depth + 1)
+
+
+def _filters(xobject):
+    filters = xobject.get("/Filter")
+    if filters is None:
+        return []
+    filters = filters.get_object()
+    return [str(name) for name in filters] if isinstance(filters, list) else [str(filters)]
+
+
+def _components(color_space):
+    color_space = color_space.get_object() if color_space is not None else None
+    if isinstance(color_space, list) and color_space:
+        if str(color_space[0]) == "/ICCBased":
+            return int(color_space[1].get_object().get("/N", 3))
+        return None  # Indexed, Separation, ... are not used for photos
+    return _COMPONENTS.get(str(color_space))
+
+
+def _grey_pixels(xobject):
+    """The image as a 2-D float array of grey levels, or None when it cannot be decoded here."""
+    import numpy as np
+
+    if xobject.get("/ImageMask"):
+        return None
+    filters = _filters(xobject)
+    data = xobject.get_data()
+    if filters and filters[-1] in ("/DCTDecode", "/JPXDecode"):
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+        image = Image.open(io.BytesIO(data))
+        # JPEGs decode straight to a reduced size, which is all the hash needs.
+        image.draft("L", (HASH_SOURCE_SIZE * 4, HASH_SOURCE_SIZE * 4))
+        return np.asarray(image.convert("L"), dtype=np.float32)
+    width, height = int(xobject["/Width"]), int(xobject["/Height"])
+    components = _components(xobject.get("/ColorSpace"))
+    if components is None or int(xobject.get("/BitsPerComponent", 8)) != 8 or len(data) < width * height * components:
+        return None
+    pixels = np.frombuffer(data, dtype=np.uint8, count=width * height * components).reshape(height, width, components)
+    pixels = pixels.astype(np.float32)
+    if components == 1:
+        return pixels[:, :, 0]
+    if components == 4:
+        pixels = (255 - pixels[:, :, :3]) * (1 - pixels[:, :, 3:] / 255)  # CMYK -> RGB, roughly
+    return pixels[:, :, :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _shrink(pixels, size=HASH_SOURCE_SIZE):
+    """Area-average a grey image down to size x size."""
+    import numpy as np
+
+    height, width = pixels.shape
+    rows = np.linspace(0, height, size + 1).astype(int)[:-1]
+    columns = np.linspace(0, width, size + 1).astype(int)[:-1]
+    sums = np.add.reduceat(np.add.reduceat(pixels, rows, axis=0), columns, axis=1)
+    counts = np.outer(np.diff(np.append(rows, height)), np.diff(np.append(columns, width)))
+    return sums / counts
+
+
+def _dct_matrix(size):
+    import numpy as np
+
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def perceptual_hashes(images):
+    """64-bit DCT hashes of a stack of HASH_SOURCE_SIZE-square grey images, as (N, 8) uint8."""
+    import numpy as np
+
+    dct = _dct_matrix(HASH_SOURCE_SIZE)
+    coefficients = dct @ images @ dct.T  # all images at once
+    low = coefficients[:, :HASH_SIZE, :HASH_SIZE].reshape(len(images), -1)
+    # The DC term only reflects overall brightness, so it is left out of the median.
+    medians = np.median(low[:, 1:], axis=1, keepdims=True)
+    return np.packbits(low > medians, axis=1)
+
+
+_POPCOUNT = None
+
+
+def hamming_distances(hashes):
+    """(N, N) matrix of bit differences between packed hashes."""
+    import numpy as np
+
+    global _POPCOUNT
+    if _POPCOUNT is None:
+        _POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+    return _POPCOUNT[hashes[:, None, :] ^ hashes[None, :, :]].sum(axis=2, dtype=np.int32)
+
+
+def duplicate_groups(distances, threshold=PHOTO_HASH_DISTANCE):
+    """Single-linkage clusters of images within `threshold` bits of each other."""
+    import numpy as np
+
+    parent = list(range(len(distances)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for first, second in np.argwhere(np.triu(distances <= threshold, 1)):
+        parent[find(int(first))] = find(int(second))
+    clusters = {}
+    for index in range(len(distances)):
+        clusters.setdefault(find(index), []).append(index)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def _caption(bbox, lines):
+    """Text printed just below the image (or, failing that, just above it) within its width."""
+    x0, y0, x1, y1 = bbox
+    below, above = [], []
+    for line in lines:
+        cells = [cell for cell in line if x0 - 2 <= cell.x <= x1]
+        if not cells:
+            continue
+        y = cells[0].y
+        if y0 - CAPTION_DISTANCE <= y <= y0:
+            below.append((y0 - y, cells))
+        elif y1 <= y <= y1 + CAPTION_DISTANCE:
+            above.append((y - y1, cells))
+    for candidates in (below, above):
+        if candidates:
+            return " ".join(cell.text for cell in min(candidates, key=lambda item: item[0])[1])
+    return ""
+
+
+def analyze_pdf_photos(reader):
+    import numpy as np
+
+    photos, shrunk = [], []
+    skipped = 0
+    seen = set()  # an image drawn twice at the same spot counts once
+    for number, page in enumerate(reader.pages, start=1):
+        placements = []
+        for xobject, name, bbox in _placed_images(reader, page.get_contents(), page.get("/Resources"), (1, 0, 0, 1, 0, 0)):
+            if min(bbox[2] - bbox[0], bbox[3] - bbox[1]) < PHOTO_MIN_DRAWN:
+                continue
+            if min(int(xobject.get("/Width", 0)), int(xobject.get("/Height", 0))) < PHOTO_MIN_SIDE:
+                continue
+            placements.append((xobject, name, bbox))
+        if not placements:
+            continue
+        lines = page_lines(page)
+        for xobject, name, bbox in placements:
+            key = (number, id(xobject), tuple(round(value) for value in bbox))
+            if key in seen:
+                continue
+            seen.add(key)
+            try:
+                pixels = _grey_pixels(xobject)
+            except Exception as e:
+                print(f"Could not decode image {name} on page {number}: {e}")
+                pixels = None
+            if pixels is None:
+                skipped += 1
+                continue
+            small = _shrink(pixels)
+            if small.std() < PHOTO_MIN_CONTRAST:
+                continue
+            photos.append(Photo(number, name, bbox, _caption(bbox, lines)))
+            shrunk.append(small)
+    if not photos:
+        return PhotoAnalysis([], [], skipped)
+    hashes = perceptual_hashes(np.stack(shrunk))
+    return PhotoAnalysis(photos, duplicate_groups(hamming_distances(hashes)), skipped)
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def analyze_photos(pdf_bytes, pdf_sha256: str):
+    """Return the document's PhotoAnalysis, or None when its photos cannot be checked locally."""
+    if not PHOTO_HASHING:
+        return None
+    with _cache_lock:
+        if pdf_sha256 in _cache:
+            return _cache[pdf_sha256]
+    try:
+        import pypdf  # imported on first use to keep it out of cold starts
+
+        analysis = analyze_pdf_photos(pypdf.PdfReader(io.BytesIO(pdf_bytes)))
+        if analysis.skipped:
+            # A partial set of photos could hide a duplicate, so the model keeps the checks.
+            print(f"Photo hashing could not decode {analysis.skipped} image(s) (JPEGs need Pillow); "
+                  "leaving photo checks to the model.")
+            analysis = None
+    except Exception as e:
+        print(f"Photo hashing unavailable, leaving photo checks to the model: {e}")
+        analysis = None
+    with _cache_lock:
+        _cache[pdf_sha256] = analysis
+        _cache.move_to_end(pdf_sha256)
+        while len(_cache) > PHOTO_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return analysis
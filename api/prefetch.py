@@ -0,0 +1,114 @@
+import asyncio
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+try:
+    from .scheduler import model_scheduler
+except ImportError:
+    from scheduler import model_scheduler
+
+# After the first per-category request for a document, extract its other sections in the
+# background so the page's later requests are served from the cache.
+PREFETCH = os.getenv("PREFETCH", "1") == "1"
+# Prefetch calls running at once, across all documents.
+PREFETCH_MAX_IN_FLIGHT = int(os.getenv("PREFETCH_MAX_IN_FLIGHT", "2"))
+# Documents remembered (so each is prefetched once) and prefetched at the same time.
+PREFETCH_MAX_DOCUMENTS = int(os.getenv("PREFETCH_MAX_DOCUMENTS", "64"))
+PREFETCH_MAX_ACTIVE_DOCUMENTS = int(os.getenv("PREFETCH_MAX_ACTIVE_DOCUMENTS", "4"))
+# How often a waiting prefetch call re-checks for spare capacity.
+PREFETCH_POLL_SECONDS = 0.2
+
+
+class Prefetcher:
+    """Runs low-priority background work without getting in the way of requests.
+
+    A prefetch call only starts while no request's model call is waiting for the scheduler
+    and at least one scheduler slot stays free, and at most `max_in_flight` run at once.
+    """
+
+    def __init__(self, scheduler=model_scheduler, enabled=PREFETCH, max_in_flight=PREFETCH_MAX_IN_FLIGHT,
+                 max_documents=PREFETCH_MAX_DOCUMENTS, max_active=PREFETCH_MAX_ACTIVE_DOCUMENTS):
+        self.scheduler = scheduler
+        self.enabled = enabled
+        self.max_in_flight = max_in_flight
+        self.max_documents = max_documents
+        self.max_active = max_active
+        self.in_flight = 0
+        self.scheduled = 0
+        self.skipped = 0
+        self.completed = 0
+        self._loop = None
+        self._seen = OrderedDict()  # document key -> True, oldest first
+        self._tasks = set()  # strong references; the event loop only keeps weak ones
+
+    def _bind_loop(self):
+        # Tasks belong to one event loop; forget those from a previous loop (e.g. test clients).
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._tasks = set()
+
+    def _has_capacity(self):
+        stats = self.scheduler.stats()
+        return (
+            self.in_flight < self.max_in_flight
+            and stats["queued"] == 0
+            and stats["in_flight"] < stats["window"] - 1
+        )
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for spare capacity, then hold one prefetch slot."""
+        while not self._has_capacity():
+            await asyncio.sleep(PREFETCH_POLL_SECONDS)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def schedule(self, key, work) -> bool:
+        """Start `work()` (a coroutine function) in the background unless `key` was seen before."""
+        if not self.enabled or key in self._seen:
+            return False
+        self._bind_loop()
+        if len(self._tasks) >= self.max_active:
+            self.skipped += 1
+            return False
+        self._seen[key] = True
+        while len(self._seen) > self.max_documents:
+            self._seen.popitem(last=False)
+        task = asyncio.ensure_future(self._run(key, work))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.scheduled += 1
+        return True
+
+    async def _run(self, key, work):
+        try:
+            await work()
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Prefetching is best effort; the request for the section will try again.
+            print(f"Prefetch for {key} failed: {e}")
+            self._seen.pop(key, None)
+
+    async def cancel_all(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "active_documents": len(self._tasks),
+            "scheduled": self.scheduled,
+            "skipped": self.skipped,
+            "completed": self.completed,
+        }
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import random
+import re
+
+MODEL_CALL_ATTEMPTS = int(os.getenv("MODEL_CALL_ATTEMPTS", "3"))
+MODEL_CALL_TIMEOUT_SECONDS = float(os.getenv("MODEL_CALL_TIMEOUT_SECONDS", "90"))
+MODEL_RETRY_BASE_DELAY = float(os.getenv("MODEL_RETRY_BASE_DELAY", "1.0"))
+MODEL_RETRY_MAX_DELAY = float(os.getenv("MODEL_RETRY_MAX_DELAY", "20.0"))
+# Start a duplicate request when the first has not answered after this many seconds; 0 disables hedging.
+MODEL_HEDGE_AFTER_SECONDS = float(os.getenv("MODEL_HEDGE_AFTER_SECONDS", "0"))
+# Upper bound on how long a retry-after hint can hold calls back.
+MODEL_RETRY_AFTER_MAX_SECONDS = float(os.getenv("MODEL_RETRY_AFTER_MAX_SECONDS", "60"))
+
+# "Please retry in 23.5s." / "retry_delay { seconds: 23 }" in quota error messages.
+_RETRY_IN_PATTERN = re.compile(r"retry in ([0-9.]+)\s*(ms|s)\b", re.IGNORECASE)
+_RETRY_DELAY_PATTERN = re.compile(r"retry_delay\s*\{\s*seconds:\s*([0-9]+)")
+
+
+class ModelCallTimeout(TimeoutError):
+    pass
+
+
+class ModelCallFailed(Exception):
+    """Raised when a model call still fails after all retries."""
+
+    def __init__(self, label, attempts, cause):
+        super().__init__(f"{label} failed after {attempts} attempt(s): {cause}")
+        self.label = label
+        self.attempts = attempts
+        self.cause = cause
+
+
+def _google_exceptions():
+    try:
+        from google.api_core import exceptions as google_exceptions
+    except ImportError:
+        return None
+    return google_exceptions
+
+
+def is_quota_error(exc) -> bool:
+    if isinstance(exc, ModelCallFailed):
+        exc = exc.cause
+    google_exceptions = _google_exceptions()
+    return google_exceptions is not None and isinstance(exc, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests))
+
+
+def retry_after_seconds(exc):
+    """Seconds the service asked us to wait before calling again, or None when it did not say."""
+    if isinstance(exc, ModelCallFailed):
+        exc = exc.cause
+    seconds = getattr(exc, "retry_after", None)
+    if seconds is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+        value = headers.get("retry-after") if hasattr(headers, "get") else None
+        try:
+            seconds = float(value) if value else None
+        except ValueError:
+            seconds = None  # an HTTP date; rare enough to fall back to backoff
+    if seconds is None:
+        for detail in getattr(exc, "details", None) or []:
+            delay = getattr(detail, "retry_delay", None)
+            if delay is not None:
+                seconds = delay.seconds + delay.nanos / 1e9
+                break
+    if seconds is None:
+        message = str(exc)
+        match = _RETRY_IN_PATTERN.search(message)
+        if match:
+            seconds = float(match.group(1)) / (1000 if match.group(2).lower() == "ms" else 1)
+        else:
+            match = _RETRY_DELAY_PATTERN.search(message)
+            seconds = float(match.group(1)) if match else None
+    if seconds is None or seconds <= 0:
+        return None
+    return min(float(seconds), MODEL_RETRY_AFTER_MAX_SECONDS)
+
+
+def is_retryable(exc) -> bool:
+    if isinstance(exc, (ModelCallTimeout, ConnectionError)):
+        return True
+    google_exceptions = _google_exceptions()
+    if google_exceptions is None:
+        return False
+    return isinstance(exc, (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.GatewayTimeout,
+    ))
+
+
+def backoff_delay(attempt: int, base_delay=MODEL_RETRY_BASE_DELAY, max_delay=MODEL_RETRY_MAX_DELAY) -> float:
+    # "Full jitter": spreads retries from concurrent requests instead of retrying in lockstep.
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+async def with_deadline(awaitable, timeout=MODEL_CALL_TIMEOUT_SECONDS):
+    if not timeout:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise ModelCallTimeout(f"model call exceeded {timeout:.0f}s") from None
+
+
+async def hedged(call, hedge_after=MODEL_HEDGE_AFTER_SECONDS, on_hedge=None, acquire=None):
+    """Run `call()`; if it is still pending after `hedge_after` seconds, race a duplicate.
+
+    The first successful result wins and the other request is cancelled. `acquire()`, when
+    given, reserves capacity for the duplicate and returns the function that releases it,
+    or None to skip the hedge. `on_hedge()` is called when the duplicate is actually sent.
+    """
+    if not hedge_after:
+        return await call()
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        release = None
+        if not done:
+            release = acquire() if acquire is not None else (lambda: None)
+        if release is not None:
+            duplicate = asyncio.ensure_future(call())
+            duplicate.add_done_callback(lambda _: release())
+            tasks.append(duplicate)
+            if on_hedge is not None:
+                on_hedge()
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call_with_retries(call, label, attempts=MODEL_CALL_ATTEMPTS):
+    """Await `call()` with jittered exponential backoff on retryable errors.
+
+    Returns (result, attempts_used); raises ModelCallFailed once the attempts are exhausted
+    or the error is not retryable.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await call(), attempt
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if attempt >= attempts or not is_retryable(e):
+                raise ModelCallFailed(label, attempt, e) from e
+            delay = max(backoff_delay(attempt - 1), retry_after_seconds(e) or 0.0)
+            print(f"Model call for {label} failed ({type(e).__name__}); retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
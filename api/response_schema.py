@@ -0,0 +1,151 @@
+import json
+import os
+
+# Ask the model for JSON constrained to a schema built from the field lists.
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "1") == "1"
+# Comparable columns allowed in the sales / rent grid schemas.
+GRID_MAX_COMPARABLES = int(os.getenv("GRID_MAX_COMPARABLES", "9"))
+
+STRING_SCHEMA = {"type": "STRING"}
+CHOICE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "choice": {"type": "STRING", "enum": ["did", "did not", ""]},
+        "comment": {"type": "STRING"},
+    },
+    "required": ["choice"],
+}
+YES_NO_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "choice": {"type": "STRING", "enum": ["Yes", "No", ""]},
+        "comment": {"type": "STRING"},
+    },
+    "required": ["choice"],
+}
+
+
+def field_schema(field_name):
+    # Matches COMPLEX_FIELD_INSTRUCTIONS: 'did did not' fields and Yes/No questions answer with a
+    # choice/comment object (a bare Yes/No is turned back into a string when parsed). The empty
+    # choice keeps the prompt's "missing fields are ''" rule for questions the report never asks.
+    if "did did not" in field_name.lower():
+        return CHOICE_SCHEMA
+    if field_name.strip().endswith("?"):
+        return YES_NO_SCHEMA
+    return STRING_SCHEMA
+
+
+def object_schema(properties, required=None):
+    schema = {"type": "OBJECT", "properties": properties}
+    required = list(properties) if required is None else required
+    if required:
+        schema["required"] = required
+    return schema
+
+
+def category_schema(keyed_fields):
+    """Schema for one category from [(response key, field name)]; every key is required."""
+    return object_schema({key: field_schema(field_name) for key, field_name in keyed_fields})
+
+
+def grid_schema(column_label, fields, max_comparables=GRID_MAX_COMPARABLES):
+    """Schema for the sales / rent grids: a 'Subject' column plus '<column_label> #N' columns."""
+    column = object_schema({field: STRING_SCHEMA for field in dict.fromkeys(fields)})
+    properties = {"Subject": column}
+    for number in range(1, max_comparables + 1):
+        properties[f"{column_label} #{number}"] = column
+    return object_schema(properties, required=["Subject"])
+
+
+def batch_schema(schemas_by_group):
+    return object_schema(dict(schemas_by_group))
+
+
+def generation_config(schema=None, json_output=True):
+    if not STRUCTURED_OUTPUT or not json_output:
+        return None
+    config = {"response_mime_type": "application/json"}
+    if schema is not None:
+        config["response_schema"] = schema
+    return config
+
+
+def _strip_fences(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[3:]
+        if text[:4].lower() == "json":
+            text = text[4:]
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text.strip()
+
+
+def _close_truncated(text):
+    """Yield repaired candidates for JSON cut off mid-stream, longest first.
+
+    Each candidate ends at a point where the preceding value was complete (before a comma,
+    or after a closing bracket) with the brackets still open at that point closed.
+    """
+    stack = []
+    cut_points = []
+    in_string = escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            cut_points.append((index + 1, "".join(reversed(stack))))
+        elif char == ",":
+            cut_points.append((index, "".join(reversed(stack))))
+    if not in_string and stack:
+        yield text + "".join(reversed(stack))
+    for end, closing in reversed(cut_points[-64:]):
+        yield text[:end] + closing
+
+
+def parse_json_object(raw_text):
+    """Parse a model answer into a dict, tolerating fences, trailing prose and truncation.
+
+    Returns (data, complete): data is None when no JSON object could be recovered, and
+    complete is False when the object was salvaged from a truncated response.
+    """
+    if not raw_text:
+        return None, False
+    text = _strip_fences(raw_text)
+    try:
+        data = json.loads(text)
+        return (data, True) if isinstance(data, dict) else (None, False)
+    except json.JSONDecodeError:
+        pass
+    start = text.find("{")
+    if start < 0:
+        return None, False
+    text = text[start:]
+    try:
+        # An object followed by extra prose.
+        data, _ = json.JSONDecoder().raw_decode(text)
+        if isinstance(data, dict):
+            return data, True
+    except json.JSONDecodeError:
+        pass
+    for candidate in _close_truncated(text):
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, dict):
+            return data, False
+    return None, False
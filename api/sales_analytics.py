@@ -0,0 +1,403 @@
+import os
+import re
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+
+# Fannie Mae's long-standing review thresholds for net / gross adjustments, in percent of sale price.
+NET_ADJUSTMENT_LIMIT = float(os.getenv("NET_ADJUSTMENT_LIMIT", "15"))
+GROSS_ADJUSTMENT_LIMIT = float(os.getenv("GROSS_ADJUSTMENT_LIMIT", "25"))
+# A comparable whose adjusted price is this far (fraction) from the report's median is flagged.
+ADJUSTED_PRICE_DEVIATION = float(os.getenv("ADJUSTED_PRICE_DEVIATION", "0.15"))
+# Modified z-score above which a comparable's price per square foot is an outlier.
+OUTLIER_Z_SCORE = 3.5
+# Reported totals may differ from the sum of the adjustments by rounding only.
+TOTAL_TOLERANCE = 1.0
+# Per-unit adjustment rates spreading more than this (fraction of the median rate) are inconsistent.
+RATE_SPREAD_LIMIT = 0.5
+
+COMPARABLE_COLUMN = re.compile(r"^COMPARABLE SALE\s*#\s*(\d+)$", re.IGNORECASE)
+NET_FIELD = "Net Adjustment (Total)"
+ADJUSTED_PRICE_FIELD = "Adjusted Sale Price of Comparable"
+PRICE_FIELD = "Sale Price"
+GLA_FIELD = "Gross Living Area"
+PRIOR_DATE_FIELD = "Date of Prior Sale/Transfer"
+PRIOR_PRICE_FIELD = "Price of Prior Sale/Transfer"
+# The grid's adjusted rows; "Above Grade Room Count" has no description row of its own.
+ADJUSTMENT_FEATURES = [
+    "Sale or Financing Concessions", "Date of Sale/Time", "Location", "Leasehold/Fee Simple", "Site", "View",
+    "Design (Style)", "Quality of Construction", "Actual Age", "Condition", "Bedrooms", "Baths",
+    "Above Grade Room Count", "Gross Living Area", "Basement & Finished Rooms Below Grade", "Functional Utility",
+    "Heating/Cooling", "Energy Efficient Items", "Garage/Carport", "Porch/Patio/Deck",
+]
+# Features whose description is a quantity, so the adjustment implies a rate per unit.
+# Site is left out: reports mix square feet and acres.
+NUMERIC_FEATURES = ["Gross Living Area", "Actual Age", "Bedrooms", "Baths"]
+
+ROOM_COUNT = ADJUSTMENT_FEATURES.index("Above Grade Room Count")
+ROOM_DETAILS = [ADJUSTMENT_FEATURES.index("Bedrooms"), ADJUSTMENT_FEATURES.index("Baths")]
+NUMERIC_ADJUSTMENTS = [ADJUSTMENT_FEATURES.index(feature) for feature in NUMERIC_FEATURES]
+
+# Every grid row read as an amount.
+_AMOUNT_FIELDS = list(dict.fromkeys(
+    [PRICE_FIELD, NET_FIELD, ADJUSTED_PRICE_FIELD, PRIOR_PRICE_FIELD]
+    + [f"{feature} Adjustment" for feature in ADJUSTMENT_FEATURES] + NUMERIC_FEATURES
+))
+
+_NUMBER = re.compile(r"-?\d[\d,]*(?:\.\d+)?|-?\.\d+")
+
+
+def parse_amount(value):
+    """'$310,000' -> 310000.0, '-5,000' / '(5,000)' -> -5000.0; nan when there is no number."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, str):
+        return np.nan
+    text = value.strip().replace("$", "").replace(" ", "")
+    match = _NUMBER.search(text)
+    if match is None:
+        return np.nan
+    number = float(match.group(0).replace(",", ""))
+    if number > 0 and text.startswith("(") and text.endswith(")"):
+        number = -number
+    return number
+
+
+def _description(value):
+    if not isinstance(value, str):
+        return ""
+    return re.sub(r"\s+", " ", value).strip().lower()
+
+
+def grid_columns(fields):
+    """(subject column, [(label, column)]) from an extraction's merged fields, comparables in order."""
+    comparables = []
+    for key, column in (fields or {}).items():
+        match = COMPARABLE_COLUMN.match(str(key).strip())
+        if match and isinstance(column, dict):
+            comparables.append((int(match.group(1)), key, column))
+    comparables.sort()
+    subject = fields.get("Subject") if isinstance((fields or {}).get("Subject"), dict) else {}
+    return subject, [(key, column) for _, key, column in comparables]
+
+
+class SalesGridArrays:
+    """The sales grids of many reports as padded numeric arrays (reports x comparables [x features]).
+
+    Missing cells are nan, missing comparables are masked out by `present`, and the
+    descriptions are integer codes shared by every report (-1 when blank).
+    """
+
+    def __init__(self, reports):
+        grids = [grid_columns(fields) for fields in reports]
+        self.labels = [[label for label, _ in comparables] for _, comparables in grids]
+        self.report_count = len(grids)
+        self.comparable_count = max([len(labels) for labels in self.labels] + [0])
+        shape = (self.report_count, self.comparable_count)
+        self.present = np.zeros(shape, dtype=bool)
+        for report, labels in enumerate(self.labels):
+            self.present[report, :len(labels)] = True
+
+        # One pass over every column: amounts into a (reports, comparables, fields) table and
+        # descriptions into integer codes. Cell texts recur, so both are memoised.
+        amounts, codes = {}, {"": -1}
+
+        def amount(value):
+            if not isinstance(value, str):
+                return parse_amount(value)
+            if value not in amounts:
+                amounts[value] = parse_amount(value)
+            return amounts[value]
+
+        described = {}
+
+        def code(value):
+            value = value if isinstance(value, str) else ""
+            if value not in described:
+                described[value] = codes.setdefault(_description(value), len(codes) - 1)
+            return described[value]
+
+        table = np.full(shape + (len(_AMOUNT_FIELDS),), np.nan)
+        self.descriptions = np.full(shape + (len(ADJUSTMENT_FEATURES),), -1, dtype=np.int64)
+        self.subject_descriptions = np.full((self.report_count, len(ADJUSTMENT_FEATURES)), -1, dtype=np.int64)
+        self.subject_numeric = np.full((self.report_count, len(NUMERIC_FEATURES)), np.nan)
+        for report, (subject, comparables) in enumerate(grids):
+            self.subject_numeric[report] = [amount(subject.get(feature)) for feature in NUMERIC_FEATURES]
+            self.subject_descriptions[report] = [code(subject.get(feature)) for feature in ADJUSTMENT_FEATURES]
+            if comparables:
+                table[report, :len(comparables)] = [
+                    [amount(column.get(field)) for field in _AMOUNT_FIELDS] for _, column in comparables]
+                self.descriptions[report, :len(comparables)] = [
+                    [code(column.get(feature)) for feature in ADJUSTMENT_FEATURES]
+                    for _, column in comparables]
+        columns = {field: index for index, field in enumerate(_AMOUNT_FIELDS)}
+        self.sale_price = table[:, :, columns[PRICE_FIELD]]
+        self.reported_net = table[:, :, columns[NET_FIELD]]
+        self.reported_adjusted = table[:, :, columns[ADJUSTED_PRICE_FIELD]]
+        self.gla = table[:, :, columns[GLA_FIELD]]
+        self.prior_price = table[:, :, columns[PRIOR_PRICE_FIELD]]
+        self.adjustments = table[:, :, [columns[f"{feature} Adjustment"] for feature in ADJUSTMENT_FEATURES]]
+        self.numeric = table[:, :, [columns[feature] for feature in NUMERIC_FEATURES]]
+        self.prior_date = [[column.get(PRIOR_DATE_FIELD, "") for _, column in comparables] for _, comparables in grids]
+
+
+@contextmanager
+def _quiet():
+    # All-nan slices (reports with fewer comparables, blank cells) and divisions by zero are
+    # expected; they produce nan, which the flags treat as "not flagged".
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        yield
+
+
+def compute_analytics(grid):
+    """Every analytic for every comparable of every report, as arrays."""
+    adjustments = grid.adjustments
+    adjusted = ~np.isnan(adjustments) & (adjustments != 0)
+    # On the form, bedrooms and baths share the room-count row's single adjustment cell;
+    # when that cell was read, the per-item values repeat it and must not be counted twice.
+    counted = adjustments.copy()
+    room_row = ~np.isnan(adjustments[:, :, ROOM_COUNT])[:, :, None]
+    counted[:, :, ROOM_DETAILS] = np.where(room_row, np.nan, adjustments[:, :, ROOM_DETAILS])
+    with _quiet():
+        net = np.where(grid.present, np.nansum(counted, axis=2), np.nan)
+        gross = np.where(grid.present, np.nansum(np.abs(counted), axis=2), np.nan)
+        net_pct = net / grid.sale_price * 100
+        gross_pct = gross / grid.sale_price * 100
+        adjusted_price = grid.sale_price + net
+        price_per_gla = np.where(grid.gla > 0, grid.sale_price / grid.gla, np.nan)
+        prior_change_pct = (grid.sale_price - grid.prior_price) / grid.prior_price * 100
+
+        median_adjusted = np.nanmedian(adjusted_price, axis=1)
+        price_deviation = (adjusted_price - median_adjusted[:, None]) / median_adjusted[:, None]
+
+        median_ppsf = np.nanmedian(price_per_gla, axis=1)
+        mad = np.nanmedian(np.abs(price_per_gla - median_ppsf[:, None]), axis=1)
+        mad = np.maximum(mad, 0.01 * median_ppsf)  # identical comps would otherwise divide by zero
+        ppsf_z = 0.6745 * (price_per_gla - median_ppsf[:, None]) / mad[:, None]
+
+        # Implied rate per unit of difference from the subject (e.g. $ per square foot of GLA).
+        difference = grid.subject_numeric[:, None, :] - grid.numeric
+        numeric_adjustments = adjustments[:, :, NUMERIC_ADJUSTMENTS]
+        rates = np.where((difference != 0) & (numeric_adjustments != 0), numeric_adjustments / difference, np.nan)
+        median_rate = np.nanmedian(rates, axis=1)
+        highest = np.max(np.where(np.isnan(rates), -np.inf, rates), axis=1, initial=-np.inf)
+        lowest = np.min(np.where(np.isnan(rates), np.inf, rates), axis=1, initial=np.inf)
+        rate_spread = (highest - lowest) / np.abs(median_rate)
+        rate_spread = np.where(np.isfinite(rate_spread), rate_spread, np.nan)
+    majority_sign = np.sign(median_rate)[:, None, :]
+    wrong_direction = ~np.isnan(rates) & (majority_sign != 0) & (np.sign(rates) != majority_sign)
+
+    # Descriptions: adjusted although it matches the subject, or comps described alike but adjusted differently.
+    described = grid.descriptions >= 0
+    same_as_subject = described & (grid.descriptions == grid.subject_descriptions[:, None, :])
+    adjusted_like_subject = same_as_subject & adjusted
+    amounts = np.nan_to_num(adjustments)
+    pairs_alike = described[:, :, None, :] & (grid.descriptions[:, :, None, :] == grid.descriptions[:, None, :, :])
+    pairs_differ = pairs_alike & (amounts[:, :, None, :] != amounts[:, None, :, :])
+    pairs_differ &= ~np.eye(grid.comparable_count, dtype=bool)[None, :, :, None]
+    inconsistent_with_peer = pairs_differ.any(axis=2)
+
+    return {
+        "net": net,
+        "gross": gross,
+        "net_pct": net_pct,
+        "gross_pct": gross_pct,
+        "adjusted_price": adjusted_price,
+        "price_per_gla": price_per_gla,
+        "prior_change_pct": prior_change_pct,
+        "price_deviation": price_deviation,
+        "ppsf_z": ppsf_z,
+        "net_over_limit": np.abs(net_pct) > NET_ADJUSTMENT_LIMIT,
+        "gross_over_limit": gross_pct > GROSS_ADJUSTMENT_LIMIT,
+        "price_outlier": np.abs(price_deviation) > ADJUSTED_PRICE_DEVIATION,
+        "ppsf_outlier": np.abs(ppsf_z) > OUTLIER_Z_SCORE,
+        "net_mismatch": np.abs(grid.reported_net - net) > TOTAL_TOLERANCE,
+        "adjusted_mismatch": np.abs(grid.reported_adjusted - adjusted_price) > TOTAL_TOLERANCE,
+        "adjusted": adjusted,
+        "rates": rates,
+        "median_rate": median_rate,
+        "rate_spread": rate_spread,
+        "wrong_direction": wrong_direction,
+        "adjusted_like_subject": adjusted_like_subject,
+        "inconsistent_with_peer": inconsistent_with_peer,
+    }
+
+
+def _number(value, digits=2):
+    return None if value is None or value != value or value in (float("inf"), float("-inf")) else round(value, digits)
+
+
+# Analytics with one value per report and feature rather than per comparable.
+_PER_FEATURE = ("median_rate", "rate_spread")
+
+
+class _ReportView:
+    """One report's rows of the analytics arrays as plain lists, so building the JSON does
+    not index NumPy arrays element by element."""
+
+    def __init__(self, grid, lists, report):
+        self.labels = grid.labels[report]
+        count = len(self.labels)
+        self.rows = {name: values[report][:count] for name, values in lists["rows"].items()}
+        self.features = {name: values[report] for name, values in lists["features"].items()}
+        self.prior_date = grid.prior_date[report]
+
+
+def _as_lists(grid, analytics):
+    # One tolist() per array for all reports instead of per-element NumPy indexing.
+    rows = {name: values.tolist() for name, values in analytics.items() if values.ndim >= 2 and name not in _PER_FEATURE}
+    for name in ("sale_price", "reported_net", "reported_adjusted", "prior_price"):
+        rows[name] = getattr(grid, name).tolist()
+    return {"rows": rows, "features": {name: analytics[name].tolist() for name in _PER_FEATURE}}
+
+
+def _flags(view, comparable):
+    row = {name: values[comparable] for name, values in view.rows.items()}
+    flags = []
+    if row["net_over_limit"]:
+        flags.append(f"Net adjustment {row['net_pct']:.1f}% exceeds {NET_ADJUSTMENT_LIMIT:g}%")
+    if row["gross_over_limit"]:
+        flags.append(f"Gross adjustment {row['gross_pct']:.1f}% exceeds {GROSS_ADJUSTMENT_LIMIT:g}%")
+    if row["price_outlier"]:
+        flags.append(f"Adjusted sale price is {row['price_deviation'] * 100:+.1f}% from the median comparable")
+    if row["ppsf_outlier"]:
+        flags.append("Sale price per square foot is an outlier among the comparables")
+    if row["net_mismatch"]:
+        flags.append(f"Reported net adjustment {row['reported_net']:,.0f} does not match "
+                     f"the sum of adjustments {row['net']:,.0f}")
+    if row["adjusted_mismatch"]:
+        flags.append(f"Reported adjusted sale price {row['reported_adjusted']:,.0f} does not match "
+                     f"{row['adjusted_price']:,.0f}")
+    for index, flagged in enumerate(row["adjusted_like_subject"]):
+        if flagged:
+            flags.append(f"{ADJUSTMENT_FEATURES[index]} is adjusted although it matches the subject")
+    for index, flagged in enumerate(row["wrong_direction"]):
+        if flagged:
+            flags.append(f"{NUMERIC_FEATURES[index]} is adjusted in the opposite direction to the other comparables")
+    return flags
+
+
+def _comparables_where(view, name, index):
+    return [label for label, row in zip(view.labels, view.rows[name]) if row[index]]
+
+
+def _feature_consistency(view):
+    consistency = {}
+    for index, feature in enumerate(ADJUSTMENT_FEATURES):
+        adjusted_count = sum(row[index] for row in view.rows["adjusted"])
+        if not adjusted_count:
+            continue
+        like_subject = _comparables_where(view, "adjusted_like_subject", index)
+        with_peer = _comparables_where(view, "inconsistent_with_peer", index)
+        entry = {
+            "adjusted_comparables": adjusted_count,
+            "adjusted_like_subject": like_subject,
+            "differs_from_alike_comparables": with_peer,
+        }
+        inconsistent = bool(like_subject or with_peer)
+        if feature in NUMERIC_FEATURES:
+            numeric = NUMERIC_FEATURES.index(feature)
+            wrong = _comparables_where(view, "wrong_direction", numeric)
+            spread = _number(view.features["rate_spread"][numeric])
+            entry["rate_per_unit"] = _number(view.features["median_rate"][numeric])
+            entry["rate_spread"] = spread
+            entry["wrong_direction"] = wrong
+            inconsistent = inconsistent or bool(wrong) or (spread is not None and spread > RATE_SPREAD_LIMIT)
+        entry["consistent"] = not inconsistent
+        consistency[feature] = entry
+    return consistency
+
+
+def report_analytics(grid, lists, report):
+    """The get_sales_comparison_data payload for one report of `grid` (`lists` from _as_lists)."""
+    view = _ReportView(grid, lists, report)
+    rows = view.rows
+    table_data, research_data = {}, {}
+    flag_count = 0
+    for comparable, label in enumerate(view.labels):
+        flags = _flags(view, comparable)
+        flag_count += len(flags)
+        table_data[label] = {
+            "sale_price": _number(rows["sale_price"][comparable]),
+            "net_adjustment": _number(rows["net"][comparable]),
+            "gross_adjustment": _number(rows["gross"][comparable]),
+            "net_adjustment_pct": _number(rows["net_pct"][comparable]),
+            "gross_adjustment_pct": _number(rows["gross_pct"][comparable]),
+            "adjusted_sale_price": _number(rows["adjusted_price"][comparable]),
+            "reported_net_adjustment": _number(rows["reported_net"][comparable]),
+            "reported_adjusted_sale_price": _number(rows["reported_adjusted"][comparable]),
+            "price_per_gla": _number(rows["price_per_gla"][comparable]),
+            "flags": flags,
+        }
+        research_data[label] = {
+            "prior_sale_date": view.prior_date[comparable],
+            "prior_sale_price": _number(rows["prior_price"][comparable]),
+            "change_since_prior_sale_pct": _number(rows["prior_change_pct"][comparable]),
+        }
+    adjusted_prices = sorted(price for price in rows["adjusted_price"] if price == price)
+    middle = len(adjusted_prices) // 2
+    additional_data = {
+        "comparables": len(view.labels),
+        "indicated_value_range": [_number(adjusted_prices[0]), _number(adjusted_prices[-1])] if adjusted_prices else None,
+        "mean_adjusted_sale_price": _number(sum(adjusted_prices) / len(adjusted_prices)) if adjusted_prices else None,
+        "median_adjusted_sale_price": _number(
+            adjusted_prices[middle] if len(adjusted_prices) % 2 else sum(adjusted_prices[middle - 1:middle + 1]) / 2
+        ) if adjusted_prices else None,
+        "feature_consistency": _feature_consistency(view),
+        "flag_count": flag_count,
+    }
+    return {"table_data": table_data, "research_data": research_data, "additional_data": additional_data}
+
+
+def analyze_sales_grid(fields):
+    grid = SalesGridArrays([fields])
+    return report_analytics(grid, _as_lists(grid, compute_analytics(grid)), 0)
+
+
+def analyze_portfolio(reports):
+    """Analytics for many reports at once, plus portfolio-wide aggregates."""
+    grid = SalesGridArrays(reports)
+    analytics = compute_analytics(grid)
+    lists = _as_lists(grid, analytics)
+    present = grid.present
+    comparables = int(present.sum())
+
+    def share(flag):
+        return _number(flag[present].mean() * 100) if comparables else None
+
+    feature_rates = {}
+    for index, feature in enumerate(NUMERIC_FEATURES):
+        rates = analytics["rates"][:, :, index][present]
+        rates = rates[~np.isnan(rates)]
+        if rates.size:
+            feature_rates[feature] = {
+                "median_rate_per_unit": _number(np.median(rates)),
+                "p10": _number(np.percentile(rates, 10)),
+                "p90": _number(np.percentile(rates, 90)),
+                "comparables": int(rates.size),
+            }
+    flags_per_report = (
+        analytics["net_over_limit"] | analytics["gross_over_limit"] | analytics["price_outlier"]
+        | analytics["ppsf_outlier"] | analytics["net_mismatch"] | analytics["adjusted_mismatch"]
+        | analytics["adjusted_like_subject"].any(axis=2) | analytics["wrong_direction"].any(axis=2)
+    ).sum(axis=1)
+    with _quiet():
+        median_net_pct = np.nanmedian(analytics["net_pct"][present]) if comparables else np.nan
+        median_gross_pct = np.nanmedian(analytics["gross_pct"][present]) if comparables else np.nan
+    return {
+        "reports": [report_analytics(grid, lists, report) for report in range(grid.report_count)],
+        "portfolio": {
+            "reports": grid.report_count,
+            "comparables": comparables,
+            "median_net_adjustment_pct": _number(float(median_net_pct)),
+            "median_gross_adjustment_pct": _number(float(median_gross_pct)),
+            "net_over_limit_pct": share(analytics["net_over_limit"]),
+            "gross_over_limit_pct": share(analytics["gross_over_limit"]),
+            "price_outlier_pct": share(analytics["price_outlier"]),
+            "total_mismatch_pct": share(analytics["net_mismatch"] | analytics["adjusted_mismatch"]),
+            "feature_rates": feature_rates,
+            "flagged_comparables_per_report": flags_per_report.tolist(),
+        },
+    }
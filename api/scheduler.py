@@ -0,0 +1,365 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+try:
+    from .resilience import ModelCallTimeout, is_quota_error, retry_after_seconds
+except ImportError:
+    from resilience import ModelCallTimeout, is_quota_error, retry_after_seconds
+
+# Process-wide limits shared by every request. Set MODEL_RATE_LIMIT_PER_MINUTE to the
+# model quota (requests per minute); 0 disables the rate limit.
+MODEL_MAX_IN_FLIGHT = int(os.getenv("MODEL_MAX_IN_FLIGHT", "16"))
+MODEL_RATE_LIMIT_PER_MINUTE = float(os.getenv("MODEL_RATE_LIMIT_PER_MINUTE", "300"))
+# Concurrency adapts between MODEL_MIN_IN_FLIGHT and MODEL_MAX_IN_FLIGHT (AIMD): it grows while
+# calls succeed within MODEL_LATENCY_TARGET_SECONDS and shrinks on quota errors and slow calls.
+# With MODEL_ADAPTIVE_CONCURRENCY=0 it stays at MODEL_MAX_IN_FLIGHT.
+MODEL_ADAPTIVE_CONCURRENCY = os.getenv("MODEL_ADAPTIVE_CONCURRENCY", "1") == "1"
+MODEL_MIN_IN_FLIGHT = int(os.getenv("MODEL_MIN_IN_FLIGHT", "1"))
+MODEL_INITIAL_IN_FLIGHT = int(os.getenv("MODEL_INITIAL_IN_FLIGHT", "8"))
+MODEL_LATENCY_TARGET_SECONDS = float(os.getenv("MODEL_LATENCY_TARGET_SECONDS", "60"))
+MODEL_RATE_LIMIT_BURST = int(os.getenv("MODEL_RATE_LIMIT_BURST", str(MODEL_INITIAL_IN_FLIGHT)))
+# Multiplicative decrease after a quota error and after a call slower than the latency target.
+QUOTA_BACKOFF = 0.5
+LATENCY_BACKOFF = 0.8
+
+# Traffic classes, most urgent first. Single sections and custom prompts a reviewer is waiting
+# on are interactive, full reports are standard, portfolios and prefetching are background.
+INTERACTIVE = "interactive"
+STANDARD = "standard"
+BACKGROUND = "background"
+PRIORITIES = (INTERACTIVE, STANDARD, BACKGROUND)
+# Relative share of model call slots for one client in each class, e.g. "interactive=8,standard=3,background=1".
+MODEL_PRIORITY_WEIGHTS = os.getenv("MODEL_PRIORITY_WEIGHTS", "interactive=8,standard=3,background=1")
+
+
+def parse_priority_weights(spec):
+    weights = {INTERACTIVE: 8.0, STANDARD: 3.0, BACKGROUND: 1.0}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() in weights and value.strip():
+            weights[name.strip()] = max(float(value), 0.001)
+    return weights
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate_per_second = rate_per_second
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate_per_second <= 0:
+            return
+        # Waiters take tokens one at a time, in arrival order.
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate_per_second)
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is available now and nobody is waiting for one."""
+        if self.rate_per_second <= 0:
+            return True
+        if self._lock.locked():
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class ConcurrencyWindow:
+    """AIMD limit on concurrent model calls.
+
+    Each call that succeeds within the latency target adds 1/window, so the window grows by
+    about one per window's worth of calls. A quota error halves it and a slow call (or a
+    timeout) shrinks it by a fifth. Only calls started after the last decrease can cause
+    another one, so a burst of failures from the same round counts once.
+    """
+
+    def __init__(self, initial=MODEL_INITIAL_IN_FLIGHT, minimum=MODEL_MIN_IN_FLIGHT, maximum=MODEL_MAX_IN_FLIGHT,
+                 latency_target=MODEL_LATENCY_TARGET_SECONDS, adaptive=MODEL_ADAPTIVE_CONCURRENCY):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.adaptive = adaptive
+        self.latency_target = latency_target
+        self.size = float(min(max(initial, self.minimum), self.maximum) if adaptive else self.maximum)
+        self.increases = 0
+        self.decreases = {"quota": 0, "latency": 0}
+        self._last_decrease = float("-inf")
+
+    @property
+    def limit(self) -> int:
+        return int(self.size)
+
+    def on_success(self, started_at, seconds):
+        if not self.adaptive:
+            return
+        if self.latency_target and seconds > self.latency_target:
+            self._decrease("latency", LATENCY_BACKOFF, started_at)
+        elif self.size < self.maximum:
+            self.size = min(self.maximum, self.size + 1.0 / self.size)
+            self.increases += 1
+
+    def on_error(self, started_at, exc):
+        if not self.adaptive:
+            return
+        if is_quota_error(exc):
+            self._decrease("quota", QUOTA_BACKOFF, started_at)
+        elif isinstance(exc, ModelCallTimeout):
+            self._decrease("latency", LATENCY_BACKOFF, started_at)
+
+    def _decrease(self, reason, factor, started_at):
+        if started_at < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self.size = max(float(self.minimum), self.size * factor)
+        self.decreases[reason] += 1
+
+
+class _ClassStats:
+    def __init__(self):
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def as_dict(self):
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "average_wait_seconds": round(self.wait_seconds / self.completed, 3) if self.completed else 0.0,
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+        }
+
+
+class _Ticket:
+    # One call waiting for a slot; `priority` changes if its group is promoted while it waits.
+    def __init__(self, future, priority, group):
+        self.future = future
+        self.priority = priority
+        self.group = group
+
+
+class ModelCallScheduler:
+    """Keeps at most `window.limit` model calls running across all requests in the process.
+
+    Calls start as soon as a slot frees up (no batch barriers) and are paced by a token
+    bucket so bursts stay inside the per-minute quota. The number of slots follows an AIMD
+    window (see ConcurrencyWindow), and a quota error's retry-after hint pauses new calls
+    for that long. Waiting calls are queued per
+    (priority, client) and a freed slot goes to the queue with the least weighted service
+    so far (stride scheduling), so one client's full report cannot hold up another
+    client's single section, and background work still makes progress. Calls given a
+    `group` can be promoted together to a more urgent class while they wait.
+    """
+
+    def __init__(self, max_in_flight=MODEL_MAX_IN_FLIGHT, rate_per_minute=MODEL_RATE_LIMIT_PER_MINUTE,
+                 burst=MODEL_RATE_LIMIT_BURST, weights=None, window=None):
+        self.max_in_flight = max_in_flight
+        self.window = window or ConcurrencyWindow(maximum=max_in_flight)
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.weights = weights or parse_priority_weights(MODEL_PRIORITY_WEIGHTS)
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.classes = {priority: _ClassStats() for priority in PRIORITIES}
+        self._loop = None
+        self._bucket = None
+        self._slots_taken = 0
+        self._queues = {}  # (priority, client) -> deque of _Ticket
+        self._passes = {}  # (priority, client) -> virtual time of its next dispatch
+        self._virtual_time = 0.0
+        self._paused_until = 0.0
+        self._resume_handle = None
+
+    def _bind_loop(self):
+        # asyncio primitives belong to one event loop; rebuild them if the loop changes
+        # (e.g. between test clients or worker restarts).
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._bucket = TokenBucket(self.rate_per_minute / 60.0, self.burst)
+            self._slots_taken = 0
+            self._queues = {}
+            self._passes = {}
+            self._virtual_time = 0.0
+            self._paused_until = 0.0
+            self._resume_handle = None
+
+    def _enqueue(self, flow, ticket):
+        queue = self._queues.get(flow)
+        if queue is None:
+            queue = self._queues[flow] = deque()
+            # A client that was idle starts level with the others instead of cashing in on its idle time.
+            self._passes[flow] = max(self._passes.get(flow, 0.0), self._virtual_time)
+        queue.append(ticket)
+        return ticket
+
+    def promote(self, group, priority):
+        """Move `group`'s waiting calls to `priority` if that is more urgent than their own."""
+        if group is None or priority not in self.weights or self._loop is None:
+            return
+        rank = PRIORITIES.index(priority)
+        for flow, queue in list(self._queues.items()):
+            if PRIORITIES.index(flow[0]) <= rank:
+                continue
+            moving = [ticket for ticket in queue if ticket.group is group and not ticket.future.done()]
+            for ticket in moving:
+                queue.remove(ticket)
+                self.classes[ticket.priority].queued -= 1
+                ticket.priority = priority
+                self.classes[priority].queued += 1
+                self._enqueue((priority, flow[1]), ticket)
+            if not queue:
+                del self._queues[flow]
+        self._dispatch()
+
+    def _dispatch(self):
+        paused_for = self._paused_until - time.monotonic()
+        if paused_for > 0:
+            if self._resume_handle is None:
+                self._resume_handle = self._loop.call_later(paused_for, self._resume)
+            return
+        while self._slots_taken < self.window.limit and self._queues:
+            flow = min(self._queues, key=lambda key: (self._passes[key], PRIORITIES.index(key[0])))
+            queue = self._queues[flow]
+            ticket = queue.popleft()
+            if not queue:
+                del self._queues[flow]
+            if ticket.future.done():
+                continue  # its caller was cancelled while waiting
+            self._virtual_time = self._passes[flow]
+            self._passes[flow] += 1.0 / self.weights[flow[0]]
+            self._slots_taken += 1
+            ticket.future.set_result(None)
+        # Forget idle clients that would restart at the current virtual time anyway.
+        for flow in [key for key, value in self._passes.items() if key not in self._queues and value <= self._virtual_time]:
+            del self._passes[flow]
+
+    def _resume(self):
+        self._resume_handle = None
+        self._dispatch()
+
+    def _observe(self, started_at, exc=None):
+        if exc is None:
+            self.window.on_success(started_at, time.monotonic() - started_at)
+            return
+        self.window.on_error(started_at, exc)
+        retry_after = retry_after_seconds(exc) if is_quota_error(exc) else None
+        if retry_after:
+            # The service said when it will take calls again; sending more before then only burns quota.
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def _release(self):
+        self._slots_taken -= 1
+        self._dispatch()
+
+    def try_acquire(self):
+        """Take a slot and a rate-limit token for an extra call (e.g. a hedge) only if both are
+        free right now and no call is waiting. Returns the function that releases them, or None."""
+        self._bind_loop()
+        if self._queues or self._slots_taken >= self.window.limit or self._paused_until > time.monotonic():
+            return None
+        if not self._bucket.try_acquire():
+            return None
+        self._slots_taken += 1
+        self.in_flight += 1
+
+        def release():
+            self.in_flight -= 1
+            self._release()
+
+        return release
+
+    async def run(self, call, priority=STANDARD, client=None, group=None):
+        """Run `call()` (a coroutine function) once a slot and a rate-limit token are available.
+
+        `client` identifies who the call is for (e.g. an address); calls in the same
+        priority class share slots fairly between clients. `group` (any object) lets
+        `promote(group, ...)` move the call to a more urgent class while it waits.
+        """
+        self._bind_loop()
+        priority = priority if priority in self.weights else STANDARD
+        queued_at = time.monotonic()
+        self.queued += 1
+        self.classes[priority].queued += 1
+        waiting = True
+        ticket = self._enqueue((priority, client), _Ticket(self._loop.create_future(), priority, group))
+        waiter = ticket.future
+        self._dispatch()
+        try:
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()  # the slot was granted just as the caller went away
+                else:
+                    waiter.cancel()
+                raise
+            stats = self.classes[ticket.priority]
+            try:
+                await self._bucket.acquire()
+                waited = time.monotonic() - queued_at
+                self.queued -= 1
+                stats.queued -= 1
+                waiting = False
+                stats.wait_seconds += waited
+                stats.max_wait_seconds = max(stats.max_wait_seconds, waited)
+                self.in_flight += 1
+                stats.in_flight += 1
+                started_at = time.monotonic()
+                try:
+                    result = await call()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._observe(started_at, e)
+                    raise
+                else:
+                    self._observe(started_at)
+                    return result
+                finally:
+                    self.in_flight -= 1
+                    stats.in_flight -= 1
+                    self.completed += 1
+                    stats.completed += 1
+            finally:
+                self._release()
+        finally:
+            if waiting:
+                self.queued -= 1
+                self.classes[ticket.priority].queued -= 1
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "window": self.window.limit,
+            "window_increases": self.window.increases,
+            "window_decreases": dict(self.window.decreases),
+            "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 3),
+            "rate_per_minute": self.rate_per_minute,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "completed": self.completed,
+            "classes": {priority: entry.as_dict() for priority, entry in self.classes.items()},
+        }
+
+
+model_scheduler = ModelCallScheduler()
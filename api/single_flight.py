@@ -0,0 +1,87 @@
+import asyncio
+import os
+
+# Share one in-flight extraction between concurrent identical requests (retries, double clicks).
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") == "1"
+
+
+class _Flight:
+    def __init__(self, task, owner):
+        self.task = task
+        self.owner = owner
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs at most one task per key; concurrent callers with the same key await that task.
+
+    Every caller holds a reference. A caller that is cancelled only drops its reference;
+    the task itself is cancelled when the last caller has gone, so a retried or duplicate
+    request never cuts the model call short for the others.
+    """
+
+    def __init__(self, enabled=SINGLE_FLIGHT):
+        self.enabled = enabled
+        self.started = 0
+        self.joined = 0
+        self.abandoned = 0
+        self._loop = None
+        self._flights = {}
+
+    def _bind_loop(self):
+        # Tasks belong to one event loop; forget flights from a previous loop (e.g. test clients).
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._flights = {}
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _current(self):
+        return self._flights if self.enabled and self._loop is asyncio.get_running_loop() else {}
+
+    def owner(self, key):
+        """The `owner` given by the caller that started the call in flight for `key`, if any."""
+        flight = self._current().get(key)
+        return flight.owner if flight is not None else None
+
+    def find(self, match):
+        """A key in flight for which `match(key)` is true, or None."""
+        return next((key for key in self._current() if match(key)), None)
+
+    async def run(self, key, call, owner=None):
+        """Return (result of `call()`, joined): joined is True when an identical call was already running."""
+        if not self.enabled:
+            return await call(), False
+        self._bind_loop()
+        flight = self._flights.get(key)
+        joined = flight is not None
+        if joined:
+            self.joined += 1
+        else:
+            flight = self._flights[key] = _Flight(asyncio.ensure_future(call()), owner)
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.started += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), joined
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Nobody is waiting any more: stop the work and let the next caller start afresh.
+                self.abandoned += 1
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "joined": self.joined,
+            "abandoned": self.abandoned,
+        }
+
+
+extraction_flights = SingleFlight()
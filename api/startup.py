@@ -0,0 +1,31 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupReport:
+    """Seconds spent in each import and warm-up phase, for tracking cold-start latency."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases = {}  # phase name -> seconds, in the order they ran
+
+    @contextmanager
+    def measure(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = time.perf_counter() - started
+
+    def as_dict(self) -> dict:
+        return {
+            "phases": {phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+            "imports_seconds": round(sum(seconds for phase, seconds in self.phases.items() if phase.startswith("import.")), 4),
+        }
+
+    def summary(self) -> str:
+        slowest = sorted(self.phases.items(), key=lambda item: item[1], reverse=True)
+        return ", ".join(f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in slowest)
+
+
+startup_report = StartupReport()
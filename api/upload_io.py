@@ -0,0 +1,46 @@
+import asyncio
+import hashlib
+import os
+
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+def _read_spooled(spooled_file, max_bytes, chunk_size):
+    # Starlette has already streamed the multipart body into a spooled temp file. Load it
+    # into a single bytes object and hash it in bounded chunks over a zero-copy view.
+    spooled_file.seek(0, os.SEEK_END)
+    size = spooled_file.tell()
+    if size > max_bytes:
+        raise UploadTooLarge(f"Upload is {size} bytes; the limit is {max_bytes}")
+    spooled_file.seek(0)
+    data = spooled_file.read()
+    hasher = hashlib.sha256()
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        hasher.update(view[offset:offset + chunk_size])
+    return data, hasher.hexdigest()
+
+
+def upload_size(file) -> int:
+    """Size of an UploadFile's body, without reading it."""
+    size = getattr(file, "size", None)
+    if size is None:
+        position = file.file.tell()
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
+        file.file.seek(position)
+    return size
+
+
+async def read_upload(file, max_bytes=MAX_UPLOAD_BYTES, chunk_size=UPLOAD_CHUNK_BYTES):
+    """Return (pdf_bytes, sha256) for an UploadFile without blocking the event loop.
+
+    The document exists once in memory; the hash is computed in the same pass so callers
+    never re-hash it.
+    """
+    return await asyncio.to_thread(_read_spooled, file.file, max_bytes, chunk_size)
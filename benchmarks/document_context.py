@@ -0,0 +1,50 @@
+"""Compare inline vs. uploaded-once document context using the offline LocalBackend.
+
+    python benchmarks/document_context.py [--pdf report.pdf | --size-mb 8] [--form-type 1004]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api import pdf_extractor  # noqa: E402
+from api.model_backend import LocalBackend, set_model_backend  # noqa: E402
+from benchmarks.synthetic_report import build_report  # noqa: E402
+
+
+async def run_mode(context_mode, pdf_bytes, form_type):
+    backend = LocalBackend(context_mode=context_mode)
+    set_model_backend(backend)
+    pdf_extractor.extraction_cache.clear()
+    started = time.perf_counter()
+    await pdf_extractor.extract_fields_from_pdf(None, form_type, pdf_bytes=pdf_bytes)
+    stats = backend.stats()
+    stats["wall_seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pdf", help="PDF to measure; defaults to a synthetic report of about --size-mb")
+    parser.add_argument("--size-mb", type=float, default=8.0)
+    parser.add_argument("--form-type", default="1004")
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            pdf_bytes = f.read()
+    else:
+        pdf_bytes = build_report(args.form_type, args.size_mb)
+
+    for mode in ("inline", "file"):
+        stats = asyncio.run(run_mode(mode, pdf_bytes, args.form_type))
+        sent = stats["request_bytes"] + stats["upload_bytes"]
+        print(f"{mode:>6}: calls={stats['calls']} uploads={stats['uploads']} "
+              f"bytes_sent={sent / 1024 / 1024:.1f}MB simulated={stats['simulated_seconds']}s wall={stats['wall_seconds']}s")
+
+
+if __name__ == "__main__":
+    main()
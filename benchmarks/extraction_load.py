@@ -0,0 +1,155 @@
+"""Load-test /extract and /extract-by-category against the offline SimulatedBackend.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/extraction_load.py [--form-types 1004,1073,1007] [--concurrency 1,4,16]
+        [--reports 8] [--endpoint extract|by-category|both] [--latency lognormal:1.5:0.4]
+        [--error-rate 0.02] [--quota-per-minute 0] [--responses canned.json] [--seed 1] [--json]
+
+Requests go through the FastAPI app in-process, so the scheduler, cache, page routing and
+retries all behave as in production while no model quota is used. Every report gets unique
+bytes unless --repeat-document is given, which measures the cache instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from api import pdf_extractor  # noqa: E402
+from api.model_backend import SimulatedBackend, set_model_backend  # noqa: E402
+from benchmarks.synthetic_report import build_report  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def report_categories(form_type):
+    return [name for name in pdf_extractor.categories_for(form_type)
+            if pdf_extractor.build_category_prompt(name) is not None]
+
+
+async def post_pdf(client, path, pdf_bytes, data):
+    started = time.perf_counter()
+    response = await client.post(path, files={"file": ("report.pdf", pdf_bytes, "application/pdf")}, data=data)
+    return time.perf_counter() - started, response.status_code
+
+
+async def run_report(client, endpoint, pdf_bytes, form_type, request_latencies, failures):
+    # "extract" is one full-report request; "by-category" fires one request per category at
+    # once, the way the Subject page does, and the report finishes with its slowest request.
+    started = time.perf_counter()
+    if endpoint == "extract":
+        requests = [post_pdf(client, "/extract", pdf_bytes, {"form_type": form_type})]
+    else:
+        requests = [post_pdf(client, "/extract-by-category", pdf_bytes, {"form_type": form_type, "category": name})
+                    for name in report_categories(form_type)]
+    for elapsed, status_code in await asyncio.gather(*requests):
+        request_latencies.append(elapsed)
+        if status_code != 200:
+            failures.append(status_code)
+    return time.perf_counter() - started
+
+
+async def run_level(client, backend, endpoint, form_type, concurrency, reports, pdf_bytes, repeat_document):
+    pdf_extractor.extraction_cache.clear()
+    backend.reset_stats()
+    report_latencies, request_latencies, failures = [], [], []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one_report(number):
+        document = pdf_bytes if repeat_document else pdf_bytes + f"\n%{number}-{time.time_ns()}".encode()
+        async with slots:
+            report_latencies.append(await run_report(client, endpoint, document, form_type, request_latencies, failures))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_report(number) for number in range(reports)))
+    wall = time.perf_counter() - started
+    stats = backend.stats()
+    return {
+        "endpoint": endpoint,
+        "form_type": form_type,
+        "concurrency": concurrency,
+        "reports": reports,
+        "requests": len(request_latencies),
+        "failed_requests": len(failures),
+        "p50": round(percentile(report_latencies, 50), 3),
+        "p95": round(percentile(report_latencies, 95), 3),
+        "p99": round(percentile(report_latencies, 99), 3),
+        "request_p50": round(percentile(request_latencies, 50), 3),
+        "request_p99": round(percentile(request_latencies, 99), 3),
+        "calls_per_report": round(stats["calls"] / reports, 2),
+        "quota_errors": stats["quota_errors"],
+        "bytes_sent": stats["request_bytes"] + stats["upload_bytes"],
+        "requests_per_second": round(len(request_latencies) / wall, 2),
+        "reports_per_second": round(reports / wall, 2),
+        "wall_seconds": round(wall, 3),
+    }
+
+
+async def run(args, backend, pdf_bytes):
+    endpoints = ["extract", "by-category"] if args.endpoint == "both" else [args.endpoint]
+    transport = httpx.ASGITransport(app=server.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        for endpoint in endpoints:
+            for form_type in args.form_types.split(","):
+                for concurrency in [int(value) for value in args.concurrency.split(",")]:
+                    result = await run_level(client, backend, endpoint, form_type, concurrency, args.reports,
+                                             pdf_bytes, args.repeat_document)
+                    results.append(result)
+                    if not args.json:
+                        print(f"{endpoint:>11} {form_type} c={concurrency:<3} p50={result['p50']}s p95={result['p95']}s "
+                              f"p99={result['p99']}s calls/report={result['calls_per_report']} "
+                              f"sent={result['bytes_sent'] / 1024 / 1024:.1f}MB rps={result['requests_per_second']} "
+                              f"429s={result['quota_errors']} failed={result['failed_requests']}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--form-types", default="1004,1073,1007")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated reports in flight")
+    parser.add_argument("--reports", type=int, default=8, help="reports per concurrency level")
+    parser.add_argument("--endpoint", choices=["extract", "by-category", "both"], default="both")
+    parser.add_argument("--latency", default="lognormal:1.5:0.4", help="per-call latency spec, e.g. fixed:0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability a call fails with a 429")
+    parser.add_argument("--quota-per-minute", type=int, default=0, help="simulated server-side quota; 0 = none")
+    parser.add_argument("--responses", help="JSON file of canned responses keyed by category")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--pdf", help="PDF to send; defaults to a synthetic report of about --size-mb")
+    parser.add_argument("--size-mb", type=float, default=2.0)
+    parser.add_argument("--repeat-document", action="store_true", help="send the same bytes for every report")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    responses = None
+    if args.responses:
+        with open(args.responses, "r", encoding="utf-8") as f:
+            responses = json.load(f)
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            pdf_bytes = f.read()
+    else:
+        pdf_bytes = build_report(args.form_types.split(",")[0], args.size_mb, seed=args.seed)
+
+    backend = SimulatedBackend(latency=args.latency, error_rate=args.error_rate,
+                               quota_per_minute=args.quota_per_minute, responses=responses, seed=args.seed)
+    set_model_backend(backend)
+    results = asyncio.run(run(args, backend, pdf_bytes))
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
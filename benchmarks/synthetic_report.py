@@ -0,0 +1,104 @@
+"""Synthetic appraisal reports for the benchmarks.
+
+A real multi-page PDF: the form pages carry each section's printed headings and a few
+labelled values in the text layer (so page routing and local extraction have something to
+find), followed by captioned photo pages that pad the report to the requested size.
+"""
+import os
+import random
+from io import BytesIO
+
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+
+from api.page_router import CATEGORY_PAGE_MARKERS, FORM_LAYOUTS, FORM_TITLE_MARKERS
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+PHOTO_WIDTH, PHOTO_HEIGHT = 480, 320  # 8-bit grey, so one photo is ~150 KB
+PHOTO_CAPTIONS = ["Front", "Rear", "Street", "Bedroom", "Bathroom", "Kitchen", "Living Room",
+                  "Comparable 1 Front", "Comparable 2 Front", "Comparable 3 Front"]
+SUBJECT_VALUES = [("Property Address", "12 Oak Lane"), ("City", "Springfield"), ("State", "IL"),
+                  ("Zip Code", "62704"), ("County", "Sangamon"), ("Assessor's Parcel #", "14-22-301-017")]
+
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _text(cells):
+    """Content stream drawing [(x, y, text)] in Helvetica."""
+    return "".join(f"BT /F1 9 Tf {x} {y} Td ({_escape(text)}) Tj ET\n" for x, y, text in cells)
+
+
+def _add_page(writer, font, content, images=None):
+    page = writer.add_blank_page(PAGE_WIDTH, PAGE_HEIGHT)
+    resources = DictionaryObject({NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})})
+    if images:
+        resources[NameObject("/XObject")] = DictionaryObject(
+            {NameObject(f"/{name}"): image for name, image in images.items()})
+    page[NameObject("/Resources")] = resources
+    stream = DecodedStreamObject()
+    stream.set_data(content.encode("latin-1"))
+    page[NameObject("/Contents")] = writer._add_object(stream)
+
+
+def _photo(writer, rng):
+    # Smooth random gradients rather than noise, so the photos survive perceptual hashing.
+    row = bytes(rng.randrange(256) for _ in range(PHOTO_WIDTH))
+    rows = [bytes((value + line * rng.randrange(1, 3)) % 256 for value in row) for line in range(PHOTO_HEIGHT)]
+    image = DecodedStreamObject()
+    image.set_data(b"".join(rows))
+    image.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Image"),
+        NameObject("/Width"): NumberObject(PHOTO_WIDTH),
+        NameObject("/Height"): NumberObject(PHOTO_HEIGHT),
+        NameObject("/ColorSpace"): NameObject("/DeviceGray"),
+        NameObject("/BitsPerComponent"): NumberObject(8),
+    })
+    return writer._add_object(image)
+
+
+def build_report(form_type="1004", size_mb=2.0, seed=None) -> bytes:
+    rng = random.Random(seed if seed is not None else os.urandom(8))
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    layout = FORM_LAYOUTS.get(form_type, FORM_LAYOUTS["1004"])
+    pages = {}
+    for category_name, offsets in layout.items():
+        pages.setdefault(offsets[0], []).append(category_name)
+    for offset in range(max(pages) + 1):
+        cells = []
+        if offset == 0:
+            cells.append((40, 760, FORM_TITLE_MARKERS.get(form_type, FORM_TITLE_MARKERS["1004"]).title()))
+            cells += [(40, 740 - 14 * row, label) for row, (label, _) in enumerate(SUBJECT_VALUES)]
+            cells += [(200, 740 - 14 * row, value) for row, (_, value) in enumerate(SUBJECT_VALUES)]
+        y = 640
+        for category_name in pages.get(offset, []):
+            for marker in CATEGORY_PAGE_MARKERS.get(category_name, []):
+                cells.append((40, y, marker.title()))
+                y -= 14
+        _add_page(writer, font, _text(cells))
+
+    # Photo pages, two photos each, until the report reaches its target size.
+    photo_bytes = PHOTO_WIDTH * PHOTO_HEIGHT
+    count = max(2, int(size_mb * 1024 * 1024) // photo_bytes)
+    photos = [_photo(writer, rng) for _ in range(count - 1)]
+    photos.append(photos[0])  # one repeated photo, as in reports that reuse a picture
+    for first in range(0, count, 2):
+        images, content, cells = {}, "", []
+        for slot, index in enumerate(range(first, min(first + 2, count))):
+            name = f"Im{slot}"
+            images[name] = photos[index]
+            y = 420 - slot * 380
+            content += f"q {PHOTO_WIDTH} 0 0 {PHOTO_HEIGHT} 66 {y} cm /{name} Do Q\n"
+            cells.append((66, y - 12, PHOTO_CAPTIONS[index % len(PHOTO_CAPTIONS)]))
+        _add_page(writer, font, content + _text(cells), images)
+    writer.add_metadata({"/Producer": "synthetic appraisal report"})
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
@@ -2,16 +2,57 @@ import os
 # Suppress gRPC ALTS credentials warnings when not on GCP
 os.environ["GRPC_VERBOSITY"] = "ERROR"
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.middleware.cors import CORSMiddleware
-from api.pdf_extractor import (
-    extract_fields_from_pdf, 
-    get_sales_comparison_data
-)
-import tempfile
+from api.startup import startup_report
+
+# Import cost per module is recorded for the cold-start report (see /metrics).
+with startup_report.measure("import.fastapi"):
+    from fastapi import Body, FastAPI, UploadFile, File, HTTPException, Form, Request
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import PlainTextResponse, StreamingResponse
+with startup_report.measure("import.pdf_extractor"):
+    from api.pdf_extractor import (
+        extract_fields_from_pdf, 
+        get_sales_comparison_data,
+        get_portfolio_sales_analytics,
+        stream_extraction_events,
+        warm_up
+    )
+with startup_report.measure("import.batch_extraction"):
+    from api.batch_extraction import BATCH_MAX_BYTES, BATCH_MAX_FILES, read_zip_pdfs, resolve_form_types, stream_batch_extraction
+with startup_report.measure("import.document_store"):
+    from api.document_store import document_store
+with startup_report.measure("import.job_queue"):
+    from api.job_queue import job_queue
+with startup_report.measure("import.metrics"):
+    from api.metrics import render_metrics
+with startup_report.measure("import.prefetch"):
+    from api.prefetch import prefetcher
+with startup_report.measure("import.upload_io"):
+    from api.upload_io import UploadTooLarge, read_upload, upload_size
+from contextlib import asynccontextmanager
+from typing import List
+import asyncio
+import json
 import traceback
 
-app = FastAPI()
+# Create the model client and prompt templates in the background at startup; otherwise
+# the first extraction does it.
+PREWARM_MODEL_CLIENT = os.getenv("PREWARM_MODEL_CLIENT", "1") == "1"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Background workers drain (and, after a restart, resume) queued full-report jobs.
+    await job_queue.start()
+    if PREWARM_MODEL_CLIENT:
+        warming = asyncio.ensure_future(asyncio.to_thread(warm_up))
+        warming.add_done_callback(lambda _: print(f"Startup timings: {startup_report.summary()}"))
+    else:
+        print(f"Startup timings: {startup_report.summary()}")
+    yield
+    await job_queue.stop()
+    await prefetcher.cancel_all()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,53 +66,149 @@ app.add_middleware(
 def health():
     return {"status": "ok"}
 
-@app.post("/extract-by-category")
-async def extract_by_category(file: UploadFile = File(...), form_type: str = Form(...), category: str = Form(None)):
-    if not file.filename:
+@app.get("/metrics")
+def metrics():
+    # Prometheus text exposition format.
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def validate_pdf_upload(file: UploadFile):
+    if file is None or not file.filename:
         raise HTTPException(status_code=400, detail="No file uploaded")
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-        content = await file.read()
-        tmp.write(content)
-        tmp_path = tmp.name
-    
+
+async def read_pdf_upload(file: UploadFile):
+    validate_pdf_upload(file)
+    try:
+        return await read_upload(file)
+    except UploadTooLarge as exc:
+        raise HTTPException(status_code=413, detail=str(exc))
+
+def client_id(request: Request):
+    # Model call slots are shared fairly between clients; callers may name themselves.
+    return request.headers.get("x-client-id") or (request.client.host if request.client else None)
+
+async def load_pdf(file: UploadFile, document_id: str):
+    # Returns (pdf_bytes, sha256) from a stored document or the uploaded file, without
+    # blocking the event loop on disk reads.
+    if document_id:
+        pdf_bytes = await asyncio.to_thread(document_store.get, document_id)
+        if pdf_bytes is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired document_id. Upload the PDF again.")
+        return pdf_bytes, document_id
+    return await read_pdf_upload(file)
+
+@app.post("/documents")
+async def upload_document(file: UploadFile = File(...)):
+    content, pdf_sha256 = await read_pdf_upload(file)
+    document_id = await asyncio.to_thread(document_store.put, content, pdf_sha256)
+    return {"document_id": document_id, "size": len(content), "expires_in": document_store.ttl_seconds}
+
+@app.delete("/documents/{document_id}")
+async def delete_document(document_id: str):
+    if not await asyncio.to_thread(document_store.delete, document_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired document_id")
+    return {"deleted": document_id}
+
+@app.post("/jobs")
+async def create_job(file: UploadFile = File(None), form_type: str = Form(...), category: str = Form(None), document_id: str = Form(None), previous_document_id: str = Form(None)):
+    pdf_bytes, pdf_sha256 = await load_pdf(file, document_id)
+    job_id = await job_queue.submit(pdf_bytes, pdf_sha256, form_type, category, previous_sha256=previous_document_id)
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job_id")
+    return job
+
+@app.post("/extract-by-category")
+async def extract_by_category(request: Request, file: UploadFile = File(None), form_type: str = Form(...), category: str = Form(None), document_id: str = Form(None), previous_document_id: str = Form(None)):
+    pdf_bytes, pdf_sha256 = await load_pdf(file, document_id)
     try:
         # This function from pdf_extractor.py contains the long-running Gemini calls
-        data = await extract_fields_from_pdf(tmp_path, form_type, category=category, custom_prompt=None)
+        data = await extract_fields_from_pdf(None, form_type, category=category, custom_prompt=None, pdf_bytes=pdf_bytes, pdf_sha256=pdf_sha256, previous_sha256=previous_document_id, client=client_id(request))
         return data
     except Exception as exc:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(exc))
-    finally:
+
+@app.post("/extract-stream")
+async def extract_stream(request: Request, file: UploadFile = File(None), form_type: str = Form(...), category: str = Form(None), document_id: str = Form(None), previous_document_id: str = Form(None)):
+    # NDJSON: one {"event": "category", ...} line per section in completion order,
+    # then a {"event": "summary", "fields": ..., "raw": ...} line with the merged result.
+    pdf_bytes, pdf_sha256 = await load_pdf(file, document_id)
+    client = client_id(request)
+
+    async def events():
+        async for event in stream_extraction_events(None, form_type, category=category, pdf_bytes=pdf_bytes, pdf_sha256=pdf_sha256, previous_sha256=previous_document_id, client=client):
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@app.post("/extract-batch")
+async def extract_batch(request: Request, files: List[UploadFile] = File(None), archive: UploadFile = File(None), form_type: str = Form(None), form_types: str = Form(None)):
+    # Accepts several PDFs and/or one zip of PDFs. Streams one NDJSON "report" event per
+    # unique document as it finishes, then a "summary" event.
+    # Limits are checked from the upload sizes before anything is read into memory.
+    files = files or []
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_FILES} files per batch")
+    has_archive = archive is not None and archive.filename
+    total_bytes = sum(upload_size(file) for file in files) + (upload_size(archive) if has_archive else 0)
+    if total_bytes > BATCH_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"The batch is larger than {BATCH_MAX_BYTES} bytes")
+    uploads = []
+    for file in files:
+        pdf_bytes, pdf_sha256 = await read_pdf_upload(file)
+        uploads.append((file.filename, pdf_bytes, pdf_sha256))
+    if has_archive:
+        if not archive.filename.lower().endswith('.zip'):
+            raise HTTPException(status_code=400, detail="archive must be a .zip file")
         try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+            archive_bytes, _ = await read_upload(archive)
+            file_bytes = sum(len(pdf_bytes) for _, pdf_bytes, _ in uploads)
+            uploads.extend(await asyncio.to_thread(
+                read_zip_pdfs, archive_bytes, BATCH_MAX_FILES - len(uploads), BATCH_MAX_BYTES - file_bytes))
+        except (ValueError, UploadTooLarge) as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No PDF files uploaded")
+    if len(uploads) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_FILES} files per batch")
 
-@app.post("/extract")
-async def extract(file: UploadFile = File(...), form_type: str = Form(...), category: str = Form(None), comment: str = Form(None)):
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="No file uploaded")
-    if not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(status_code=400, detail="Only PDF files are supported")
+    resolved = resolve_form_types([name for name, _, _ in uploads], form_types, form_type)
+    documents = [
+        (name, pdf_bytes, resolved_type, pdf_sha256)
+        for (name, pdf_bytes, pdf_sha256), resolved_type in zip(uploads, resolved)
+    ]
+    client = client_id(request)
+
+    async def events():
+        async for event in stream_batch_extraction(documents, client=client):
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-        content = await file.read()
-        tmp.write(content)
-        tmp_path = tmp.name
+@app.post("/sales-comparison")
+async def sales_comparison(payload: dict = Body(...)):
+    # {"fields": {...}} for one report's extracted fields, or {"reports": [{...}, ...]} for a portfolio.
+    if isinstance(payload.get("reports"), list):
+        return await asyncio.to_thread(get_portfolio_sales_analytics, payload["reports"])
+    if isinstance(payload.get("fields"), dict):
+        return await asyncio.to_thread(get_sales_comparison_data, payload["fields"])
+    raise HTTPException(status_code=400, detail="Send {'fields': {...}} or {'reports': [...]}")
+
+@app.post("/extract")
+async def extract(request: Request, file: UploadFile = File(None), form_type: str = Form(...), category: str = Form(None), comment: str = Form(None), document_id: str = Form(None), previous_document_id: str = Form(None)):
+    pdf_bytes, pdf_sha256 = await load_pdf(file, document_id)
     try:
-        data = await extract_fields_from_pdf(tmp_path, form_type, category=category, custom_prompt=comment)
+        data = await extract_fields_from_pdf(None, form_type, category=category, custom_prompt=comment, pdf_bytes=pdf_bytes, pdf_sha256=pdf_sha256, previous_sha256=previous_document_id, client=client_id(request))
         return data
     except Exception as exc:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(exc))
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
 
 if __name__ == "__main__":
     import uvicorn
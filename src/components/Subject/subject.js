@@ -388,6 +388,8 @@ function Subject() {
   const timerRef = useRef(null);
   const [isEditable, setIsEditable] = useState(true);
   const fileInputRef = useRef(null);
+  // The PDF is uploaded once to /documents and every section request references it by id.
+  const uploadedDocumentRef = useRef({ file: null, id: null, previousId: null, name: null, formType: null });
   const [isGeneratingPdf, setIsGeneratingPdf] = useState(false);
   const [editingField, setEditingField] = useState(null);
   const [themeMode, setThemeMode] = useState('light');
@@ -982,6 +984,36 @@ function Subject() {
     }, 1000);
   };
 
+  const uploadDocument = async (formType, signal) => {
+    if (uploadedDocumentRef.current.file === selectedFile && uploadedDocumentRef.current.id) {
+      return uploadedDocumentRef.current.id;
+    }
+    const formData = new FormData();
+    formData.append('file', selectedFile);
+    try {
+      const response = await fetch('/documents', { method: 'POST', body: formData, signal });
+      if (!response.ok) return null;
+      const { document_id } = await response.json();
+      // A file with the same name and form type as the previous upload is treated as a revision
+      // of it, so the server can reuse results for the sections whose pages did not change.
+      // Any other file is an unrelated report and starts without a previous document.
+      const { id: previousId, previousId: olderId, name, formType: previousFormType } = uploadedDocumentRef.current;
+      const isRevision = name === selectedFile.name && previousFormType === formType;
+      uploadedDocumentRef.current = {
+        file: selectedFile,
+        id: document_id,
+        previousId: isRevision ? (previousId && previousId !== document_id ? previousId : olderId) : null,
+        name: selectedFile.name,
+        formType,
+      };
+      return document_id;
+    } catch (error) {
+      if (error.name === 'AbortError') throw error;
+      // Older backends without /documents: fall back to sending the file with each request.
+      return null;
+    }
+  };
+
   const callExtractionAPI = async (formType, category, onRetry) => {
     setExtractionProgress(10);
     const retries = 3;
@@ -991,8 +1023,16 @@ function Subject() {
     const controller = new AbortController();
     for (let i = 0; i < retries; i++) {
       try {
+        const documentId = await uploadDocument(formType, controller.signal);
         const formData = new FormData();
-        formData.append('file', selectedFile);
+        if (documentId) {
+          formData.append('document_id', documentId);
+          if (uploadedDocumentRef.current.previousId) {
+            formData.append('previous_document_id', uploadedDocumentRef.current.previousId);
+          }
+        } else {
+          formData.append('file', selectedFile);
+        }
         formData.append('form_type', formType);
         if (category) {
           formData.append('category', category);
@@ -1013,6 +1053,10 @@ function Subject() {
         });
 
         if (!response.ok) {
+          if (response.status === 404) {
+            // The stored document expired on the server; upload it again on the next attempt.
+            uploadedDocumentRef.current = { ...uploadedDocumentRef.current, file: null, id: null };
+          }
           const errorText = await response.text();
           let errorMessage = errorText;
           try {